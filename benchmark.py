@@ -0,0 +1,560 @@
+"""Benchmarks the recommendation engines on generated review data
+
+Times each recommender path (p50/p95/p99 latency and peak memory) and scores
+it offline against held-out reviews (precision@k and recall@k):
+
+    $ python benchmark.py [num_users] [num_games] [reviews_per_user]
+    $ python benchmark.py 20000 5000 50 --json results.json
+    $ python benchmark.py --db
+    $ python benchmark.py --search 100000 [--db]
+
+The defaults generate 100k reviews; 20000 x 50 is 1M. The in-memory engines
+(RatingMatrix.recommend_games() mirrors the Pearson lists precompute.py
+stores) compare the algorithms rather than database round-trips. --db instead
+times the request-time SQL paths against the configured database, where
+there is nothing held out to score. --json writes the results (or "-" for
+stdout) so runs can be compared for regressions.
+
+--search times the search backends on a generated catalog instead. With
+--db the catalog is inserted into the configured database in a transaction
+that is rolled back, to time TrigramSearch with and without its indexes.
+"""
+
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from factorization import FactorModel
+from similarity import RatingMatrix, UserLSH
+
+
+def generate_reviews(num_users=2000, num_games=1000, per_user=50, factors=5,
+                     seed=0):
+    """Makes (user_id, game_id, score) rows with a hidden taste structure
+
+    Scores fall between 50 and 100 like gen_fake_data's, but follow latent
+    user and game traits so there is something for the engines to find.
+    Popular games are reviewed more often, as on the real site.
+    """
+
+    rand = np.random.RandomState(seed)
+    tastes = rand.normal(size=(num_users, factors))
+    traits = rand.normal(size=(num_games, factors))
+
+    popularity = 1.0 / np.arange(1, num_games + 1)
+    popularity /= popularity.sum()
+
+    rows = []
+    for user in range(num_users):
+        games = rand.choice(num_games, min(per_user, num_games), replace=False,
+                            p=popularity)
+        affinity = traits[games].dot(tastes[user]) / np.sqrt(factors)
+        scores = np.clip(75 + 12 * affinity + rand.normal(scale=4, size=len(games)),
+                         50, 100).round().astype(int)
+
+        rows.extend(zip([user + 1] * len(games), (games + 1).tolist(),
+                        scores.tolist()))
+
+    return rows
+
+
+def split_holdout(rows, fraction=0.2, seed=0):
+    """Splits rows into (train, held_out) with held_out keyed by user_id"""
+
+    rand = np.random.RandomState(seed)
+    held = rand.random_sample(len(rows)) < fraction
+
+    train = [row for row, hold in zip(rows, held) if not hold]
+    held_out = {}
+    for (user_id, game_id, score), hold in zip(rows, held):
+        if hold:
+            held_out.setdefault(user_id, []).append((game_id, score))
+
+    return train, held_out
+
+
+def recall_at_k(recommended, held_out, k=20, liked=80):
+    """Share of the held-out games a user liked that appear in the top k"""
+
+    liked_games = set(game_id for game_id, score in held_out if score >= liked)
+    if not liked_games:
+        return None
+
+    return len(liked_games & set(recommended[:k])) / float(len(liked_games))
+
+
+def precision_at_k(recommended, held_out, k=20, liked=80):
+    """Share of the top k that are held-out games the user liked
+
+    Short lists are still divided by k, so an engine can't score well by
+    recommending less.
+    """
+
+    liked_games = set(game_id for game_id, score in held_out if score >= liked)
+    if not liked_games:
+        return None
+
+    return len(liked_games & set(recommended[:k])) / float(k)
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far, in megabytes"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        peak /= 1024
+
+    return peak / 1024.0
+
+
+def run_isolated(function):
+    """Calls function() in a forked child process and returns its result
+
+    The child has its own peak resident memory, so peak_memory_mb() called
+    inside function() covers only what it allocated on top of the
+    interpreter, not everything this process has run before.
+    """
+
+    receive, send = multiprocessing.Pipe(False)
+
+    def run():
+        try:
+            send.send((True, function()))
+        except Exception:
+            send.send((False, traceback.format_exc()))
+
+    child = multiprocessing.Process(target=run)
+    child.start()
+    succeeded, result = receive.recv()
+    child.join()
+
+    if not succeeded:
+        raise RuntimeError("Benchmark failed in child process:\n" + result)
+
+    return result
+
+
+def latency_stats(latencies):
+    """p50/p95/p99 and mean of latencies given in seconds, in milliseconds"""
+
+    latencies = np.array(latencies) * 1000
+    if not len(latencies):
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    return {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+            "mean_ms": latencies.mean()}
+
+
+def benchmark_engine(name, recommend, held_out, k=20, build_s=0.0):
+    """Times recommend(user_id) for each held-out user and scores the lists
+
+    Peak memory is the process's high-water mark once the engine has been
+    built and queried; compare_recommenders() runs each engine in its own
+    process so the figure is the engine's alone.
+    """
+
+    latencies = []
+    precisions = []
+    recalls = []
+
+    for user_id in sorted(held_out):
+        start = time.time()
+        recommended = recommend(user_id)
+        latencies.append(time.time() - start)
+
+        recall = recall_at_k(recommended, held_out[user_id], k)
+        if recall is not None:
+            recalls.append(recall)
+            precisions.append(precision_at_k(recommended, held_out[user_id], k))
+
+    result = {"engine": name, "users": len(latencies), "k": k,
+              "build_s": build_s, "peak_memory_mb": peak_memory_mb(),
+              "precision_at_k": np.mean(precisions) if precisions else 0.0,
+              "recall_at_k": np.mean(recalls) if recalls else 0.0}
+    result.update(latency_stats(latencies))
+
+    return result
+
+
+def compare_recommenders(num_users=2000, num_games=1000, per_user=50, k=20,
+                         max_users=500):
+    """Benchmarks every engine on one generated dataset; returns the results
+
+    Each engine is built and queried in its own child process (see
+    run_isolated()), so build times and memory include its RatingMatrix
+    and nothing left over from the engines before it. memory_mb is how far
+    the child's resident memory grew over the dataset it inherited.
+    """
+
+    rows = generate_reviews(num_users, num_games, per_user)
+    train, held_out = split_holdout(rows)
+
+    # Only time a sample of users so large datasets finish quickly
+    held_out = dict((user_id, held_out[user_id])
+                    for user_id in sorted(held_out)[:max_users])
+
+    def reviewed(matrix, user_id):
+        row = matrix.user_row(user_id)
+        if row is None:
+            return []
+        return matrix.game_ids[matrix.ratings(row)[0]]
+
+    def build_popular():
+        matrix = RatingMatrix.from_rows(train)
+
+        # Most reviewed games first, as precompute_popular() ranks them
+        counts = np.diff(matrix.game_ptr)
+        popular = matrix.game_ids[np.argsort(-counts, kind="mergesort")].tolist()
+
+        def recommend_popular(user_id):
+            skip = set(reviewed(matrix, user_id).tolist())
+            return [game_id for game_id in popular if game_id not in skip][:k]
+
+        return recommend_popular
+
+    def build_pearson():
+        return RatingMatrix.from_rows(train).recommend_games
+
+    def build_lsh():
+        matrix = RatingMatrix.from_rows(train)
+        index = UserLSH.from_rows(train)
+
+        def recommend_lsh(user_id):
+            rows = matrix.user_rows(index.candidates(user_id))
+            return matrix.recommend_games(user_id, rows=rows)
+
+        return recommend_lsh
+
+    def build_factors():
+        matrix = RatingMatrix.from_rows(train)
+        model = FactorModel.train(matrix)
+
+        return lambda user_id: model.recommend_games(user_id, k,
+                                                     reviewed(matrix, user_id))
+
+    def run(name, build):
+        before = peak_memory_mb()
+        start = time.time()
+        recommend = build()
+        result = benchmark_engine(name, recommend, held_out, k,
+                                  time.time() - start)
+        result["memory_mb"] = result["peak_memory_mb"] - before
+        return result
+
+    results = [run_isolated(lambda: run(name, build))
+               for name, build in [("popular", build_popular),
+                                   ("pearson", build_pearson),
+                                   ("lsh", build_lsh),
+                                   ("factors", build_factors)]]
+
+    for result in results:
+        result.update({"num_users": num_users, "num_games": num_games,
+                       "reviews": len(rows)})
+
+    return results
+
+
+def benchmark_database(k=20, max_users=200):
+    """Times the request-time SQL paths against the configured database
+
+    live is helpers.recommend_games() as served to users precompute.py
+    hasn't covered; stored reads the list precompute.py wrote. Neither goes
+    through the route cache. Their memory is mostly the database server's,
+    so peak memory is just this process's high-water mark.
+    """
+
+    import helpers
+    from model import User, Review, Recommendation, connect_to_db, db
+    from server import app # Imported here; server imports the engines
+
+    connect_to_db(app)
+
+    with app.app_context():
+        users = User.query.order_by(User.user_id).limit(max_users).all()
+
+        def recommend_live(user_id):
+            user = User.query.get(user_id)
+            return [row.game_id for row in helpers.recommend_games(user)]
+
+        def recommend_stored(user_id):
+            return [game_id for game_id, in
+                    db.session.query(Recommendation.game_id)
+                              .filter(Recommendation.user_id == user_id)
+                              .order_by(Recommendation.rank)]
+
+        held_out = dict((user.user_id, []) for user in users)
+        num_reviews = Review.query.count()
+
+        results = [benchmark_engine("sql_live", recommend_live, held_out, k),
+                   benchmark_engine("sql_stored", recommend_stored, held_out, k)]
+
+        for result in results:
+            result.update({"num_users": User.query.count(), "reviews": num_reviews,
+                           "precision_at_k": None, "recall_at_k": None})
+
+    return results
+
+
+def generate_catalog(num_games=10000, seed=0):
+    """Makes (category, id, name) search rows for a catalog of num_games
+
+    Names are one to four words drawn from a made-up vocabulary, with two
+    users per game and proportionally fewer franchises, developers,
+    platforms and genres.
+    """
+
+    rand = np.random.RandomState(seed)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    words = np.array(["".join(rand.choice(letters, rand.randint(3, 10)))
+                      for _ in range(max(num_games // 3, 50))])
+
+    def names(size, most_words):
+        # Every word of every name in one draw, then split name by name
+        counts = rand.randint(1, most_words + 1, size=size)
+        drawn = words[rand.randint(len(words), size=counts.sum())].tolist()
+        ends = np.cumsum(counts).tolist()
+        return [" ".join(drawn[end - count:end]).title()
+                for count, end in zip(counts.tolist(), ends)]
+
+    sizes = {"users": 2 * num_games, "games": num_games,
+             "franchises": max(num_games // 10, 1),
+             "developers": max(num_games // 20, 1), "platforms": 50, "genres": 30}
+
+    rows = []
+    for category, size in sorted(sizes.items()):
+        if category == "users":
+            drawn = words[rand.randint(len(words), size=size)].tolist()
+            found = ["%s%d" % (word, entity_id)
+                     for entity_id, word in enumerate(drawn, 1)]
+        else:
+            found = names(size, 4 if category == "games" else 2)
+        rows.extend((category, entity_id, name)
+                    for entity_id, name in enumerate(found, 1))
+
+    return rows
+
+
+def search_queries(rows, num_queries=500, seed=0):
+    """Typical queries for rows: whole words, word prefixes and word pairs"""
+
+    rand = np.random.RandomState(seed)
+    names = [name.lower().split() for category, entity_id, name in rows
+             if category == "games"]
+
+    queries = []
+    for number in range(num_queries):
+        words = names[rand.randint(len(names))]
+        word = words[rand.randint(len(words))]
+        if number % 3 == 0:
+            queries.append(word)
+        elif number % 3 == 1:
+            queries.append(word[:rand.randint(3, len(word) + 1)])
+        else:
+            queries.append(" ".join(words[:2]))
+
+    return queries
+
+
+def benchmark_search_backend(name, backend, queries, limit=20, build_s=0.0):
+    """Times backend.search() for each query"""
+
+    latencies = []
+    found = 0
+
+    for query in queries:
+        start = time.time()
+        results = backend.search(query, limit + 1)
+        latencies.append(time.time() - start)
+        found += sum(len(rows) for rows in results.values())
+
+    result = {"engine": name, "queries": len(queries), "build_s": build_s,
+              "peak_memory_mb": peak_memory_mb(), "precision_at_k": None,
+              "recall_at_k": None, "mean_results": found / float(len(queries))}
+    result.update(latency_stats(latencies))
+
+    return result
+
+
+def compare_search(num_games=10000, num_queries=500, limit=20, db=False):
+    """Benchmarks the search backends on one generated catalog
+
+    The in-memory index always runs, in its own process (see
+    run_isolated()). With db the catalog is also inserted into the
+    configured database and TrigramSearch is timed before and after adding
+    its indexes; everything, indexes included, is rolled back.
+    """
+
+    from search import SearchIndex
+
+    rows = generate_catalog(num_games)
+    queries = search_queries(rows, num_queries)
+
+    def run_index():
+        before = peak_memory_mb()
+        start = time.time()
+        index = SearchIndex.from_rows(rows)
+        result = benchmark_search_backend("index", index, queries, limit,
+                                          time.time() - start)
+        result["memory_mb"] = result["peak_memory_mb"] - before
+        return result
+
+    results = [run_isolated(run_index)]
+
+    if db:
+        results.extend(benchmark_search_database(rows, queries, limit))
+
+    for result in results:
+        result.update({"num_games": num_games, "entries": len(rows)})
+
+    return results
+
+
+def benchmark_search_database(rows, queries, limit=20):
+    """Times TrigramSearch on rows loaded into the configured database
+
+    Needs the pg_trgm extension, which `python search.py --migrate` adds.
+    """
+
+    import search
+    from model import connect_to_db, db
+    from server import app # Imported here; server imports the engines
+
+    connect_to_db(app)
+
+    with app.app_context():
+        try:
+            _insert_catalog(rows)
+            db.session.execute("ANALYZE")
+
+            backend = search.TrigramSearch()
+            results = [benchmark_search_backend("trigram_noindex", backend,
+                                                queries, limit)]
+
+            start = time.time()
+            for index, table, column in search.trigram_indexes():
+                db.session.execute("CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)"
+                                   % (index, table, column))
+            db.session.execute("ANALYZE")
+            results.append(benchmark_search_backend("trigram", backend, queries,
+                                                    limit, time.time() - start))
+        finally:
+            db.session.rollback()
+
+    return results
+
+
+def _insert_catalog(rows):
+    """Adds generated rows to the searchable tables, after their current ids"""
+
+    import datetime
+    import search
+    from model import db
+
+    now = datetime.datetime.utcnow()
+
+    for category in search.CATEGORIES:
+        id_column, name_column = search.SEARCH_COLUMNS[category]
+        model = id_column.class_
+        first_id = (db.session.query(db.func.max(id_column)).scalar() or 0) + 1
+
+        mappings = []
+        for row_category, entity_id, name in rows:
+            if row_category != category:
+                continue
+
+            mapping = {id_column.key: first_id + entity_id, name_column.key: name}
+            if category == "users":
+                mapping.update({"email": "%s@bench.test" % name, "password": "x"})
+            elif category == "games":
+                mapping["release_date"] = now
+            mappings.append(mapping)
+
+        db.session.bulk_insert_mappings(model, mappings)
+
+
+def print_results(results):
+    """Prints one line per engine"""
+
+    def show(value, spec):
+        return "-" if value is None else spec % value
+
+    for result in results:
+        if "queries" in result:
+            count = "queries=%d" % result["queries"]
+        else:
+            count = "users=%d" % result["users"]
+
+        print ("%-10s %s p50=%sms p95=%sms p99=%sms peak=%.0fMB mem=%sMB "
+               "precision@k=%s recall@k=%s" % (
+                   result["engine"], count,
+                   show(result["p50_ms"], "%.2f"), show(result["p95_ms"], "%.2f"),
+                   show(result["p99_ms"], "%.2f"), result["peak_memory_mb"],
+                   show(result.get("memory_mb"), "+%.0f"),
+                   show(result["precision_at_k"], "%.3f"),
+                   show(result["recall_at_k"], "%.3f")))
+
+
+def write_json(results, path):
+    """Writes results to path as JSON, or to stdout if path is "-" """
+
+    def plain(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    results = [dict((key, plain(value)) for key, value in result.items())
+               for result in results]
+    output = json.dumps({"generated_at": time.time(), "results": results},
+                        indent=2, sort_keys=True)
+
+    if path == "-":
+        print output
+    else:
+        with open(path, "w") as file:
+            file.write(output + "\n")
+
+
+################################################################################
+# Run when called from main
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the recommenders")
+    parser.add_argument("num_users", type=int, nargs="?", default=2000)
+    parser.add_argument("num_games", type=int, nargs="?", default=1000)
+    parser.add_argument("reviews_per_user", type=int, nargs="?", default=50)
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--max-users", type=int, default=500,
+                        help="users timed per engine")
+    parser.add_argument("--db", action="store_true",
+                        help="time the SQL paths on the configured database")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also write results as JSON ('-' for stdout)")
+    parser.add_argument("--search", type=int, nargs="?", const=10000,
+                        metavar="GAMES",
+                        help="benchmark the search backends instead, on a "
+                             "generated catalog of GAMES games (with --db, "
+                             "also in the database)")
+    args = parser.parse_args()
+
+    if args.search:
+        results = compare_search(args.search, db=args.db)
+    elif args.db:
+        results = benchmark_database(args.k, args.max_users)
+    else:
+        results = compare_recommenders(args.num_users, args.num_games,
+                                       args.reviews_per_user, args.k,
+                                       args.max_users)
+
+    print_results(results)
+    if args.json:
+        write_json(results, args.json)
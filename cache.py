@@ -0,0 +1,233 @@
+"""In-process caches for expensive route results"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Size-bounded least-recently-used cache with a time to live
+
+    Entries expire ttl seconds after they are set; once max_size entries are
+    held, setting a new one evicts the least recently used. Hit, miss,
+    eviction and invalidation counts are kept for tuning, see stats().
+    """
+
+    def __init__(self, max_size=1000, ttl=300, timer=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        c = "<LRUCache size=%s max_size=%s ttl=%s>"
+        return c % (len(self._entries), self.max_size, self.ttl)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the live value for key, or default on a miss"""
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or entry[0] <= self.timer():
+                self.misses += 1
+                return default
+
+            # Reinsert to mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key, value):
+        """Stores value for key, evicting the least recently used if full"""
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.timer() + self.ttl, value)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops key if cached"""
+
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_all(self):
+        """Drops every entry, counting each as an invalidation"""
+
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def clear(self):
+        """Drops every entry and resets the counters"""
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        """Returns the counters as a dict for tuning"""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {"size": len(self._entries), "max_size": self.max_size,
+                    "ttl": self.ttl, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations}
+
+
+class RefreshingCache(object):
+    """Result cache that recomputes expired entries in the background
+
+    Stale-while-revalidate: an entry is fresh for ttl seconds. After that,
+    get() keeps returning the stale value and starts a single background
+    refresh, so only the first request for a key ever waits on compute.
+    Entries stale for longer than max_stale are recomputed inline.
+    invalidate() marks an entry stale rather than dropping it.
+    """
+
+    def __init__(self, ttl=60, max_stale=3600, background=True,
+                 timer=time.time):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.background = background
+        self.timer = timer
+
+        # key -> [expires, value, generation]
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        c = "<RefreshingCache size=%s ttl=%s max_stale=%s>"
+        return c % (len(self._entries), self.ttl, self.max_stale)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, compute):
+        """Returns the value for key, calling compute() to fill or refresh it"""
+
+        now = self.timer()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+
+            stale = entry and entry[0] + self.max_stale > now
+            if stale:
+                self.stale_hits += 1
+                refresh = key not in self._refreshing
+                if refresh:
+                    self._refreshing.add(key)
+                generation = entry[2]
+            else:
+                self.misses += 1
+                generation = entry[2] if entry else 0
+
+        if not stale:
+            value = compute()
+            self._store(key, value, generation)
+            return value
+
+        if refresh:
+            if self.background:
+                thread = threading.Thread(target=self._refresh,
+                                          args=(key, compute, generation))
+                thread.daemon = True
+                thread.start()
+            else:
+                self._refresh(key, compute, generation)
+
+        return entry[1]
+
+    def _refresh(self, key, compute, generation):
+        """Recomputes key, letting a later get() retry if compute() fails"""
+
+        try:
+            self._store(key, compute(), generation)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key, value, generation):
+        """Saves value computed as of generation
+
+        If key was invalidated while computing, the value is kept but left
+        stale so the next get() picks up the change.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            current = entry[2] if entry else 0
+
+            if current == generation:
+                expires = self.timer() + self.ttl
+            else:
+                expires = self.timer()
+
+            self._entries[key] = [expires, value, current]
+            self.refreshes += 1
+
+    def invalidate(self, key):
+        """Marks key stale so the next get() starts a refresh"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[0] = min(entry[0], self.timer())
+                entry[2] += 1
+                self.invalidations += 1
+
+    def clear(self):
+        """Drops every entry and resets the counters"""
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.stale_hits = self.misses = 0
+            self.refreshes = self.invalidations = 0
+
+    def stats(self):
+        """Returns the counters as a dict for tuning"""
+
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+
+            return {"size": len(self._entries), "ttl": self.ttl,
+                    "max_stale": self.max_stale, "hits": self.hits,
+                    "stale_hits": self.stale_hits, "misses": self.misses,
+                    "hit_rate": (float(self.hits + self.stale_hits) / lookups
+                                 if lookups else 0.0),
+                    "refreshes": self.refreshes,
+                    "invalidations": self.invalidations}
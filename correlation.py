@@ -2,6 +2,8 @@
 
 from math import sqrt
 
+import numpy as np
+
 
 def pearson(pairs):
     """Return Pearson correlation for pairs.
@@ -31,4 +33,27 @@ def pearson(pairs):
     if denominator == 0:
         return 0
 
-    return numerator / denominator
\ No newline at end of file
+    return numerator / denominator
+
+
+def pearson_sums(size, sum_1, sum_2, squares_1, squares_2, product_sum):
+    """Return Pearson correlations from running sums.
+    Vectorized form of pearson(): each argument is an array with one entry
+    per pair of series, and the result is an array of correlations.
+    """
+
+    size = np.asarray(size, dtype=float)
+    size[size == 0] = np.nan
+
+    numerator = product_sum - ((sum_1 * sum_2) / size)
+
+    variance = ((squares_1 - (sum_1 * sum_1) / size) *
+                (squares_2 - (sum_2 * sum_2) / size))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlations = numerator / np.sqrt(variance)
+
+    # Matches pearson() returning 0 when the denominator is 0
+    correlations[~(variance > 0)] = 0
+
+    return correlations
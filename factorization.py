@@ -0,0 +1,251 @@
+"""Matrix-factorization recommender trained with alternating least squares
+
+An alternative to the Pearson neighbor engine: scores are modelled as the
+global mean, plus a per-user and a per-game bias, plus the dot product of a
+user factor and a game factor vector. Factors are trained offline and saved
+to disk; at request time all games are scored for a user with one
+matrix-vector product. Train with:
+
+    $ python factorization.py [path]
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from model import Review, db
+from similarity import RatingMatrix
+
+
+class FactorModel(object):
+    """Latent user and game factors learned from review scores"""
+
+    def __init__(self, user_ids, game_ids, user_factors, game_factors, mean,
+                 user_biases, game_biases, game_counts, spread):
+        self.user_ids = np.asarray(user_ids)
+        self.game_ids = np.asarray(game_ids)
+        self.user_factors = np.asarray(user_factors)
+        self.game_factors = np.asarray(game_factors)
+        self.mean = float(mean)
+        self.user_biases = np.asarray(user_biases)
+        self.game_biases = np.asarray(game_biases)
+        self.game_counts = np.asarray(game_counts)
+        self.spread = float(spread)
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        f = "<FactorModel users=%s games=%s factors=%s>"
+        return f % (len(self.user_ids), len(self.game_ids),
+                    self.user_factors.shape[1])
+
+    @classmethod
+    def train(cls, matrix, factors=10, iterations=15, regularization=0.1,
+              bias_regularization=5.0, seed=0):
+        """Fits biases and factors to a RatingMatrix by alternating least squares
+
+        Each half-step first refits one side's biases against what the rest
+        of the model leaves unexplained, shrunk towards zero by
+        bias_regularization as if that many extra reviews scored the mean.
+        It then solves a small ridge regression per user (or game) for the
+        residual against the other side's fixed factors; regularization is
+        scaled by the number of reviews so heavy reviewers aren't over-shrunk.
+        """
+
+        rand = np.random.RandomState(seed)
+        mean = matrix.user_scores.mean() if len(matrix.user_scores) else 0.0
+
+        user_factors = rand.normal(scale=0.1, size=(len(matrix.user_ids), factors))
+        game_factors = rand.normal(scale=0.1, size=(len(matrix.game_ids), factors))
+        user_biases = np.zeros(len(matrix.user_ids))
+        game_biases = np.zeros(len(matrix.game_ids))
+
+        # The user row of each by-user score and the game column of each
+        # by-game score, to line scores up with their biases
+        user_rows = np.repeat(np.arange(len(matrix.user_ids)),
+                              np.diff(matrix.user_ptr))
+        game_cols = np.repeat(np.arange(len(matrix.game_ids)),
+                              np.diff(matrix.game_ptr))
+
+        for _ in range(iterations):
+            values = matrix.user_scores - mean - game_biases[matrix.user_games]
+            user_biases = _fit_biases(user_rows, values - _dots(
+                user_factors[user_rows], game_factors[matrix.user_games]),
+                len(user_biases), bias_regularization)
+            _solve(user_factors, game_factors, matrix.user_ptr,
+                   matrix.user_games, values - user_biases[user_rows],
+                   regularization)
+
+            values = matrix.game_scores - mean - user_biases[matrix.game_users]
+            game_biases = _fit_biases(game_cols, values - _dots(
+                game_factors[game_cols], user_factors[matrix.game_users]),
+                len(game_biases), bias_regularization)
+            _solve(game_factors, user_factors, matrix.game_ptr,
+                   matrix.game_users, values - game_biases[game_cols],
+                   regularization)
+
+        # How far training scores stray from the predictions; recommend_games()
+        # reads predictions within about this much of a threshold as a toss-up
+        errors = (matrix.user_scores - mean - user_biases[user_rows] -
+                  game_biases[matrix.user_games] - _dots(
+                      user_factors[user_rows], game_factors[matrix.user_games]))
+        spread = 1.0
+        if len(errors):
+            spread = max(np.sqrt(np.mean(np.square(errors))), spread)
+
+        return cls(matrix.user_ids, matrix.game_ids, user_factors,
+                   game_factors, mean, user_biases, game_biases,
+                   np.diff(matrix.game_ptr), spread)
+
+    def save(self, path):
+        """Writes the factor matrices to an .npz file at path"""
+
+        with open(path, "wb") as file:
+            np.savez(file, user_ids=self.user_ids, game_ids=self.game_ids,
+                     user_factors=self.user_factors,
+                     game_factors=self.game_factors, mean=self.mean,
+                     user_biases=self.user_biases,
+                     game_biases=self.game_biases,
+                     game_counts=self.game_counts, spread=self.spread)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a model written by save()"""
+
+        with np.load(path) as data:
+            return cls(data["user_ids"], data["game_ids"], data["user_factors"],
+                       data["game_factors"], data["mean"], data["user_biases"],
+                       data["game_biases"], data["game_counts"], data["spread"])
+
+    def scores(self, user_id):
+        """Predicted score of every game for user_id, or None if unknown"""
+
+        row = np.searchsorted(self.user_ids, user_id)
+        if row >= len(self.user_ids) or self.user_ids[row] != user_id:
+            return None
+
+        return (self.mean + self.user_biases[row] + self.game_biases +
+                self.game_factors.dot(self.user_factors[row]))
+
+    def expected_likes(self, user_id, liked=80):
+        """Chance that user_id reviews each game and scores it at least liked
+
+        Whether a user reviews a game at all is estimated from how often it
+        has been reviewed; whether they like it, from a logistic curve of the
+        predicted score around liked, as wide as the model's training error.
+        Returns None if user_id is unknown.
+        """
+
+        scores = self.scores(user_id)
+        if scores is None:
+            return None
+
+        likes = 1 / (1 + np.exp((liked - scores) / self.spread))
+
+        return self.game_counts / float(max(self.game_counts.sum(), 1)) * likes
+
+    def recommend_games(self, user_id, limit=20, reviewed=(), liked=80):
+        """Game ids user_id is most likely to review and like, best first
+
+        Ranked by expected_likes(); a predicted score alone favors rarely
+        reviewed games the user would probably never pick up. Games in
+        reviewed are skipped.
+        """
+
+        scores = self.expected_likes(user_id, liked)
+        if scores is None:
+            return []
+
+        skip = np.in1d(self.game_ids, list(reviewed))
+        scores[skip] = -np.inf
+
+        size = min(limit, len(scores) - skip.sum())
+        if size <= 0:
+            return []
+
+        best = np.argpartition(-scores, size - 1)[:size]
+        best = best[np.argsort(-scores[best], kind="mergesort")]
+
+        return self.game_ids[best].tolist()
+
+
+def _dots(left, right):
+    """Row-wise dot products of two equally shaped matrices"""
+
+    return np.einsum("ij,ij->i", left, right)
+
+
+def _fit_biases(owners, values, size, regularization):
+    """Regularized mean of values per owner index, 0 for owners without any"""
+
+    totals = np.bincount(owners, weights=values, minlength=size)
+    counts = np.bincount(owners, minlength=size)
+
+    return totals / (counts + regularization)
+
+
+def _solve(target, fixed, ptr, index, values, regularization):
+    """One ALS half-step: refits each row of target with fixed held still"""
+
+    eye = np.eye(fixed.shape[1])
+
+    for row in range(len(target)):
+        start, end = ptr[row], ptr[row + 1]
+        if start == end:
+            continue
+
+        other = fixed[index[start:end]]
+        target[row] = np.linalg.solve(
+            other.T.dot(other) + regularization * (end - start) * eye,
+            other.T.dot(values[start:end]))
+
+
+# Models loaded by load_cached(), keyed by path
+_loaded = {}
+
+
+def load_cached(path):
+    """Returns the model saved at path, rereading it only when the file changes
+
+    Returns None if nothing has been trained at path yet.
+    """
+
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    cached = _loaded.get(path)
+    if not cached or cached[0] != modified:
+        cached = (modified, FactorModel.load(path))
+        _loaded[path] = cached
+
+    return cached[1]
+
+
+def train_from_db(path, **options):
+    """Trains a model from the reviews table and saves it to path"""
+
+    print "Factors"
+
+    rows = db.session.query(Review.user_id, Review.game_id, Review.score).all()
+    model = FactorModel.train(RatingMatrix.from_rows(rows), **options)
+    model.save(path)
+
+    return model
+
+
+################################################################################
+# Run when called from main
+
+if __name__ == "__main__":
+    from model import connect_to_db
+    from server import app # Imported here; server imports this module
+
+    connect_to_db(app)
+
+    if len(sys.argv) > 1:
+        train_from_db(sys.argv[1])
+    else:
+        train_from_db(app.config["FACTORS_PATH"])
@@ -1,91 +1,1220 @@
 """Helper functions for server routes"""
 
-from flask import session
+from flask import session, request, current_app, has_app_context, abort
 from flask_sqlalchemy import sqlalchemy
 from sqlalchemy.sql import func
+from sqlalchemy.dialects.postgresql import insert
+import os
+import time
+import calendar
+from math import ceil
+from datetime import datetime, timedelta
+from collections import namedtuple, OrderedDict
 
+import factorization
+import search
+from cache import LRUCache, RefreshingCache
+from leaderboard import Leaderboard
+from trending import TrendingGames
 from model import (User, Game, Review, CriticReview, Platform, Developer,
-                   Genre, Franchise, CurrentGame, db)
+                   Genre, Franchise, CurrentGame, GameStats, Cover,
+                   GameCohortStats, Recommendation, CohortPopularGame,
+                   UserSimilarity, GameGenre, GameDeveloper, GamePlatform, db)
 
 
 ################################################################################
 # @app.route("/") helpers
 
-def assign_avg_score(lst, recent=False):
-    """Gets the avg score from the query and binds it to the game object"""
+# Lightweight game rows for the homepage carousels
+GameCard = namedtuple("GameCard", "game_id name cover_url avg_score")
+RankedGame = namedtuple("RankedGame", "game_id avg_score")
+TrendingCard = namedtuple("TrendingCard",
+                          "game_id name cover_url avg_score trend activity")
+
+
+def get_game_cards(game_ids):
+    """Loads a GameCard for each of game_ids in one query, keyed by game_id
+
+    avg_score is the players' average from game_stats, or None.
+    """
+
+    game_ids = set(game_ids)
+    if not game_ids:
+        return {}
+
+    rows = (db.session.query(Game.game_id, Game.name,
+                             first_cover_url().label("cover_url"),
+                             GameStats.avg_score)
+                      .outerjoin(GameStats, GameStats.game_id == Game.game_id)
+                      .filter(Game.game_id.in_(game_ids)).all())
+
+    return {row.game_id: GameCard(*row) for row in rows}
+
+
+def assign_avg_score(lst, cards, recent=False):
+    """Binds each row's game_id to its card from get_game_cards()
+
+    The card keeps the row's avg_score; recent rows (which have none) keep
+    the players' average from game_stats.
+    """
 
     results = []
 
     for review in lst:
-        game_id = review.game_id
-        game = Game.query.filter_by(game_id=game_id).first()
+        card = cards.get(review.game_id)
+        if not card:
+            continue
+
         if not recent:
-            game.avg_score = float(review.avg_score)
-        else:        
-            avg_score = (db.session.query(func.avg(Review.score)).filter(
-                         Review.game_id==game_id).first())
-            game.avg_score = float(avg_score[0])
+            card = card._replace(avg_score=float(review.avg_score))
+        else:
+            card = card._replace(avg_score=float(card.avg_score or 0))
 
-        results.append(game)
+        results.append(card)
 
     return results
 
 
+# The homepage lists shared by every visitor, by name; see get_homepage_list()
+homepage_cache = RefreshingCache(ttl=60, max_stale=3600)
+
+
+def get_homepage_list(name):
+    """Gets one of the shared homepage lists through homepage_cache
+
+    Expired lists are rebuilt on a background thread, which needs an app
+    context (and so a database session) of its own.
+    """
+
+    app = current_app._get_current_object()
+    build = homepage_builders[name]
+
+    def compute():
+        if has_app_context():
+            return build()
+        with app.app_context():
+            return build()
+
+    return homepage_cache.get(name, compute)
+
+
+def invalidate_homepage_lists():
+    """Marks the lists a review write changes as stale"""
+
+    homepage_cache.invalidate("user_list")
+    homepage_cache.invalidate("recent_list")
+    homepage_cache.invalidate("trending_list")
+
+
+def build_user_list():
+    """Games with the best player averages"""
+
+    ranked = [RankedGame(*pair) for pair in get_leaderboard("players").top(20)]
+
+    return assign_avg_score(ranked, get_game_cards(
+                            row.game_id for row in ranked))
+
+
+def build_critic_list():
+    """Games with the best critic averages"""
+
+    ranked = [RankedGame(*pair) for pair in get_leaderboard("critics").top(20)]
+
+    return assign_avg_score(ranked, get_game_cards(
+                            row.game_id for row in ranked))
+
+
+def build_recent_list():
+    """Most recently reviewed games with their player averages"""
+
+    recent_reviews = (db.session.query(Review.game_id)
+                      .order_by(Review.review_time.desc()).limit(20).all())
+
+    return assign_avg_score(recent_reviews, get_game_cards(
+                            row.game_id for row in recent_reviews), recent=True)
+
+
+def build_soon_list():
+    """Upcoming games, soonest first"""
+
+    return (db.session.query(Game.game_id, Game.name, Game.release_date,
+            first_cover_url().label("cover_url"))
+            .filter(Game.release_date > datetime.now())
+            .order_by(Game.release_date).limit(20).all())
+
+
+def build_trending_list():
+    """Games with the most decayed review activity, as TrendingCards
+
+    avg_score is the decayed average, so it reflects recent reviews.
+    """
+
+    trending = get_trending().top(20)
+    cards = get_game_cards(game_id for game_id, trend, activity, avg in trending)
+
+    return [TrendingCard(game_id, cards[game_id].name, cards[game_id].cover_url,
+                         avg_score, trend, activity)
+            for game_id, trend, activity, avg_score in trending
+            if game_id in cards]
+
+
+homepage_builders = {"user_list": build_user_list,
+                     "critic_list": build_critic_list,
+                     "recent_list": build_recent_list,
+                     "soon_list": build_soon_list,
+                     "trending_list": build_trending_list}
+
+
+# This process's leaderboards by name as (loaded_at, Leaderboard), see
+# get_leaderboard()
+_leaderboards = {}
+
+
+def leaderboard_column(name):
+    """The game_stats average a leaderboard ranks by"""
+
+    return {"players": GameStats.avg_score, "critics": GameStats.critic_avg}[name]
+
+
+def get_leaderboard(name):
+    """Returns the "players" or "critics" Leaderboard, loading it on first use
+
+    Review writes in this process update the players board as they happen;
+    both are reloaded from game_stats once LEADERBOARD_MAX_AGE seconds old
+    to pick up writes handled by other processes.
+    """
+
+    loaded = _leaderboards.get(name)
+
+    if (not loaded or
+            time.time() - loaded[0] > current_app.config["LEADERBOARD_MAX_AGE"]):
+        column = leaderboard_column(name)
+        rows = (db.session.query(GameStats.game_id, column)
+                          .filter(column != None).all())
+        loaded = (time.time(), Leaderboard.from_rows(rows))
+        _leaderboards[name] = loaded
+
+    return loaded[1]
+
+
+def check_leaderboards(limit=20):
+    """Compares each loaded leaderboard's top games with game_stats in SQL
+
+    Returns {name: (in memory, in SQL)} for the boards that disagree.
+    """
+
+    mismatched = {}
+
+    for name, (loaded_at, leaderboard) in _leaderboards.items():
+        column = leaderboard_column(name)
+        expected = (db.session.query(GameStats.game_id, column)
+                              .filter(column != None)
+                              .order_by(column.desc(), GameStats.game_id)
+                              .limit(limit).all())
+        expected = [(game_id, round(score, 6)) for game_id, score in expected]
+        actual = [(game_id, round(score, 6))
+                  for game_id, score in leaderboard.top(limit)]
+
+        if actual != expected:
+            mismatched[name] = (actual, expected)
+
+    return mismatched
+
+
+# This process's trending ranking as {"index": TrendingGames, "built": time},
+# see get_trending()
+_trending = {}
+
+
+def get_trending():
+    """Returns the TrendingGames for this process, building it on first use
+
+    Reviews older than eight half-lives add under half a percent each, so
+    only newer ones are replayed. Review writes in this process are added
+    as they happen; it is rebuilt once TRENDING_MAX_AGE seconds old to pick
+    up writes handled by other processes.
+    """
+
+    config = current_app.config
+
+    if (not _trending or
+            time.time() - _trending["built"] > config["TRENDING_MAX_AGE"]):
+        half_life = config["TRENDING_HALF_LIFE"]
+        since = datetime.utcnow() - timedelta(seconds=8 * half_life)
+        rows = (db.session.query(Review.game_id, Review.score, Review.review_time)
+                          .filter(Review.review_time > since)
+                          .order_by(Review.review_time).all())
+
+        _trending["index"] = TrendingGames.from_rows(
+            [(game_id, score, review_timestamp(review_time))
+             for game_id, score, review_time in rows], half_life=half_life)
+        _trending["built"] = time.time()
+
+    return _trending["index"]
+
+
+def review_timestamp(review_time):
+    """Unix time of a review_time (stored as naive UTC), or now for None"""
+
+    if review_time is None:
+        return time.time()
+
+    return calendar.timegm(review_time.utctimetuple())
+
+
+# Recommended lists by user_id, dropped by invalidate_recommendations()
+recommendation_cache = LRUCache(max_size=10000, ttl=600)
+
+
 def get_recommended_list(user_id):
-    """Gets the best user matches for current user; builds unique rec. list"""
-
-    user = User.query.filter_by(user_id=session["user_id"]).first()
-    user_reviewed = {}
-    for review in user.reviews:
-        user_reviewed[review.game_id] = review
-    best_users = user.recommend()
-    print best_users
-    recommended_list = []
-    if best_users:
-        for other_user in best_users:
-            top_four = (Review.query.filter_by(user_id=other_user).order_by(
-                        Review.score.desc()).limit(4).all())
-            recommended_list.extend(top_four)
-    else:
-        # Ignored in test due to small sample size
-        recommended_list = None # pragma: no cover
+    """Gets the recommended games for a user, from recommendation_cache if fresh"""
 
-    print recommended_list
-    # Remove duplicates
-    if recommended_list:
-        recommended_list = list(set(recommended_list))
-        final_list = []
-        for game in recommended_list:
-            if game.game_id not in user_reviewed:
-                # Ignored in test due to small sample size
-                final_list.append(game) # pragma: no cover
-        recommended_list = final_list
+    recommended_list = recommendation_cache.get(user_id)
 
+    if recommended_list is None:
+        recommended_list = load_recommended_list(user_id)
+        recommendation_cache.set(user_id, recommended_list)
 
     return recommended_list
 
+
+def invalidate_recommendations(user_ids, stored=False):
+    """Drops cached recommendations for user_ids after their inputs changed
+
+    With stored=True the lists precompute.py stored are deleted too, along
+    with the users' recommended_at, so the next view builds a fresh one; the
+    deletion is left on the session for the route to commit. Lists can also
+    go stale when another user changes their profile; the cache's ttl
+    bounds how long that lasts.
+    """
+
+    for user_id in user_ids:
+        recommendation_cache.invalidate(int(user_id))
+
+    if stored and user_ids:
+        (Recommendation.query.filter(Recommendation.user_id.in_(user_ids))
+                             .delete(synchronize_session=False))
+        (User.query.filter(User.user_id.in_(user_ids))
+                   .update({User.recommended_at: None}, synchronize_session=False))
+
+
+def load_recommended_list(user_id):
+    """Gets the recommended games for a user as (game_id, name, cover_url) rows
+
+    Users with fewer than COLD_START_REVIEWS reviews get their cohort's
+    popular games, as does anyone the engines find nothing for. Otherwise
+    reads the list precompute.py stored for the user in one indexed lookup;
+    only users the batch job hasn't covered (recommended_at unset) get a
+    list built on the spot, so an empty stored list isn't recomputed on
+    every view. Deployments with RECOMMENDER set to "factors" use
+    get_factor_list().
+    """
+
+    cohort, num_reviews, recommended_at = (
+        db.session.query(User.cohort, User.num_reviews, User.recommended_at)
+                  .filter(User.user_id == user_id).first())
+
+    if num_reviews < current_app.config["COLD_START_REVIEWS"]:
+        popular_list = get_popular_list(user_id, cohort)
+        if popular_list:
+            return popular_list
+
+    if current_app.config.get("RECOMMENDER") == "factors":
+        recommended_list = get_factor_list(user_id)
+    else:
+        recommended_list = (db.session.query(Game.game_id, Game.name,
+                                              first_cover_url().label("cover_url"))
+                                       .join(Recommendation,
+                                             Recommendation.game_id == Game.game_id)
+                                       .filter(Recommendation.user_id == user_id)
+                                       .order_by(Recommendation.rank).all())
+
+        if not recommended_list and recommended_at is None:
+            user = User.query.filter_by(user_id=user_id).first()
+            recommended_list = recommend_games(user)
+
+    return recommended_list or get_popular_list(user_id, cohort)
+
+
+def get_popular_list(user_id, cohort, limit=20):
+    """Gets cold-start (game_id, name, cover_url) rows from precompute.py's lists
+
+    The cohort's most reviewed games come first, topped up from the
+    site-wide list; games the user already reviewed are skipped.
+    """
+
+    reviewed = db.session.query(Review.game_id).filter(Review.user_id == user_id)
+
+    rows = (db.session.query(Game.game_id, Game.name,
+                             first_cover_url().label("cover_url"))
+                      .join(CohortPopularGame,
+                            CohortPopularGame.game_id == Game.game_id)
+                      .filter(CohortPopularGame.cohort.in_([cohort or "all", "all"]),
+                              ~CohortPopularGame.game_id.in_(reviewed))
+                      .order_by(CohortPopularGame.cohort == "all",
+                                CohortPopularGame.rank).all())
+
+    popular_list = []
+    seen = set()
+    for row in rows:
+        if row.game_id not in seen:
+            seen.add(row.game_id)
+            popular_list.append(row)
+
+    return popular_list[:limit]
+
+
+def get_factor_list(user_id, limit=20):
+    """Gets recommended (game_id, name, cover_url) rows from the factor model"""
+
+    model = factorization.load_cached(current_app.config["FACTORS_PATH"])
+    if not model:
+        return []
+
+    reviewed = [game_id for game_id, in
+                db.session.query(Review.game_id).filter_by(user_id=user_id)]
+
+    return get_game_rows(model.recommend_games(user_id, limit, reviewed))
+
+
+def recommend_games(user, per_user=4):
+    """Gets the best user matches for user; builds unique rec. list of games
+
+    One windowed query takes the top per_user games of each similar user,
+    skipping games user already reviewed, and merges them by game weighted
+    by similarity: each recommending neighbor adds (1 + correlation) * score.
+    Returns (game_id, name, cover_url, weight) rows, best first.
+    """
+
+    similarities = user.similar_users(5)
+    if not similarities:
+        return []
+
+    reviewed = db.session.query(Review.game_id).filter(Review.user_id == user.user_id)
+
+    ranked = (db.session.query(Review.user_id, Review.game_id, Review.score,
+                               func.row_number().over(
+                                   partition_by=Review.user_id,
+                                   order_by=(Review.score.desc(), Review.game_id))
+                               .label("position"))
+                        .filter(Review.user_id.in_([other_id for other_id, correlation
+                                                    in similarities]),
+                                ~Review.game_id.in_(reviewed))
+                        .subquery())
+
+    correlation = sqlalchemy.case(dict(similarities), value=ranked.c.user_id)
+    weight = func.sum((1 + correlation) * ranked.c.score).label("weight")
+
+    return (db.session.query(Game.game_id, Game.name,
+                             first_cover_url().label("cover_url"), weight)
+                      .join(ranked, ranked.c.game_id == Game.game_id)
+                      .filter(ranked.c.position <= per_user)
+                      .group_by(Game.game_id, Game.name)
+                      .order_by(weight.desc(), Game.game_id).all())
+
+
+def first_cover_url():
+    """Correlated subquery for the url of a game's first cover"""
+
+    return (db.session.query(Cover.url).filter(Cover.game_id == Game.game_id)
+                      .order_by(Cover.cover_id).limit(1).correlate(Game)
+                      .as_scalar())
+
+
+def get_game_rows(game_ids):
+    """Gets (game_id, name, cover_url) rows for game_ids, in the same order"""
+
+    if not game_ids:
+        return []
+
+    rows = (db.session.query(Game.game_id, Game.name,
+                             first_cover_url().label("cover_url"))
+                      .filter(Game.game_id.in_(game_ids)).all())
+    by_id = {row.game_id: row for row in rows}
+
+    return [by_id[game_id] for game_id in game_ids if game_id in by_id]
+
+################################################################################
+
+################################################################################
+# @app.route("/review/<game_id>") and @app.route("/publish_review") helpers
+
+def record_review_score(user_id, game_id, old_score, new_score, old_time=None,
+                        review_time=None):
+    """Updates everything derived from review scores after a review write
+
+    old_score is None for a new review. An edited review passes the
+    review_time it had (old_time) and now has; either defaults to now.
+    Database changes are left on the session for the route to commit with
+    the review.
+    """
+
+    user_id = int(user_id)
+    game_id = int(game_id)
+
+    # Locks the game's stats row until commit, which orders concurrent
+    # reviews of the game before they look for each other's scores
+    stats = update_game_stats(game_id, old_score, new_score)
+    update_similarity_index(user_id, game_id, old_score, new_score)
+    update_game_cohort_stats(game_id, user_id, old_score, new_score)
+
+    if old_score is None:
+        (User.query.filter(User.user_id == user_id)
+                   .update({User.num_reviews: User.num_reviews + 1},
+                           synchronize_session=False))
+
+    if _leaderboards.get("players"):
+        _leaderboards["players"][1].update(game_id, stats.avg_score)
+
+    # An edit moves the review's event, as a rebuild from reviews would see it
+    if _trending.get("index"):
+        if old_score is not None:
+            _trending["index"].remove_review(game_id, old_score,
+                                             review_timestamp(old_time))
+        _trending["index"].add_review(game_id, new_score,
+                                      review_timestamp(review_time))
+
+    # The reviewer's list is rebuilt; anyone sharing a game with them may
+    # have them as a neighbor, so their cached lists are dropped too
+    neighbors = (db.session.query(UserSimilarity.other_id)
+                           .filter(UserSimilarity.user_id == user_id))
+    invalidate_recommendations([user_id], stored=True)
+    invalidate_recommendations([other_id for other_id, in neighbors])
+    invalidate_homepage_lists()
+
+
+def update_game_stats(game_id, old_score, new_score):
+    """Folds one review write into the game's game_stats row
+
+    A single INSERT ... ON CONFLICT DO UPDATE adds the change to the stored
+    sums, so the first reviews of a game can't race to create its row and
+    concurrent reviews can't lose each other's counts. The row stays locked
+    until the route commits. Returns the row's (game_id, avg_score).
+    """
+
+    table = GameStats.__table__
+    added = 1 if old_score is None else 0
+    change = new_score - (old_score or 0)
+    updated_at = datetime.utcnow()
+
+    upsert = insert(table).values(
+        game_id=game_id, num_reviews=added, score_sum=change,
+        avg_score=float(change) / added if added else None, num_critics=0,
+        critic_sum=0, updated_at=updated_at)
+
+    num_reviews = table.c.num_reviews + added
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[table.c.game_id],
+        set_={"num_reviews": num_reviews,
+              "score_sum": table.c.score_sum + change,
+              "avg_score": (sqlalchemy.cast(table.c.score_sum + change, db.Float) /
+                            func.nullif(num_reviews, 0)),
+              "updated_at": updated_at})
+
+    return db.session.execute(
+        upsert.returning(table.c.game_id, table.c.avg_score)).first()
+
+
+def update_game_cohort_stats(game_id, user_id, old_score, new_score):
+    """Folds one review write into the game's histogram row for the reviewer
+
+    Reviewers without a cohort aren't charted. Left on the session for the
+    route to commit.
+    """
+
+    cohort = db.session.query(User.cohort).filter(User.user_id == user_id).scalar()
+    if cohort:
+        add_cohort_score(game_id, cohort, new_score, old_score)
+
+
+def add_cohort_score(game_id, cohort, score, old_score=None, sign=1):
+    """Adds (or with sign=-1 removes) a score in a GameCohortStats row
+
+    old_score is set when an existing review's score changes. The row is
+    locked until the route commits.
+    """
+
+    stats = (GameCohortStats.query.filter_by(game_id=game_id, cohort=cohort)
+                                  .with_for_update().first())
+    if not stats:
+        stats = GameCohortStats(game_id=game_id, cohort=cohort, num_reviews=0,
+                                score_sum=0)
+        db.session.add(stats)
+
+    if old_score is None:
+        stats.num_reviews += sign
+        stats.score_sum += sign * score
+    else:
+        stats.score_sum += score - old_score
+
+
+def update_similarity_index(user_id, game_id, old_score, new_score):
+    """Folds one review write into the similarity sums of each affected pair
+
+    Only pairs between user_id and the other reviewers of game_id change, so
+    the cost is O(co-reviewers). old_score is None for a new review. Each
+    pair's change is upserted onto its stored sums, so concurrent writes add
+    up rather than duplicating or overwriting a pair; record_review_score()
+    locks the game's stats row first, so two new reviews of one game see
+    each other. Changes are left on the session for the route to commit.
+    """
+
+    user_id = int(user_id)
+
+    co_reviews = (db.session.query(Review.user_id, Review.score, User.cohort)
+                  .join(User, User.user_id == Review.user_id)
+                  .filter(Review.game_id == game_id, Review.user_id != user_id)
+                  .all())
+    if not co_reviews:
+        return
+
+    cohort = db.session.query(User.cohort).filter(User.user_id == user_id).scalar()
+
+    changes = []
+    for other_id, other_score, other_cohort in co_reviews:
+        old_pair = old_score is not None and (old_score, other_score) or None
+        forward = UserSimilarity.sum_changes((new_score, other_score), old_pair)
+        forward.update(user_id=user_id, other_id=other_id,
+                       other_cohort=other_cohort, correlation=0)
+
+        old_pair = old_score is not None and (other_score, old_score) or None
+        backward = UserSimilarity.sum_changes((other_score, new_score), old_pair)
+        backward.update(user_id=other_id, other_id=user_id,
+                        other_cohort=cohort, correlation=0)
+
+        changes.extend([forward, backward])
+
+    table = UserSimilarity.__table__
+    sums = [table.c[column] for column in UserSimilarity.sum_columns]
+
+    upsert = insert(table).values(changes)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.other_id],
+        set_={column.name: column + upsert.excluded[column.name]
+              for column in sums})
+    pairs = db.session.execute(
+        upsert.returning(table.c.user_id, table.c.other_id, *sums)).fetchall()
+
+    # The upsert keeps the pairs locked, so their sums can't move before
+    # the correlations computed from them are stored
+    db.session.execute(
+        table.update().where(db.and_(
+            table.c.user_id == sqlalchemy.bindparam("pair_user_id"),
+            table.c.other_id == sqlalchemy.bindparam("pair_other_id")))
+        .values(correlation=sqlalchemy.bindparam("pair_correlation")),
+        [{"pair_user_id": pair.user_id, "pair_other_id": pair.other_id,
+          "pair_correlation": value}
+         for pair, value in zip(pairs, UserSimilarity.correlations(pairs))])
+
+################################################################################
+
+################################################################################
+# @app.route("/create_profile") helpers
+
+def update_user_cohort(user, old_cohort=None):
+    """Copies user's new cohort onto the rows keyed by it
+
+    Called after age or gender change: one indexed update over the user's
+    neighbors in the similarity index, and their reviews are moved from
+    old_cohort's game histograms to the new cohort's. Left on the session
+    for the route to commit.
+    """
+
+    (UserSimilarity.query.filter(UserSimilarity.other_id == user.user_id)
+                         .update({"other_cohort": user.cohort},
+                                 synchronize_session=False))
+
+    if old_cohort != user.cohort:
+        reviews = (db.session.query(Review.game_id, Review.score)
+                             .filter(Review.user_id == user.user_id))
+        game_ids = []
+        for game_id, score in reviews:
+            if old_cohort:
+                add_cohort_score(game_id, old_cohort, score, sign=-1)
+            if user.cohort:
+                add_cohort_score(game_id, user.cohort, score)
+            game_ids.append(game_id)
+
+        # Their breakdown charts changed
+        if game_ids:
+            (GameStats.query.filter(GameStats.game_id.in_(game_ids))
+                            .update({"updated_at": datetime.utcnow()},
+                                    synchronize_session=False))
+
+    invalidate_recommendations([user.user_id], stored=True)
+
+################################################################################
+
+################################################################################
+# @app.route("/search") helpers
+
+# This process's search index as {"index": SearchIndex, "built": time}, see
+# get_search_index()
+_search_index = {}
+
+# Resolved /search pages, see get_search_results()
+search_cache = LRUCache(max_size=1000, ttl=300)
+
+# Modification time of the SEARCH_INDEX_PATH snapshot when last checked, see
+# check_search_snapshot()
+_search_snapshot = {}
+
+
+def get_search_index():
+    """Returns the SearchIndex for this process, loading it on first use
+
+    A snapshot at SEARCH_INDEX_PATH younger than SEARCH_MAX_AGE is read
+    instead of querying the searchable tables. Signups in this process are
+    added as they happen; it is rebuilt from the database once
+    SEARCH_MAX_AGE seconds old to pick up changes made elsewhere.
+    """
+
+    config = current_app.config
+    max_age = config["SEARCH_MAX_AGE"]
+
+    if not _search_index or time.time() - _search_index["built"] > max_age:
+        path = config["SEARCH_INDEX_PATH"]
+        if (not _search_index and path and os.path.exists(path) and
+                time.time() - os.path.getmtime(path) <= max_age):
+            _search_index["index"] = search.SearchIndex.load(path)
+            _search_index["built"] = os.path.getmtime(path)
+        else:
+            _search_index["index"] = search.build_from_db()
+            _search_index["built"] = time.time()
+
+        search_cache.invalidate_all()
+
+    return _search_index["index"]
+
+
+def check_search_snapshot():
+    """Notices a reseeded catalog by its search snapshot changing
+
+    Reseeding ends with `python search.py` rewriting SEARCH_INDEX_PATH
+    (see seed.py), which is how other processes hear about it. When the
+    snapshot's modification time moves, cached results and the loaded
+    indexes are dropped. Costs one stat() per search or browse page.
+    """
+
+    path = current_app.config["SEARCH_INDEX_PATH"]
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        modified = None
+
+    if _search_snapshot.get("modified", modified) != modified:
+        invalidate_catalog()
+    _search_snapshot["modified"] = modified
+
+
+def invalidate_catalog():
+    """Drops cached search results, search indexes and browse page counts
+    after the catalog changed
+    """
+
+    search_cache.invalidate_all()
+    browse_count_cache.invalidate_all()
+    _search_index.clear()
+    _suggest_index.clear()
+
+
+def index_new_user(user):
+    """Adds a user who just signed up to this process's loaded search index"""
+
+    if _search_index.get("index"):
+        _search_index["index"].add("users", user.user_id, user.username)
+
+    search_cache.invalidate_all()
+
+
+# This process's typeahead index as {"index": PrefixIndex, "built": time},
+# see get_suggest_index()
+_suggest_index = {}
+
+# Page for each suggestion category
+SUGGEST_URLS = {"games": "/games/%s", "franchises": "/franchises/%s",
+                "developers": "/developers/%s", "platforms": "/platforms/%s"}
+
+
+def get_suggest_index():
+    """Returns the PrefixIndex for this process, building it on first use
+
+    Rebuilt from the database once SUGGEST_MAX_AGE seconds old, which also
+    refreshes the review counts suggestions are weighted by.
+    """
+
+    config = current_app.config
+
+    if (not _suggest_index or
+            time.time() - _suggest_index["built"] > config["SUGGEST_MAX_AGE"]):
+        _suggest_index["index"] = search.PrefixIndex(
+            search.suggest_rows(), max_limit=config["SUGGEST_MAX_LIMIT"])
+        _suggest_index["built"] = time.time()
+
+    return _suggest_index["index"]
+
+
+def get_suggestions(prefix, limit):
+    """Gets up to limit typeahead suggestions for prefix as dicts"""
+
+    return [{"category": category, "id": entity_id, "name": name,
+             "url": SUGGEST_URLS[category] % entity_id}
+            for category, entity_id, name
+            in get_suggest_index().suggest(prefix, limit)]
+
+
+# Backend for SEARCH_BACKEND = "trigram"; it keeps no state
+trigram_search = search.TrigramSearch()
+
+
+def get_search_backend():
+    """The backend chosen by SEARCH_BACKEND: the in-memory "index" or
+    PostgreSQL "trigram" queries
+    """
+
+    if current_app.config["SEARCH_BACKEND"] == "trigram":
+        return trigram_search
+
+    return get_search_index()
+
+
+# Lightweight /search rows; groups are genres, franchises, developers and
+# platforms, with the names of their first SEARCH_GROUP_GAMES games and how
+# many they have in all
+SearchGame = namedtuple("SearchGame", "game_id name summary")
+SearchGroup = namedtuple("SearchGroup", "entity_id name games num_games")
+
+SEARCH_GROUP_GAMES = 5
+
+# Column linking each group category's ids to game_ids
+SEARCH_GROUP_LINKS = {"genres": GameGenre.genre_id,
+                      "franchises": Game.franchise_id,
+                      "developers": GameDeveloper.developer_id,
+                      "platforms": GamePlatform.platform_id}
+
+
+def get_search_results(query, limit=20, page=1, categories=search.CATEGORIES):
+    """Gets a page of the best matches for query in each of categories
+
+    Returns (results, more): at most limit matches per category, best first,
+    and whether each category has another page. Users are (username,
+    user_id) pairs, games SearchGames and the rest SearchGroups; categories
+    not searched are empty. Pages are kept in search_cache by normalized
+    query, so popular searches skip the backend and database entirely.
+    """
+
+    check_search_snapshot()
+
+    key = (current_app.config["SEARCH_BACKEND"], search.normalize(query),
+           tuple(categories), page, limit)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+
+    found = get_search_backend().search(query, limit + 1, categories,
+                                        (page - 1) * limit)
+
+    more = {}
+    for category in search.CATEGORIES:
+        rows = found.get(category, [])
+        more[category] = len(rows) > limit
+        found[category] = rows[:limit]
+
+    results = {"users": [(name, user_id) for user_id, name in found["users"]],
+               "games": get_search_games(found["games"])}
+
+    for category, link in SEARCH_GROUP_LINKS.items():
+        results[category] = get_search_groups(found[category], link)
+
+    search_cache.set(key, (results, more))
+
+    return results, more
+
+
+def get_search_games(found):
+    """SearchGames for (game_id, name) results, in order, with one query"""
+
+    if not found:
+        return []
+
+    summaries = dict(db.session.query(Game.game_id, Game.summary)
+                               .filter(Game.game_id.in_([game_id for game_id, name
+                                                         in found])))
+
+    return [SearchGame(game_id, name, summaries.get(game_id))
+            for game_id, name in found]
+
+
+def get_search_groups(found, link):
+    """SearchGroups for (id, name) results, in order, with one query
+
+    link is the column of SEARCH_GROUP_LINKS holding the group's id. Only
+    the first SEARCH_GROUP_GAMES game names of each group are read, ranked
+    and counted by window functions, so a group as big as a platform costs
+    the same as a small one; its browse page lists the rest.
+    """
+
+    if not found:
+        return []
+
+    ranked = db.session.query(link.label("entity_id"), Game.name.label("name"),
+                              func.row_number().over(partition_by=link,
+                                                     order_by=Game.name)
+                              .label("position"),
+                              func.count().over(partition_by=link)
+                              .label("num_games"))
+    if link.class_ is not Game:
+        ranked = ranked.join(Game, Game.game_id == link.class_.game_id)
+    ranked = (ranked.filter(link.in_([entity_id for entity_id, name in found]))
+                    .subquery())
+
+    rows = (db.session.query(ranked.c.entity_id, ranked.c.name,
+                             ranked.c.num_games)
+                      .filter(ranked.c.position <= SEARCH_GROUP_GAMES)
+                      .order_by(ranked.c.entity_id, ranked.c.position))
+
+    games = {}
+    counts = {}
+    for entity_id, game_name, num_games in rows:
+        games.setdefault(entity_id, []).append(game_name)
+        counts[entity_id] = num_games
+
+    return [SearchGroup(entity_id, name, games.get(entity_id, []),
+                        counts.get(entity_id, 0))
+            for entity_id, name in found]
+
+################################################################################
+
+################################################################################
+# @app.route("/games/<game_id>"), @app.route("/users/<user_id>") and their
+# review listing helpers
+
+def load_game_details(game_id):
+    """Loads a game with everything game_details.html shows about it
+
+    The franchise and stats are joined in and each collection arrives in one
+    subquery load, so the page costs the same few queries however many
+    covers, screenshots or platforms a game has.
+    """
+
+    return (Game.query.filter_by(game_id=game_id)
+                      .options(sqlalchemy.orm.joinedload("franchise"),
+                               sqlalchemy.orm.joinedload("stats"),
+                               sqlalchemy.orm.subqueryload("covers"),
+                               sqlalchemy.orm.subqueryload("developers"),
+                               sqlalchemy.orm.subqueryload("genres"),
+                               sqlalchemy.orm.subqueryload("platforms"),
+                               sqlalchemy.orm.subqueryload("screenshots"),
+                               sqlalchemy.orm.subqueryload("videos"))
+                      .first())
+
+
+def get_game_version(game_id):
+    """Gets (etag, last_modified) for pages built from game_id's reviews
+
+    One primary key read of game_stats. Returns None for games without a
+    stats row, whose pages are then always sent in full.
+    """
+
+    updated_at = (db.session.query(GameStats.updated_at)
+                            .filter(GameStats.game_id == game_id).scalar())
+    if updated_at is None:
+        return None
+
+    return ("%s-%s" % (game_id, updated_at.strftime("%Y%m%d%H%M%S%f")),
+            updated_at.replace(microsecond=0))
+
+
+def not_modified(version):
+    """Returns a 304 response if the client already has version, else None
+
+    If-None-Match is checked first; If-Modified-Since only when the client
+    sent no ETag.
+    """
+
+    if version is None:
+        return None
+
+    etag, last_modified = version
+
+    if request.if_none_match:
+        unchanged = request.if_none_match.contains(etag)
+    else:
+        unchanged = (request.if_modified_since is not None and
+                     request.if_modified_since >= last_modified)
+
+    if not unchanged:
+        return None
+
+    return tag_response(current_app.response_class(status=304), version)
+
+
+def tag_response(response, version):
+    """Adds version's ETag and Last-Modified headers to response
+
+    Tagged responses are also marked no-cache, so caches revalidate them
+    with a conditional request instead of reusing them unchecked.
+    """
+
+    if version is not None:
+        response.set_etag(version[0])
+        response.last_modified = version[1]
+        response.cache_control.no_cache = True
+
+    return response
+
+
+REVIEWS_PER_PAGE = 9
+
+
+def get_review_page(query, after=None, limit=REVIEWS_PER_PAGE):
+    """Gets one page of query's reviews, newest first, and the next cursor
+
+    Keyset pagination: a cursor names the last review shown by
+    (review_time, review_id) and the next page starts strictly after it, so
+    deep pages cost the same indexed range scan as the first. Returns
+    (reviews, next_cursor); next_cursor is None on the last page. A cursor
+    that doesn't decode is a 400 Bad Request.
+    """
+
+    query = query.order_by(Review.review_time.desc(), Review.review_id.desc())
+
+    if after:
+        try:
+            review_time, review_id = decode_review_cursor(after)
+        except (ValueError, TypeError):
+            abort(400)
+        query = query.filter(sqlalchemy.tuple_(Review.review_time, Review.review_id)
+                             < sqlalchemy.tuple_(review_time, review_id))
+
+    reviews = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        next_cursor = encode_review_cursor(reviews[-1])
+
+    return reviews, next_cursor
+
+
+def encode_review_cursor(review):
+    """Cursor string for the page after review"""
+
+    return "%s_%d" % (review.review_time.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                      review.review_id)
+
+
+def decode_review_cursor(cursor):
+    """Returns (review_time, review_id) from encode_review_cursor()'s string"""
+
+    review_time, review_id = cursor.rsplit("_", 1)
+
+    return (datetime.strptime(review_time, "%Y-%m-%dT%H:%M:%S.%f"),
+            int(review_id))
+
+
+def count_pages(num_reviews):
+    """Number of review pages for a stored review count"""
+
+    return int(ceil(float(num_reviews or 0) / REVIEWS_PER_PAGE))
+
+################################################################################
+
+################################################################################
+# @app.route("/genres/<genre_id>"), @app.route("/developers/<developer_id>"),
+# @app.route("/franchises/<franchise_id>") and @app.route("/platforms/<platform_id>")
+# browse helpers
+
+BROWSE_PER_PAGE = 24
+
+# One game on a browse page
+BrowseCard = namedtuple("BrowseCard",
+                        "game_id name cover_url release_date avg_score critic_avg")
+
+# Column linking each browse category's ids to game_ids
+BROWSE_LINKS = {"genres": GameGenre.genre_id,
+                "developers": GameDeveloper.developer_id,
+                "franchises": Game.franchise_id,
+                "platforms": GamePlatform.platform_id}
+
+# Browse page orders, all best first; the first is the default
+BROWSE_SORTS = OrderedDict([("release", Game.release_date),
+                            ("score", GameStats.avg_score),
+                            ("critic", GameStats.critic_avg)])
+
+# BrowseCard field holding each sort's value
+BROWSE_FIELDS = {"release": "release_date", "score": "avg_score",
+                 "critic": "critic_avg"}
+
+# Number of games in each (category, id), see count_browse_games()
+browse_count_cache = LRUCache(max_size=10000, ttl=3600)
+
+
+def browse_sort(sort):
+    """The BROWSE_SORTS key for a requested sort, or the default"""
+
+    if sort in BROWSE_SORTS:
+        return sort
+
+    return next(iter(BROWSE_SORTS))
+
+
+def get_browse_page(category, entity_id, sort, after=None, limit=BROWSE_PER_PAGE):
+    """Gets one page of a category's games as BrowseCards, and the next cursor
+
+    Keyset pagination, as for reviews: the page continues strictly after
+    the (sort value, game_id) in the cursor, so every page costs the same
+    indexed walk of the link table and the sorted column whatever the
+    category's size. Games without the sort value (unreviewed games under
+    "score") come last, newest game_id first; they are read by a second
+    query once the rest run out. Returns (cards, next_cursor), where
+    next_cursor is None on the last page. A cursor that doesn't decode is
+    a 400 Bad Request.
+    """
+
+    link = BROWSE_LINKS[category]
+    column = BROWSE_SORTS[sort]
+
+    query = (db.session.query(Game.game_id, Game.name,
+                              first_cover_url().label("cover_url"),
+                              Game.release_date, GameStats.avg_score,
+                              GameStats.critic_avg)
+                       .outerjoin(GameStats, GameStats.game_id == Game.game_id))
+    if link.class_ is not Game:
+        query = query.join(link.class_, link.class_.game_id == Game.game_id)
+    query = query.filter(link == entity_id)
+
+    value = game_id = None
+    if after:
+        try:
+            value, game_id = decode_browse_cursor(sort, after)
+        except (ValueError, TypeError):
+            abort(400)
+
+    rows = []
+    if not after or value is not None:
+        ranked = query.filter(column != None)
+        if after:
+            ranked = ranked.filter(sqlalchemy.tuple_(column, Game.game_id)
+                                   < sqlalchemy.tuple_(value, game_id))
+        rows = (ranked.order_by(column.desc(), Game.game_id.desc())
+                      .limit(limit + 1).all())
+
+    if len(rows) <= limit:
+        unranked = query.filter(column == None)
+        if after and value is None:
+            unranked = unranked.filter(Game.game_id < game_id)
+        rows.extend(unranked.order_by(Game.game_id.desc())
+                            .limit(limit + 1 - len(rows)))
+
+    cards = [BrowseCard(*row) for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = cards[-1]
+        next_cursor = encode_browse_cursor(
+            sort, getattr(last, BROWSE_FIELDS[sort]), last.game_id)
+
+    return cards, next_cursor
+
+
+def encode_browse_cursor(sort, value, game_id):
+    """Cursor string for the browse page after (value, game_id)"""
+
+    if value is None:
+        value = "none"
+    elif sort == "release":
+        value = value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    else:
+        value = repr(value)
+
+    return "%s_%d" % (value, game_id)
+
+
+def decode_browse_cursor(sort, cursor):
+    """Returns (value, game_id) from encode_browse_cursor()'s string"""
+
+    value, game_id = cursor.rsplit("_", 1)
+
+    if value == "none":
+        value = None
+    elif sort == "release":
+        value = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    else:
+        value = float(value)
+
+    return value, int(game_id)
+
+
+def count_browse_games(category, entity_id):
+    """Number of games in a category, from browse_count_cache if fresh
+
+    Counted from the link table's index; the catalog only changes when
+    reseeded, which clears the cache (see invalidate_catalog()).
+    """
+
+    key = (category, entity_id)
+    count = browse_count_cache.get(key)
+
+    if count is None:
+        link = BROWSE_LINKS[category]
+        count = (db.session.query(func.count(link.class_.game_id))
+                           .filter(link == entity_id).scalar())
+        browse_count_cache.set(key, count)
+
+    return count
+
+
+def load_browse_page(category, entity_id, sort=None, after=None):
+    """Gets everything a browse template shows besides the category itself
+
+    Returns a dict of the page's games, its sort, the cursors of this and
+    the next page, and the category's game and page counts.
+    """
+
+    check_search_snapshot()
+
+    sort = browse_sort(sort)
+    games, next_cursor = get_browse_page(category, entity_id, sort, after)
+    num_games = count_browse_games(category, entity_id)
+
+    return {"games": games, "sort": sort, "sorts": list(BROWSE_SORTS),
+            "after": after, "next_cursor": next_cursor, "num_games": num_games,
+            "num_pages": int(ceil(float(num_games) / BROWSE_PER_PAGE))}
+
 ################################################################################
 
 ################################################################################
 # @app.route("/get_review_breakdown") helpers
 
-def sort_by_age_gender(users):
+# Chart series by gender, and the age brackets (by cohort decade) on its axis
+CHART_GENDERS = {"m": "m", "f": "f", "tm": "tm", "tw": "tw", "nb_gf": "nb"}
+CHART_BRACKETS = {0: 0, 10: 0, 20: 1, 30: 2, 40: 3}
+
+
+def get_demographic_averages(game_id):
+    """Average score per gender and age bracket for game_id's chart
+
+    One indexed read of the game's cohort histogram; cohorts are
+    "gender:decade", so each maps straight onto a series and bracket.
+    Brackets nobody reviewed from average 0.
+    """
+
+    averages = dict((series, [0] * 4) for series in CHART_GENDERS.values())
 
-    queries = {"m": users.filter(User.gender == "m"),
-               "f": users.filter(User.gender == "f"),
-               "tm": users.filter(User.gender == "tm"),
-               "tw": users.filter(User.gender == "tw"),
-               "nb": users.filter(User.gender == "nb_gf")}
+    for cohort, count, total in (db.session.query(GameCohortStats.cohort,
+                                                  GameCohortStats.num_reviews,
+                                                  GameCohortStats.score_sum)
+                                           .filter_by(game_id=game_id)):
+        gender, decade = cohort.rsplit(":", 1)
+        series = CHART_GENDERS.get(gender)
+        bracket = CHART_BRACKETS.get(int(decade))
 
-    datasets = {"m": [], "f": [], "tm": [], "tw":[], "nb": []}
+        if series and bracket is not None and count:
+            averages[series][bracket] = float(total) / count
 
-    for item in queries:
-        datasets[item].append(queries[item].filter(User.age <= 19).all())
-        datasets[item].append(queries[item].filter(User.age <= 29, User.age >19).all())
-        datasets[item].append(queries[item].filter(User.age <= 39, User.age >29).all())
-        datasets[item].append(queries[item].filter(User.age <= 49, User.age >39).all())
+    return averages
 
-    return datasets
 
 def get_chart_dict(averages):
 
@@ -0,0 +1,67 @@
+"""In-process ranking of games by average score"""
+
+import threading
+from bisect import bisect_left, insort
+
+
+class Leaderboard(object):
+    """Games ranked by average score, best first
+
+    Entries are kept in a list sorted by (-score, game_id), so ties break by
+    game_id as in the SQL it replaces. Finding a game's position is a binary
+    search; moving it is one list insert and delete, which for the number of
+    games on the site is a short memmove. top() is a slice.
+    """
+
+    def __init__(self):
+        self._ranked = []
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        return "<Leaderboard games=%s>" % len(self._ranked)
+
+    def __len__(self):
+        return len(self._ranked)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the leaderboard from (game_id, score) rows"""
+
+        leaderboard = cls()
+        for game_id, score in rows:
+            if score is not None:
+                leaderboard._scores[game_id] = float(score)
+
+        leaderboard._ranked = sorted((-score, game_id) for game_id, score
+                                     in leaderboard._scores.items())
+
+        return leaderboard
+
+    def update(self, game_id, score):
+        """Sets game_id's score, or removes it if score is None"""
+
+        with self._lock:
+            old_score = self._scores.pop(game_id, None)
+            if old_score is not None:
+                del self._ranked[bisect_left(self._ranked, (-old_score, game_id))]
+
+            if score is not None:
+                score = float(score)
+                self._scores[game_id] = score
+                insort(self._ranked, (-score, game_id))
+
+    def score(self, game_id):
+        """Returns game_id's score, or None if it isn't ranked"""
+
+        return self._scores.get(game_id)
+
+    def top(self, limit=20):
+        """Returns the best (game_id, score) pairs, best first"""
+
+        with self._lock:
+            ranked = self._ranked[:limit]
+
+        return [(game_id, -score) for score, game_id in ranked]
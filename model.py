@@ -2,7 +2,9 @@
 
 from flask_sqlalchemy import SQLAlchemy
 import datetime
+import numpy as np
 import correlation
+import similarity
 
 db = SQLAlchemy()
 
@@ -24,68 +26,80 @@ class User(db.Model):
     gender = db.Column(db.String(5))
     full_sort = db.Column(db.Boolean, default=True)
 
+    # Demographic bucket (gender and age decade) kept in step with age and
+    # gender; full_sort recommendations only match users in the same cohort
+    cohort = db.Column(db.String(12), index=True)
+
+    # Kept up to date by helpers.record_review_score(), see count_user_reviews()
+    num_reviews = db.Column(db.Integer, nullable=False, default=0)
+
+    # When precompute.py last stored this user's recommendations; cleared
+    # with them by helpers.invalidate_recommendations(stored=True), so an
+    # empty stored list is only a result while this is set
+    recommended_at = db.Column(db.DateTime)
+
     def __repr__(self):
         """Provide helpful output when printed"""
 
         u = "<User user_id=%s username=%s email=%s age=%s gender=%s>"
         return u % (self.user_id, self.username, self.email, self.age, self.gender)
 
-    def recommend(self):
-        """Predict games that this user would like"""
+    @staticmethod
+    def cohort_key(gender, age):
+        """Cohort for a gender and age, e.g. "f:30" for a 34 year old woman"""
 
-        
-        # Find users that are similar to the current user
-        review_dict = {}
+        if not gender or age is None:
+            return None
 
-        for review in self.reviews:
-            review_dict[review.game_id] = review.score
+        return "%s:%d" % (gender, int(age) / 10 * 10)
 
-        min_age = self.age / 10 * 10
-        max_age = min_age + 10
+    @db.validates("age", "gender")
+    def update_cohort(self, key, value):
+        """Recomputes the cohort whenever age or gender is set"""
 
-        if self.full_sort:
-            sim_users = (db.session.query(Review.user_id, Review.game_id, Review.score)
-                                          .filter(User.user_id != self.user_id,
-                                          User.gender == self.gender,
-                                          User.age >= min_age, User.age <= max_age,
-                                          Review.user_id == User.user_id).all())
+        if key == "age":
+            value = int(value) if value not in (None, "") else None
+            self.cohort = User.cohort_key(self.gender, value)
         else:
-            sim_users = (db.session.query(Review.user_id, Review.game_id, Review.score)
-                                          .filter(User.user_id != self.user_id,
-                                          Review.user_id == User.user_id).all())
-
-        matched_reviews = {}
-        for review in sim_users:
-            match = review_dict.get(review[1])
-            if match:
-                if matched_reviews.get(review.user_id):
-                    # Ignored in test due to small sample size
-                    matched_reviews[review.user_id].append((match, review.score)) # pragma: no cover
-                else:
-                    matched_reviews[review.user_id] = [(match, review.score)]
-
-        similarities = []
-        for user in matched_reviews:
-            similarities.append((user,
-                            correlation.pearson(matched_reviews[user])))
-
-        if similarities:
-
-            similarities.sort(key=lambda x: x[1], reverse=True)
-
-            #Return top five similar user_ids
-            best_users = []
-            for i in range(5):
-                try:
-                    best_users.append(similarities[i][0])
-                except IndexError:
-                    return best_users
-            # Ignored in test due to small sample size
-            return best_users # pragma: no cover
+            self.cohort = User.cohort_key(value, self.age)
+
+        return value
+
+    def similar_users(self, limit=5):
+        """Returns (user_id, correlation) for the users most like this one
+
+        Read straight from the similarity index, best match first.
+        """
+
+        neighbors = (db.session.query(UserSimilarity.other_id,
+                                      UserSimilarity.correlation)
+                               .filter(UserSimilarity.user_id == self.user_id,
+                                       UserSimilarity.size > 0))
+
+        # Restrict the other users to the same gender and age decade; the
+        # index carries their cohort, so only this cohort's rows are read.
+        # Users without a cohort have nobody to match.
+        if self.full_sort:
+            if self.cohort is None:
+                return []
+            neighbors = neighbors.filter(UserSimilarity.other_cohort == self.cohort)
+
+        return (neighbors.order_by(UserSimilarity.correlation.desc(),
+                                   UserSimilarity.other_id)
+                         .limit(limit).all())
+
+    def recommend(self):
+        """Predict games that this user would like
+
+        Returns the user_ids of the five users whose scores correlate best
+        with this user's, or None if nobody has reviewed the same games.
+        """
+
+        best_users = [other_id for other_id, correlation
+                      in self.similar_users(5)]
 
         # If there are not similarities, return None
-        else:
-            return None
+        return best_users or None
 
 
 class Review(db.Model):
@@ -95,18 +109,24 @@ class Review(db.Model):
 
     review_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"),
-                        nullable=False)
+                        nullable=False, index=True)
     game_id = db.Column(db.Integer, db.ForeignKey("games.game_id"),
                         nullable=False)
     score = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.Text)
-    review_time = db.Column(db.DateTime, nullable=False,
+    review_time = db.Column(db.DateTime, nullable=False, index=True,
                             default=datetime.datetime.utcnow)
 
     # Set middle table relationships to users and games
     user = db.relationship("User", backref="reviews")
     game = db.relationship("Game", backref="reviews")
 
+    # Newest-first keyset pagination of a game's or user's reviews
+    __table_args__ = (db.Index("ix_reviews_game_time", "game_id", "review_time",
+                               "review_id"),
+                      db.Index("ix_reviews_user_time", "user_id", "review_time",
+                               "review_id"))
+
     def __repr__(self):
         """Provide helpful output when printed"""
 
@@ -114,6 +134,189 @@ class Review(db.Model):
         return r % (self.user_id, self.game_id, self.score)
 
 
+class UserSimilarity(db.Model):
+    """Running Pearson sums for each pair of users who reviewed the same game
+
+    Every pair is stored in both directions so a user's neighbors are a single
+    indexed read. The *_user columns hold user_id's scores and the *_other
+    columns the other user's scores, summed over the games they share. Each
+    direction is stored once, so review writes can upsert their changes.
+    """
+
+    __tablename__ = "user_similarities"
+    __table_args__ = (db.UniqueConstraint("user_id", "other_id",
+                                          name="uq_user_similarities_pair"),
+                      db.Index("ix_user_similarities_user_correlation",
+                               "user_id", "correlation"),
+                      db.Index("ix_user_similarities_user_cohort_correlation",
+                               "user_id", "other_cohort", "correlation"),
+                      db.Index("ix_user_similarities_other", "other_id"))
+
+    similarity_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"),
+                        nullable=False)
+    other_id = db.Column(db.Integer, db.ForeignKey("users.user_id"),
+                         nullable=False)
+    # Copy of the other user's cohort, see User.cohort
+    other_cohort = db.Column(db.String(12))
+    size = db.Column(db.Integer, nullable=False, default=0)
+    sum_user = db.Column(db.Float, nullable=False, default=0)
+    sum_other = db.Column(db.Float, nullable=False, default=0)
+    squares_user = db.Column(db.Float, nullable=False, default=0)
+    squares_other = db.Column(db.Float, nullable=False, default=0)
+    product_sum = db.Column(db.Float, nullable=False, default=0)
+    correlation = db.Column(db.Float, nullable=False, default=0)
+
+    # Sum columns in the order correlation.pearson_sums() takes them
+    sum_columns = ("size", "sum_user", "sum_other", "squares_user",
+                   "squares_other", "product_sum")
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        s = "<UserSimilarity user_id=%s other_id=%s size=%s correlation=%s>"
+        return s % (self.user_id, self.other_id, self.size, self.correlation)
+
+    @staticmethod
+    def sum_changes(scores, old_scores=None):
+        """Changes to the sum columns when a shared game's (score, other_score)
+        is set to scores, from old_scores or from not being shared
+        """
+
+        def sums(pair):
+            if pair is None:
+                return [0] * len(UserSimilarity.sum_columns)
+
+            score, other_score = float(pair[0]), float(pair[1])
+            return [1, score, other_score, score * score,
+                    other_score * other_score, score * other_score]
+
+        return dict(zip(UserSimilarity.sum_columns,
+                        [new - old for new, old
+                         in zip(sums(scores), sums(old_scores))]))
+
+    @staticmethod
+    def correlations(rows):
+        """Pearson correlation of each row's sum columns"""
+
+        if not rows:
+            return []
+
+        sums = [np.array([getattr(row, column) for row in rows], dtype=float)
+                for column in UserSimilarity.sum_columns]
+
+        return correlation.pearson_sums(*sums).tolist()
+
+
+class Recommendation(db.Model):
+    """Precomputed game recommendations for a user, built by precompute.py"""
+
+    __tablename__ = "recommendations"
+    __table_args__ = (db.Index("ix_recommendations_user_rank", "user_id", "rank"),)
+
+    recommendation_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"),
+                        nullable=False)
+    game_id = db.Column(db.Integer, db.ForeignKey("games.game_id"),
+                        nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    generated_at = db.Column(db.DateTime, nullable=False,
+                             default=datetime.datetime.utcnow)
+
+    game = db.relationship("Game")
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        r = "<Recommendation user_id=%s game_id=%s rank=%s>"
+        return r % (self.user_id, self.game_id, self.rank)
+
+
+class CohortPopularGame(db.Model):
+    """Most reviewed games per cohort, built by precompute.py
+
+    Served to users with too few reviews for similarity matching. The
+    cohort "all" ranks games across every user.
+    """
+
+    __tablename__ = "cohort_popular_games"
+    __table_args__ = (db.Index("ix_cohort_popular_games_cohort_rank",
+                               "cohort", "rank"),)
+
+    popular_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    cohort = db.Column(db.String(12), nullable=False)
+    game_id = db.Column(db.Integer, db.ForeignKey("games.game_id"),
+                        nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    num_reviews = db.Column(db.Integer, nullable=False)
+    avg_score = db.Column(db.Float, nullable=False)
+    generated_at = db.Column(db.DateTime, nullable=False,
+                             default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        p = "<CohortPopularGame cohort=%s game_id=%s rank=%s>"
+        return p % (self.cohort, self.game_id, self.rank)
+
+
+class GameStats(db.Model):
+    """Per-game review and critic score aggregates
+
+    Kept up to date by helpers.record_review_score() as reviews are written,
+    and rebuilt in bulk by build_game_stats(), so pages can read averages
+    without grouping the reviews and critics tables.
+    """
+
+    __tablename__ = "game_stats"
+
+    game_id = db.Column(db.Integer, db.ForeignKey("games.game_id"),
+                        primary_key=True)
+    num_reviews = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Integer, nullable=False, default=0)
+    avg_score = db.Column(db.Float, index=True)
+    num_critics = db.Column(db.Integer, nullable=False, default=0)
+    critic_sum = db.Column(db.Integer, nullable=False, default=0)
+    critic_avg = db.Column(db.Float, index=True)
+
+    # When anything shown about the game's reviews last changed; the version
+    # stamp behind the ETag and Last-Modified headers of its pages
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+
+    game = db.relationship("Game", backref=db.backref("stats", uselist=False))
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        s = "<GameStats game_id=%s num_reviews=%s avg_score=%s critic_avg=%s>"
+        return s % (self.game_id, self.num_reviews, self.avg_score,
+                    self.critic_avg)
+
+
+class GameCohortStats(db.Model):
+    """Review count and score sum per game and reviewer cohort
+
+    The demographic histogram behind a game's review breakdown chart. Kept
+    up to date as reviews are written and as reviewers change cohort, and
+    rebuilt in bulk by build_game_stats().
+    """
+
+    __tablename__ = "game_cohort_stats"
+
+    game_id = db.Column(db.Integer, db.ForeignKey("games.game_id"),
+                        primary_key=True)
+    cohort = db.Column(db.String(12), primary_key=True)
+    num_reviews = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        s = "<GameCohortStats game_id=%s cohort=%s num_reviews=%s>"
+        return s % (self.game_id, self.cohort, self.num_reviews)
+
+
 class CriticReview(db.Model):
     """Reviews specific to the critic websties scraped
 
@@ -155,6 +358,11 @@ class Game(db.Model):
     # Set one to many relationship with franchises
     franchise = db.relationship("Franchise", backref="games")
 
+    # Browse pages walk games newest first, overall and within a franchise
+    __table_args__ = (db.Index("ix_games_release", "release_date", "game_id"),
+                      db.Index("ix_games_franchise_release", "franchise_id",
+                               "release_date", "game_id"))
+
     def __repr__(self):
         """Provide helpful output when printed"""
 
@@ -227,6 +435,9 @@ class GameGenre(db.Model):
     game_id = db.Column(db.Integer, db.ForeignKey("games.game_id"), nullable=False)
     genre_id = db.Column(db.Integer, db.ForeignKey("genres.genre_id"), nullable=False)
 
+    # Browse pages find and count a genre's games by (genre_id, game_id)
+    __table_args__ = (db.Index("ix_game_genres_genre_game", "genre_id", "game_id"),)
+
 
 class Genre(db.Model):
     """Genre table"""
@@ -256,6 +467,10 @@ class GameDeveloper(db.Model):
     developer_id = db.Column(db.Integer, db.ForeignKey("developers.developer_id"),
                              nullable=False)
 
+    # Browse pages find and count a developer's games by (developer_id, game_id)
+    __table_args__ = (db.Index("ix_game_developers_developer_game", "developer_id",
+                               "game_id"),)
+
 
 class Developer(db.Model):
     """Developer table"""
@@ -305,6 +520,10 @@ class GamePlatform(db.Model):
     platform_id = db.Column(db.Integer, db.ForeignKey("platforms.platform_id"),
                             nullable=False)
 
+    # Browse pages find and count a platform's games by (platform_id, game_id)
+    __table_args__ = (db.Index("ix_game_platforms_platform_game", "platform_id",
+                               "game_id"),)
+
 
 class Platform(db.Model):
     """Game platform table"""
@@ -359,6 +578,89 @@ def connect_to_db(app, db_url='postgresql:///games'):
     db.init_app(app)
 
 
+def build_similarity_index():
+    """Rebuilds the user_similarities table from every review"""
+
+    UserSimilarity.query.delete()
+
+    rows = db.session.query(Review.user_id, Review.game_id, Review.score).all()
+    matrix = similarity.RatingMatrix.from_rows(rows)
+    cohorts = dict(db.session.query(User.user_id, User.cohort).all())
+
+    for user_id in matrix.user_ids.tolist():
+        other_ids, sums = matrix.pair_sums(user_id)
+        correlations = correlation.pearson_sums(*sums)
+
+        columns = ("other_id", "correlation") + UserSimilarity.sum_columns
+        values = zip(other_ids.tolist(), correlations.tolist(),
+                     *[column.tolist() for column in sums])
+
+        mappings = []
+        for row in values:
+            mapping = dict(zip(columns, row))
+            mapping["user_id"] = user_id
+            mapping["other_cohort"] = cohorts.get(mapping["other_id"])
+            mappings.append(mapping)
+
+        db.session.bulk_insert_mappings(UserSimilarity, mappings)
+
+    db.session.commit()
+
+
+def build_game_stats():
+    """Rebuilds game_stats and game_cohort_stats from every review and critic"""
+
+    GameStats.query.delete()
+    GameCohortStats.query.delete()
+
+    updated_at = datetime.datetime.utcnow()
+
+    stats = {}
+    for game_id, in db.session.query(Game.game_id):
+        stats[game_id] = {"game_id": game_id, "num_reviews": 0, "score_sum": 0,
+                          "avg_score": None, "num_critics": 0, "critic_sum": 0,
+                          "critic_avg": None, "updated_at": updated_at}
+
+    reviews = (db.session.query(Review.game_id, db.func.count(Review.review_id),
+                                db.func.sum(Review.score))
+                         .group_by(Review.game_id))
+    for game_id, count, total in reviews:
+        stats[game_id].update(num_reviews=count, score_sum=total,
+                              avg_score=float(total) / count)
+
+    critics = (db.session.query(CriticReview.game_id,
+                                db.func.count(CriticReview.review_id),
+                                db.func.sum(CriticReview.score))
+                         .group_by(CriticReview.game_id))
+    for game_id, count, total in critics:
+        stats[game_id].update(num_critics=count, critic_sum=total,
+                              critic_avg=float(total) / count)
+
+    by_cohort = (db.session.query(Review.game_id, User.cohort,
+                                  db.func.count(Review.review_id),
+                                  db.func.sum(Review.score))
+                           .join(User, User.user_id == Review.user_id)
+                           .filter(User.cohort != None)
+                           .group_by(Review.game_id, User.cohort))
+    cohort_stats = [{"game_id": game_id, "cohort": cohort, "num_reviews": count,
+                     "score_sum": total}
+                    for game_id, cohort, count, total in by_cohort]
+
+    db.session.bulk_insert_mappings(GameStats, stats.values())
+    db.session.bulk_insert_mappings(GameCohortStats, cohort_stats)
+    db.session.commit()
+
+
+def count_user_reviews():
+    """Recounts every user's num_reviews from the reviews table"""
+
+    counts = (db.session.query(db.func.count(Review.review_id))
+                        .filter(Review.user_id == User.user_id)
+                        .correlate(User).as_scalar())
+    User.query.update({User.num_reviews: counts}, synchronize_session=False)
+    db.session.commit()
+
+
 def example_data():
     """Makes some example objects for db testing"""
     user = User(username='testo', password='testo', email='testo@test.com',
@@ -392,3 +694,21 @@ def example_data():
     db.session.add_all([gameGenre, gamePlatform, gameDeveloper])
     db.session.commit()
 
+    build_game_stats()
+    count_user_reviews()
+    build_similarity_index()
+
+
+def example_sequel(reviews=((2, 90),)):
+    """Adds a second example game, "Sequel", reviewed as (user_id, score) pairs
+
+    The derived tables aren't rebuilt; tests that need them call the build
+    functions.
+    """
+
+    db.session.add(Game(game_id=2, name="Sequel",
+                        release_date=datetime.datetime.now()))
+    db.session.commit()
+    db.session.add_all([Review(user_id=user_id, game_id=2, score=score)
+                        for user_id, score in reviews])
+    db.session.commit()
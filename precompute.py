@@ -0,0 +1,299 @@
+"""Batch job that precomputes homepage recommendations for every user
+
+Run after seed.py and then on a schedule (e.g. nightly from cron):
+
+    $ python precompute.py [chunk_size]
+    $ python precompute.py --workers 32
+
+Both forms also refresh the per-cohort popular games shown to new users.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from sqlalchemy.sql import func
+
+from model import (User, Review, Recommendation, CohortPopularGame,
+                   connect_to_db, db)
+from server import app
+from similarity import RatingMatrix, UserLSH
+import helpers
+
+
+def precompute_recommendations(chunk_size=500):
+    """Stores recommendations for every user, chunk_size users at a time
+
+    Each chunk is written and committed on its own and then dropped from the
+    session, so memory stays bounded however many users and reviews there
+    are. Returns the number of users processed.
+    """
+
+    print "Recommendations"
+
+    generated_at = datetime.utcnow()
+    start = time.time()
+    num_users = 0
+    last_user_id = 0
+
+    while True:
+        users = (User.query.filter(User.user_id > last_user_id)
+                           .order_by(User.user_id).limit(chunk_size).all())
+        if not users:
+            break
+
+        user_ids = [user.user_id for user in users]
+
+        recommendations = []
+        for user in users:
+            for rank, game in enumerate(helpers.recommend_games(user)):
+                recommendations.append({"user_id": user.user_id,
+                                        "game_id": game.game_id, "rank": rank,
+                                        "generated_at": generated_at})
+
+        # Replace the chunk's previous generation in the same transaction
+        (Recommendation.query.filter(Recommendation.user_id.in_(user_ids))
+                             .delete(synchronize_session=False))
+        db.session.bulk_insert_mappings(Recommendation, recommendations)
+        mark_recommended(user_ids, generated_at)
+        db.session.commit()
+        db.session.expunge_all()
+
+        num_users += len(users)
+        last_user_id = user_ids[-1]
+
+        # Show progress and throughput
+        elapsed = time.time() - start
+        print "%d users, %.1f users/sec" % (num_users, num_users / max(elapsed, 1e-6))
+
+    return num_users
+
+
+def mark_recommended(user_ids, generated_at):
+    """Records that user_ids' stored lists are current, even when empty"""
+
+    (User.query.filter(User.user_id.in_(user_ids))
+               .update({User.recommended_at: generated_at},
+                       synchronize_session=False))
+
+
+def precompute_popular(limit=20):
+    """Stores the most reviewed games of each cohort, and of everyone
+
+    One windowed query ranks games within every cohort and a second ranks
+    them site-wide under the cohort "all". Returns the number of rows stored.
+    """
+
+    print "Popular games"
+
+    generated_at = datetime.utcnow()
+    num_reviews = func.count(Review.review_id)
+    avg_score = func.avg(Review.score)
+
+    by_cohort = (db.session.query(User.cohort, Review.game_id,
+                                  num_reviews.label("num_reviews"),
+                                  avg_score.label("avg_score"),
+                                  func.row_number().over(
+                                      partition_by=User.cohort,
+                                      order_by=(num_reviews.desc(), avg_score.desc(),
+                                                Review.game_id))
+                                  .label("position"))
+                           .join(Review, Review.user_id == User.user_id)
+                           .filter(User.cohort != None)
+                           .group_by(User.cohort, Review.game_id)
+                           .subquery())
+    cohort_rows = (db.session.query(by_cohort)
+                             .filter(by_cohort.c.position <= limit).all())
+
+    overall_rows = (db.session.query(Review.game_id, num_reviews, avg_score)
+                              .group_by(Review.game_id)
+                              .order_by(num_reviews.desc(), avg_score.desc(),
+                                        Review.game_id)
+                              .limit(limit).all())
+
+    popular = [{"cohort": cohort, "game_id": game_id, "rank": position - 1,
+                "num_reviews": count, "avg_score": float(avg),
+                "generated_at": generated_at}
+               for cohort, game_id, count, avg, position in cohort_rows]
+    popular.extend({"cohort": "all", "game_id": game_id, "rank": rank,
+                    "num_reviews": count, "avg_score": float(avg),
+                    "generated_at": generated_at}
+                   for rank, (game_id, count, avg) in enumerate(overall_rows))
+
+    # Swap in the new lists in one transaction
+    CohortPopularGame.query.delete()
+    db.session.bulk_insert_mappings(CohortPopularGame, popular)
+    db.session.commit()
+
+    return len(popular)
+
+
+def precompute_parallel(workers=None, tasks_per_worker=4):
+    """Stores recommendations for every user using a pool of processes
+
+    The ratings are read once, written to memory-mapped .npy files, and
+    opened read-only by each worker, so tasks only carry a range of matrix
+    rows. Workers never touch the database; results are merged and written
+    by this process in a single transaction. With NEIGHBOR_SEARCH set to
+    "lsh", a UserLSH built here from the same ratings is handed to each
+    worker, and only its candidates are ranked. Returns the number of users
+    processed.
+    """
+
+    print "Recommendations (parallel)"
+
+    workers = workers or cpu_count()
+    generated_at = datetime.utcnow()
+    start = time.time()
+
+    rows = db.session.query(Review.user_id, Review.game_id, Review.score).all()
+    matrix = RatingMatrix.from_rows(rows)
+    cohorts = _cohort_arrays(matrix.user_ids)
+
+    index = None
+    if app.config["NEIGHBOR_SEARCH"] == "lsh":
+        index = UserLSH.from_rows(rows, tables=app.config["LSH_TABLES"],
+                                  bits=app.config["LSH_BITS"])
+
+    directory = tempfile.mkdtemp(prefix="exp_ratings_")
+    try:
+        matrix.save(directory)
+        for name, array in cohorts.items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+
+        # Forked workers must not share the parent's database connections
+        db.session.close()
+        db.engine.dispose()
+
+        bounds = np.linspace(0, len(matrix.user_ids),
+                             workers * tasks_per_worker + 1).astype(int)
+        ranges = [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)
+                  if bounds[i] < bounds[i + 1]]
+
+        pool = Pool(workers, _init_worker, (directory, index))
+        try:
+            Recommendation.query.delete()
+            num_users = 0
+
+            for results in pool.imap_unordered(_recommend_rows, ranges):
+                recommendations = []
+                for user_id, game_ids in results:
+                    for rank, game_id in enumerate(game_ids):
+                        recommendations.append({"user_id": user_id,
+                                                "game_id": game_id, "rank": rank,
+                                                "generated_at": generated_at})
+                db.session.bulk_insert_mappings(Recommendation, recommendations)
+                mark_recommended([user_id for user_id, game_ids in results],
+                                 generated_at)
+                num_users += len(results)
+
+                # Show progress and throughput
+                elapsed = time.time() - start
+                print "%d users, %.1f users/sec" % (num_users,
+                                                    num_users / max(elapsed, 1e-6))
+
+            db.session.commit()
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(directory)
+
+    return num_users
+
+
+def _cohort_arrays(user_ids):
+    """Cohort codes and full_sort flags aligned with the matrix rows"""
+
+    users = dict((user_id, (cohort, full_sort)) for user_id, cohort, full_sort in
+                 db.session.query(User.user_id, User.cohort, User.full_sort)
+                           .filter(User.user_id.in_(user_ids.tolist())))
+    rows = [users[user_id] for user_id in user_ids.tolist()]
+
+    # Users without a cohort are -1
+    codes = {None: -1}
+    for cohort, full_sort in rows:
+        codes.setdefault(cohort, len(codes) - 1)
+
+    return {"cohorts": np.array([codes[cohort] for cohort, full_sort in rows],
+                                dtype=np.int64),
+            "full_sorts": np.array([bool(full_sort) for cohort, full_sort in rows])}
+
+
+# Read-only data opened once per worker process by _init_worker
+_shared = {}
+
+
+def _init_worker(directory, index=None):
+    """Memory-maps the ratings and cohort arrays written by the parent
+
+    index is the parent's UserLSH, if neighbors come from its candidates.
+    """
+
+    _shared["matrix"] = RatingMatrix.load(directory)
+    _shared["index"] = index
+    for name in ("cohorts", "full_sorts"):
+        _shared[name] = np.load(os.path.join(directory, name + ".npy"),
+                                mmap_mode="r")
+
+
+def _recommend_rows(row_range):
+    """Returns (user_id, game_ids) for the matrix rows in [start, end)"""
+
+    matrix = _shared["matrix"]
+    cohorts = _shared["cohorts"]
+
+    results = []
+    for row in range(*row_range):
+        user_id = int(matrix.user_ids[row])
+
+        # Same cohort, as in User.similar_users(); without one, nobody
+        cohort = None
+        if _shared["full_sorts"][row]:
+            if cohorts[row] < 0:
+                results.append((user_id, []))
+                continue
+            cohort = cohorts[row]
+
+        # Only the users sharing an LSH bucket are compared against; an
+        # empty bucket falls back to everyone
+        found = _shared["index"] and _shared["index"].candidates(user_id)
+        if found:
+            rows = matrix.user_rows(found)
+            if cohort is not None:
+                rows = rows[cohorts[rows] == cohort]
+            games = matrix.recommend_games(user_id, rows=rows)
+        elif cohort is not None:
+            games = matrix.recommend_games(user_id,
+                                           candidates=cohorts == cohort)
+        else:
+            games = matrix.recommend_games(user_id)
+
+        results.append((user_id, games))
+
+    return results
+
+
+################################################################################
+# Run when called from main
+
+if __name__ == "__main__":
+    connect_to_db(app)
+
+    # In case tables haven't been created, create them
+    db.create_all()
+
+    if len(sys.argv) > 2 and sys.argv[1] == "--workers":
+        precompute_parallel(int(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        precompute_recommendations(int(sys.argv[1]))
+    else:
+        precompute_recommendations()
+
+    precompute_popular()
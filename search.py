@@ -0,0 +1,485 @@
+"""In-process search index over users, games and the catalog tables
+
+Replaces the ILIKE '%term%' scans behind /search. Names are split into
+lowercase tokens and each token's 3 character substrings are posted, so a
+query token finds the names containing it by intersecting a few posting
+sets instead of reading every row. The index can be saved to a
+snapshot so processes start without querying the six tables:
+
+    $ python search.py [path]
+
+TrigramSearch is the alternative that leaves search to PostgreSQL; add the
+pg_trgm indexes it needs with (and remove them with --unmigrate):
+
+    $ python search.py --migrate
+"""
+
+import re
+import sys
+import json
+import heapq
+import threading
+from bisect import bisect_left
+
+from model import (User, Game, Genre, Franchise, Developer, Platform, GameStats,
+                   GameDeveloper, GamePlatform, db)
+
+
+# Search result categories, in the order /search shows them
+CATEGORIES = ("users", "games", "genres", "franchises", "developers", "platforms")
+
+# Length of the posted substrings. Query words shorter than this match the
+# start of a word only, so "a" doesn't rank most of the catalog.
+GRAM_SIZE = 3
+
+_token_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(text):
+    """Lowercase unicode text with its tokens joined by single spaces"""
+
+    if isinstance(text, str):
+        text = text.decode("utf-8")
+
+    return u" ".join(_token_pattern.findall(text.lower()))
+
+
+def grams(token, size=GRAM_SIZE):
+    """Posting keys for token: its substrings of size characters, and its
+    shorter prefixes marked with a leading ^
+    """
+
+    keys = set(u"^" + token[:length]
+               for length in range(1, min(size, len(token) + 1)))
+    keys.update(token[start:start + size]
+                for start in range(len(token) - size + 1))
+
+    return keys
+
+
+def query_grams(token, size=GRAM_SIZE):
+    """Posting keys a name must have to match query token"""
+
+    if len(token) < size:
+        return [u"^" + token]
+
+    return [token[start:start + size] for start in range(len(token) - size + 1)]
+
+
+def matches(normalized, token, size=GRAM_SIZE):
+    """Whether a normalized name matches query token, see SearchIndex"""
+
+    if len(token) < size:
+        return (u" " + normalized).find(u" " + token) >= 0
+
+    return token in normalized
+
+
+class SearchIndex(object):
+    """Names of searchable entities, keyed by (category, id)
+
+    A name matches when each query token appears somewhere in it, as with
+    one ILIKE per word; tokens shorter than GRAM_SIZE must start a word.
+    Candidates come from the postings of the query tokens' substrings,
+    smallest set first, and are then checked against the name itself.
+    Results are ranked exact name first, then names starting with the
+    query, the query at the start of a later word, anywhere in the name,
+    and finally the words found apart; ties go to shorter names.
+    """
+
+    def __init__(self):
+        # (category, id) -> (normalized name, name)
+        self.entries = {}
+
+        # substring -> set of (category, id)
+        self.postings = {}
+
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        s = "<SearchIndex entries=%s postings=%s>"
+        return s % (len(self.entries), len(self.postings))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the index from (category, id, name) rows"""
+
+        index = cls()
+        for category, entity_id, name in rows:
+            index.add(category, entity_id, name)
+
+        return index
+
+    def rows(self):
+        """Returns the indexed (category, id, name) rows"""
+
+        with self._lock:
+            return [(category, entity_id, name) for (category, entity_id), (_, name)
+                    in self.entries.items()]
+
+    def save(self, path):
+        """Writes the rows to a JSON snapshot at path, see load()"""
+
+        with open(path, "wb") as file:
+            json.dump(self.rows(), file)
+
+    @classmethod
+    def load(cls, path):
+        """Rebuilds an index from a snapshot written by save()"""
+
+        with open(path, "rb") as file:
+            return cls.from_rows(json.load(file))
+
+    def add(self, category, entity_id, name):
+        """Indexes name under (category, entity_id), replacing any old name"""
+
+        key = (category, entity_id)
+        normalized = normalize(name)
+
+        with self._lock:
+            self._remove(key)
+            self.entries[key] = (normalized, name)
+
+            for token in set(normalized.split()):
+                for gram in grams(token):
+                    self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, category, entity_id):
+        """Drops (category, entity_id) if indexed"""
+
+        with self._lock:
+            self._remove((category, entity_id))
+
+    def _remove(self, key):
+        """Drops key's postings; the caller holds the lock"""
+
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        for token in set(entry[0].split()):
+            for gram in grams(token):
+                keys = self.postings[gram]
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    def search(self, query, limit=20, categories=CATEGORIES, offset=0):
+        """Ranks the entities matching query
+
+        Returns {category: [(id, name), ...]} with at most limit results per
+        category, best first, skipping the first offset of each.
+        """
+
+        phrase = normalize(query)
+        tokens = phrase.split()
+        results = dict((category, []) for category in categories)
+        if not tokens:
+            return results
+
+        with self._lock:
+            candidates = self._candidates(tokens)
+
+            ranked = dict((category, []) for category in categories)
+            for key in candidates:
+                if key[0] not in ranked:
+                    continue
+
+                normalized, name = self.entries[key]
+                if all(matches(normalized, token) for token in tokens):
+                    ranked[key[0]].append((_rank(normalized, phrase), len(normalized),
+                                           normalized, key[1], name))
+
+        for category, found in ranked.items():
+            best = heapq.nsmallest(offset + limit, found)[offset:]
+            results[category] = [(entity_id, name) for _, _, _, entity_id, name
+                                 in best]
+
+        return results
+
+    def _candidates(self, tokens):
+        """Keys whose names may contain every token; the caller holds the lock"""
+
+        sets = []
+        for token in set(tokens):
+            for gram in query_grams(token):
+                keys = self.postings.get(gram)
+                if not keys:
+                    return set()
+                sets.append(keys)
+
+        sets.sort(key=len)
+        found = set(sets[0])
+        for keys in sets[1:]:
+            found &= keys
+            if not found:
+                break
+
+        return found
+
+
+def _rank(normalized, phrase):
+    """Match tier of a name containing every query token, best first"""
+
+    if normalized == phrase:
+        return 0
+    if normalized.startswith(phrase):
+        return 1
+    if u" " + phrase in normalized:
+        return 2
+    if phrase in normalized:
+        return 3
+
+    return 4
+
+
+class PrefixIndex(object):
+    """Typeahead suggestions: names with a word starting with a prefix
+
+    Each name is entered once per word, as the text from that word on, in
+    one sorted array, so the names matching a prefix are a contiguous slice
+    found by two binary searches. Suggestions are ranked by weight
+    (popularity), then names that start with the prefix, then shorter
+    names. Prefixes up to precomputed_length characters match long slices,
+    so their top max_limit suggestions are ranked once when built. The
+    index is rebuilt rather than updated.
+    """
+
+    precomputed_length = 2
+
+    def __init__(self, rows, max_limit=10):
+        # key (category, id) -> (normalized name, name, weight)
+        self.entries = {}
+        self.max_limit = max_limit
+
+        suffixes = []
+        for category, entity_id, name, weight in rows:
+            key = (category, entity_id)
+            normalized = normalize(name)
+            self.entries[key] = (normalized, name, weight or 0)
+
+            words = normalized.split()
+            for start in range(len(words)):
+                suffixes.append((u" ".join(words[start:]), key))
+
+        suffixes.sort()
+        self.suffixes = [suffix for suffix, key in suffixes]
+        self.keys = [key for suffix, key in suffixes]
+
+        # prefix -> ranked keys
+        self.precomputed = {}
+        shorts = {}
+        for suffix, key in suffixes:
+            for length in range(1, min(self.precomputed_length, len(suffix)) + 1):
+                shorts.setdefault(suffix[:length], set()).add(key)
+        for prefix, keys in shorts.items():
+            self.precomputed[prefix] = self._rank(prefix, keys, max_limit)
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        p = "<PrefixIndex entries=%s suffixes=%s>"
+        return p % (len(self.entries), len(self.suffixes))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def suggest(self, prefix, limit=10):
+        """Returns up to limit (category, id, name) suggestions for prefix"""
+
+        prefix = normalize(prefix)
+        limit = min(limit, self.max_limit)
+        if not prefix or limit <= 0:
+            return []
+
+        if len(prefix) <= self.precomputed_length:
+            keys = self.precomputed.get(prefix, [])[:limit]
+        else:
+            start = bisect_left(self.suffixes, prefix)
+            end = bisect_left(self.suffixes, prefix + u"\uffff", start)
+            keys = self._rank(prefix, set(self.keys[start:end]), limit)
+
+        return [key + (self.entries[key][1],) for key in keys]
+
+    def _rank(self, prefix, keys, limit):
+        """The limit best keys matching prefix, best first"""
+
+        def order(key):
+            normalized, name, weight = self.entries[key]
+            return (-weight, not normalized.startswith(prefix), len(normalized),
+                    normalized, key)
+
+        return heapq.nsmallest(limit, keys, key=order)
+
+
+# (id, name) columns searched in each category
+SEARCH_COLUMNS = {"users": (User.user_id, User.username),
+                  "games": (Game.game_id, Game.name),
+                  "genres": (Genre.genre_id, Genre.genre),
+                  "franchises": (Franchise.franchise_id, Franchise.name),
+                  "developers": (Developer.developer_id, Developer.name),
+                  "platforms": (Platform.platform_id, Platform.name)}
+
+
+def index_rows():
+    """Reads the (category, id, name) rows of every searchable table"""
+
+    rows = []
+    for category in CATEGORIES:
+        rows.extend((category, entity_id, name) for entity_id, name
+                    in db.session.query(*SEARCH_COLUMNS[category]))
+
+    return rows
+
+
+class TrigramSearch(object):
+    """Search backend that queries PostgreSQL instead of holding an index
+
+    Matches like SearchIndex, with one ILIKE per query word, which the
+    pg_trgm GIN indexes added by create_trigram_indexes() serve. Results are
+    ranked by trigram similarity to the whole query, then shorter names.
+    Each category is one query with its own LIMIT and OFFSET.
+    """
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        return "<TrigramSearch>"
+
+    def search(self, query, limit=20, categories=CATEGORIES, offset=0):
+        """Ranks the entities matching query, see SearchIndex.search()"""
+
+        phrase = normalize(query)
+        tokens = phrase.split()
+        results = dict((category, []) for category in categories)
+        if not tokens:
+            return results
+
+        for category in categories:
+            id_column, name_column = SEARCH_COLUMNS[category]
+            matches = [name_column.ilike(u"%" + _escape_like(token) + u"%",
+                                         escape="\\")
+                       for token in set(tokens)]
+
+            similarity = db.func.similarity(name_column, phrase)
+
+            results[category] = (db.session.query(id_column, name_column)
+                                           .filter(*matches)
+                                           .order_by(similarity.desc(),
+                                                     db.func.length(name_column),
+                                                     name_column, id_column)
+                                           .offset(offset).limit(limit).all())
+
+        return results
+
+
+def _escape_like(text):
+    """Escapes LIKE wildcards so text matches literally"""
+
+    return (text.replace(u"\\", u"\\\\").replace(u"%", u"\\%")
+                .replace(u"_", u"\\_"))
+
+
+def trigram_indexes():
+    """(index name, table, column) of the GIN indexes TrigramSearch uses"""
+
+    indexes = []
+    for category in CATEGORIES:
+        name_column = SEARCH_COLUMNS[category][1]
+        table = name_column.table.name
+        indexes.append(("ix_%s_%s_trgm" % (table, name_column.key), table,
+                        name_column.key))
+
+    return indexes
+
+
+def create_trigram_indexes():
+    """Migration for the "trigram" search backend; safe to rerun
+
+    Installs pg_trgm and adds a GIN trigram index on each searched name.
+    """
+
+    db.session.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for index, table, column in trigram_indexes():
+        db.session.execute("CREATE INDEX IF NOT EXISTS %s ON %s "
+                           "USING gin (%s gin_trgm_ops)" % (index, table, column))
+    db.session.commit()
+
+
+def drop_trigram_indexes():
+    """Reverts create_trigram_indexes(), leaving the extension installed"""
+
+    for index, table, column in trigram_indexes():
+        db.session.execute("DROP INDEX IF EXISTS %s" % index)
+    db.session.commit()
+
+
+def suggest_rows():
+    """Reads (category, id, name, weight) rows for the PrefixIndex
+
+    A game weighs its number of reviews; a franchise, developer or platform
+    the reviews of all its games.
+    """
+
+    num_reviews = db.func.coalesce(db.func.sum(GameStats.num_reviews), 0)
+
+    rows = [("games", game_id, name, weight) for game_id, name, weight in
+            db.session.query(Game.game_id, Game.name, num_reviews)
+                      .outerjoin(GameStats, GameStats.game_id == Game.game_id)
+                      .group_by(Game.game_id)]
+
+    rows.extend(("franchises", franchise_id, name, weight)
+                for franchise_id, name, weight in
+                db.session.query(Franchise.franchise_id, Franchise.name, num_reviews)
+                          .outerjoin(Game, Game.franchise_id == Franchise.franchise_id)
+                          .outerjoin(GameStats, GameStats.game_id == Game.game_id)
+                          .group_by(Franchise.franchise_id))
+
+    for category, model, id_column, link in (
+            ("developers", Developer, Developer.developer_id, GameDeveloper),
+            ("platforms", Platform, Platform.platform_id, GamePlatform)):
+        rows.extend((category, entity_id, name, weight)
+                    for entity_id, name, weight in
+                    db.session.query(id_column, model.name, num_reviews)
+                              .outerjoin(link, getattr(link, id_column.key) == id_column)
+                              .outerjoin(GameStats, GameStats.game_id == link.game_id)
+                              .group_by(id_column))
+
+    return rows
+
+
+def build_from_db(path=None):
+    """Builds the index from the database, saving a snapshot to path if given"""
+
+    index = SearchIndex.from_rows(index_rows())
+    if path:
+        index.save(path)
+
+    return index
+
+
+################################################################################
+# Run when called from main
+
+if __name__ == "__main__":
+    from model import connect_to_db
+    from server import app # Imported here; server imports helpers, which imports this
+
+    connect_to_db(app)
+
+    if sys.argv[1:] == ["--migrate"]:
+        print "Trigram indexes"
+        create_trigram_indexes()
+    elif sys.argv[1:] == ["--unmigrate"]:
+        drop_trigram_indexes()
+    elif len(sys.argv) > 1:
+        print "Search index"
+        build_from_db(sys.argv[1])
+    else:
+        print "Search index"
+        build_from_db(app.config["SEARCH_INDEX_PATH"])
@@ -5,13 +5,15 @@ from model import (User, Review, Game, Franchise, Cover, GamePlatform, Platform,
                    GameDeveloper, Developer, GameGenre, Genre, Screenshot,
                    CriticReview, Video)
 
-from model import connect_to_db, db
+from model import (connect_to_db, db, build_similarity_index, build_game_stats,
+                   count_user_reviews)
 from server import app
 from datetime import datetime
 import time
 import json
 
 import pull_data
+import search
 
 
 def load_users():
@@ -69,6 +71,33 @@ def load_reviews():
     db.session.commit()
 
 
+def load_similarities():
+    """Rebuilds the user similarity index from the reviews table"""
+
+    print "Similarities"
+
+    build_similarity_index()
+
+
+def load_game_stats():
+    """Rebuilds the per-game score aggregates and per-user review counts"""
+
+    print "Game stats"
+
+    build_game_stats()
+    count_user_reviews()
+
+
+def load_search_index():
+    """Rewrites the search snapshot; running servers reload it and drop their
+    cached search results when it changes
+    """
+
+    print "Search index"
+
+    search.build_from_db(app.config["SEARCH_INDEX_PATH"])
+
+
 def load_critic_reviews():
 
     print "Critics"
@@ -511,13 +540,16 @@ if __name__ == "__main__":
     # load_franchises()
     # load_games(games_list)
     # load_reviews()
+    # load_similarities()
     # load_critic_reviews()
+    # load_game_stats()
     # load_covers(games_list)
     # load_videos(games_list)
     # load_screenshots(games_list)
     # load_game_genres(games_list)
     # load_game_devs(games_list)
     # load_game_platforms(platforms_list)
+    # load_search_index()
 
 
 
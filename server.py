@@ -2,14 +2,16 @@
 
 from jinja2 import StrictUndefined
 
-from flask import (Flask, render_template, redirect, request, flash, session, jsonify)
+from flask import (Flask, render_template, redirect, request, flash, session, jsonify,
+                   make_response, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_sqlalchemy import sqlalchemy
 from sqlalchemy.sql import func
 import json
-from math import ceil
+import os
 from datetime import datetime
 import helpers
+from search import CATEGORIES
 
 from model import (User, Game, Review, CriticReview, Platform, Developer,
                    Genre, Franchise, CurrentGame, connect_to_db, db)
@@ -22,6 +24,51 @@ app.secret_key = "khsgzcvwtriquhiwdjbsdjfgiuijasdbhfv"
 # Tells Jinja to raise an error when an undefined vairable is used
 app.jinja_env.undefined = StrictUndefined
 
+# Recommendation engine for this deployment: "pearson" neighbors or "factors"
+# from a model trained by factorization.py
+app.config["RECOMMENDER"] = os.environ.get("EXP_RECOMMENDER", "pearson")
+app.config["FACTORS_PATH"] = os.environ.get("EXP_FACTORS_PATH",
+                                            "static/data/factors.npz")
+
+# Users with fewer reviews than this get their cohort's popular games
+app.config["COLD_START_REVIEWS"] = int(os.environ.get("EXP_COLD_START_REVIEWS", 3))
+
+# Similar-user search in `precompute.py --workers`: "exact" ranks everyone
+# sharing a game with the user, "lsh" only the candidates an approximate
+# index returns. More tables raise recall; more bits per table make
+# lookups faster. Requests read the similarity index either way.
+app.config["NEIGHBOR_SEARCH"] = os.environ.get("EXP_NEIGHBOR_SEARCH", "exact")
+app.config["LSH_TABLES"] = int(os.environ.get("EXP_LSH_TABLES", 8))
+app.config["LSH_BITS"] = int(os.environ.get("EXP_LSH_BITS", 6))
+
+# The homepage's top rated lists are ranked in memory; reloaded from
+# game_stats after this many seconds to pick up other processes' reviews
+app.config["LEADERBOARD_MAX_AGE"] = int(os.environ.get("EXP_LEADERBOARD_MAX_AGE",
+                                                       600))
+
+# Trending games: review activity halves in weight every TRENDING_HALF_LIFE
+# seconds; rebuilt from reviews after TRENDING_MAX_AGE seconds
+app.config["TRENDING_HALF_LIFE"] = int(os.environ.get("EXP_TRENDING_HALF_LIFE",
+                                                      7 * 24 * 3600))
+app.config["TRENDING_MAX_AGE"] = int(os.environ.get("EXP_TRENDING_MAX_AGE", 600))
+
+# /search reads an in-memory "index", started from the snapshot search.py
+# writes when it is fresh and rebuilt from the database after SEARCH_MAX_AGE
+# seconds, or queries PostgreSQL with "trigram" once `python search.py
+# --migrate` has added its indexes. SEARCH_LIMIT results per category page.
+app.config["SEARCH_BACKEND"] = os.environ.get("EXP_SEARCH_BACKEND", "index")
+app.config["SEARCH_INDEX_PATH"] = os.environ.get("EXP_SEARCH_INDEX_PATH",
+                                                 "static/data/search_index.json")
+app.config["SEARCH_MAX_AGE"] = int(os.environ.get("EXP_SEARCH_MAX_AGE", 3600))
+app.config["SEARCH_LIMIT"] = int(os.environ.get("EXP_SEARCH_LIMIT", 20))
+
+# /search/suggest.json answers from a prefix index weighted by review counts,
+# rebuilt after SUGGEST_MAX_AGE seconds. Clients may ask for up to
+# SUGGEST_MAX_LIMIT suggestions, SUGGEST_LIMIT by default.
+app.config["SUGGEST_MAX_AGE"] = int(os.environ.get("EXP_SUGGEST_MAX_AGE", 300))
+app.config["SUGGEST_LIMIT"] = int(os.environ.get("EXP_SUGGEST_LIMIT", 8))
+app.config["SUGGEST_MAX_LIMIT"] = int(os.environ.get("EXP_SUGGEST_MAX_LIMIT", 20))
+
 ################################################################################
 # Routes
 
@@ -29,19 +76,12 @@ app.jinja_env.undefined = StrictUndefined
 def display_homepage():
     """Displays the homepage"""
 
-    user_reviews = (db.session.query(func.avg(Review.score).label("avg_score"), 
-                    Review.game_id).group_by(Review.game_id).order_by(func.avg(
-                    Review.score).desc()).limit(20).all())
-    critic_reviews = (db.session.query(func.avg(CriticReview.score).label("avg_score"), 
-                      CriticReview.game_id).group_by(CriticReview.game_id).order_by(
-                      func.avg(CriticReview.score).desc()).limit(20).all())
-    recent_reviews = (Review.query.order_by(Review.review_time.desc()).limit(20).all())
-    soon_list = (Game.query.filter(Game.release_date > datetime.now()).order_by(
-                 Game.release_date).limit(20).all())
-
-    user_list = helpers.assign_avg_score(user_reviews)
-    critic_list = helpers.assign_avg_score(critic_reviews)
-    recent_list = helpers.assign_avg_score(recent_reviews, recent=True)
+    # Shared by every visitor and cached; only the recommendations are per user
+    user_list = helpers.get_homepage_list("user_list")
+    critic_list = helpers.get_homepage_list("critic_list")
+    recent_list = helpers.get_homepage_list("recent_list")
+    soon_list = helpers.get_homepage_list("soon_list")
+    trending_list = helpers.get_homepage_list("trending_list")
 
     if session.get("user_id"):
         recommended_list = helpers.get_recommended_list(session["user_id"])
@@ -51,7 +91,7 @@ def display_homepage():
     return render_template("index.html", 
                            recommended_list=recommended_list, user_list=user_list,
                            critic_list=critic_list, recent_list=recent_list,
-                           soon_list=soon_list)
+                           soon_list=soon_list, trending_list=trending_list)
 
 
 @app.route("/signup", methods=["GET", "POST"])
@@ -71,6 +111,8 @@ def signup():
         db.session.add(user)
         db.session.commit()
 
+        helpers.index_new_user(user)
+
         # Set the session value with the user's ID
         session["user_id"] = user.user_id
 
@@ -92,10 +134,12 @@ def create_profile():
 
         # Get user in process, add info to DB row
         user = User.query.filter_by(user_id=session["user_id"]).first()
+        old_cohort = user.cohort
         user.fname = request.form.get("fname")
         user.lname = request.form.get("lname")
         user.age = request.form.get("age")
         user.gender = request.form.get("gender")
+        helpers.update_user_cohort(user, old_cohort)
         db.session.commit()
 
         flash("Your profile is complete!")
@@ -173,44 +217,73 @@ def validate_email():
 def display_results():
     """Displays paginated results of user search"""
 
-    search = request.args.get("search")
-    results = {}
+    search = request.args.get("search", "")
+    page = max(request.args.get("page", 1, type=int), 1)
+
+    # A category shows its own pages; otherwise the first page of each
+    category = request.args.get("category")
+    if category in CATEGORIES:
+        categories = (category,)
+    else:
+        category = None
+        page = 1
+        categories = CATEGORIES
+
+    results, more = helpers.get_search_results(search, app.config["SEARCH_LIMIT"],
+                                               page, categories)
 
-    results["users"] = (db.session.query(User.username, User.user_id).filter(
-                        User.username.ilike("%" + search + "%")).all())
-    results["games"] = Game.query.filter(Game.name.ilike("%" + search + "%")).all()
-    results["genres"] = Genre.query.filter(Genre.genre.ilike("%" + search + "%")).all()
-    results["franchises"] = (Franchise.query.filter(Franchise.name.ilike("%" + 
-                             search + "%")).all())
-    results["developers"] = (Developer.query.filter(Developer.name.ilike("%" + 
-                             search + "%")).all())
-    results["platforms"] = (Platform.query.filter(Platform.name.ilike("%" + 
-                            search + "%")).all())
+    return render_template("search.html", search=search, results=results,
+                           more=more, category=category, page=page)
 
-    return render_template("search.html", search=search, results=results)
+
+@app.route("/search/suggest.json")
+def suggest_search():
+    """Returns typeahead suggestions for the search box as JSON
+
+    Games, franchises, developers and platforms with a word starting with
+    q, most reviewed first.
+    """
+
+    prefix = request.args.get("q", "")
+    limit = request.args.get("limit", app.config["SUGGEST_LIMIT"], type=int)
+
+    return jsonify({"suggestions": helpers.get_suggestions(prefix, limit)})
 
 
 @app.route("/games/<game_id>")
 def display_game(game_id):
     """Returns game_details page for selected game_id"""
 
-    game = Game.query.filter_by(game_id=game_id).first()
-    reviews = Review.query.filter_by(game_id=game_id).all()
-
-    player_score = (db.session.query(func.avg(Review.score))
-                    .filter_by(game_id=game_id).first())
+    # Signed-in views show the user's own review and flashed messages, so
+    # only plain anonymous views are answered conditionally, and caches must
+    # keep copies apart by session cookie
+    version = None
+    if not session.get("user_id") and "_flashes" not in session:
+        version = helpers.get_game_version(game_id)
+        cached = helpers.not_modified(version)
+        if cached:
+            cached.vary.add("Cookie")
+            return cached
+
+    game = helpers.load_game_details(game_id)
+    reviews, next_cursor = helpers.get_review_page(
+        Review.query.filter_by(game_id=game_id)
+                    .options(sqlalchemy.orm.joinedload(Review.user)))
+
+    stats = game.stats
     critic_scores = (db.session.query(CriticReview.name, CriticReview.score,
                      CriticReview.link).filter_by(game_id=game_id).all())
 
-    num_pages = int(ceil(float(len(reviews)) / 9))
+    num_pages = helpers.count_pages(stats.num_reviews if stats else 0)
 
     videos = game.videos
 
-    critic_avg = 0
-    for review in critic_scores:
-        critic_avg += review[1]
-    if len(critic_scores) >= 1:
-        critic_avg = critic_avg / len(critic_scores)
+    if stats:
+        player_score = stats.avg_score
+        critic_avg = stats.critic_avg or 0
+    else:
+        player_score = None
+        critic_avg = 0
 
     if session.get("user_id"):
         user_id = session["user_id"]
@@ -223,29 +296,40 @@ def display_game(game_id):
         added = None
 
 
-    return render_template("game_details.html", game=game, reviews=reviews,
-                           player_score=player_score, critic_scores=critic_scores,
-                           num_pages=num_pages, current_review=current_review,
-                           added=added, videos=videos, critic_avg=critic_avg)
+    response = helpers.tag_response(make_response(render_template(
+        "game_details.html", game=game, reviews=reviews,
+        player_score=player_score, critic_scores=critic_scores,
+        num_pages=num_pages, current_review=current_review, added=added,
+        videos=videos, critic_avg=critic_avg, next_cursor=next_cursor)), version)
+    response.vary.add("Cookie")
+
+    return response
 
 
 @app.route("/review/<game_id>", methods=["POST"])
 def add_update_review(game_id):
 
     review = Review.query.filter_by(user_id=session["user_id"], game_id=game_id).first()
+    score = int(request.form.get("score"))
 
     if review:
-        review.score = request.form.get("score")
+        old_score = review.score
+        old_time = review.review_time
+        review.score = score
         review.comment = request.form.get("comment")
-        review.review_time = datetime.now()
+        review.review_time = datetime.utcnow()
         flash("Your rating has been updated.")
     else:
+        old_score = old_time = None
         review = Review(user_id=session["user_id"], game_id=game_id, 
-                        score=request.form.get("score"),
+                        score=score,
                         comment=request.form.get("comment"))
         db.session.add(review)
         flash("Your rating has been added.")
 
+    helpers.record_review_score(session["user_id"], game_id, old_score, score,
+                                old_time, review.review_time)
+
     db.session.commit()
 
     return redirect("/games/" + game_id)
@@ -256,9 +340,11 @@ def display_user(user_id):
     """Displays the user and all of their reviews"""
 
     user = User.query.filter_by(user_id=user_id).first()
-    reviews = Review.query.filter_by(user_id=user_id).all()
+    reviews, next_cursor = helpers.get_review_page(
+        Review.query.filter_by(user_id=user_id)
+                    .options(sqlalchemy.orm.joinedload(Review.game)))
 
-    num_pages = int(ceil(float(len(reviews)) / 9))
+    num_pages = helpers.count_pages(user.num_reviews)
 
     current_games = CurrentGame.query.filter_by(user_id=user_id).all()
 
@@ -268,53 +354,85 @@ def display_user(user_id):
         game.cover = game_item.covers[0]
 
     return render_template("user_details.html", user=user, reviews=reviews,
-                           num_pages=num_pages, current_games=current_games)
+                           num_pages=num_pages, current_games=current_games,
+                           next_cursor=next_cursor)
 
 
-@app.route("/genres/<genre_id>")
+@app.route("/genres/<int:genre_id>")
 def display_genre(genre_id):
-    """Displays the list of games for a given genre"""
+    """Displays a sorted page of the games for a given genre"""
 
     genre = Genre.query.filter_by(genre_id=genre_id).first()
+    if not genre:
+        abort(404)
 
-    return render_template("genre_details.html", genre=genre)
+    page = helpers.load_browse_page("genres", genre_id,
+                                    request.args.get("sort"),
+                                    request.args.get("after"))
 
+    return render_template("genre_details.html", genre=genre, **page)
 
-@app.route("/developers/<developer_id>")
+
+@app.route("/developers/<int:developer_id>")
 def display_developer(developer_id):
-    """Displays the list of games for a given developer"""
+    """Displays a sorted page of the games for a given developer"""
 
     developer = Developer.query.filter_by(developer_id=developer_id).first()
+    if not developer:
+        abort(404)
+
+    page = helpers.load_browse_page("developers", developer_id,
+                                    request.args.get("sort"),
+                                    request.args.get("after"))
 
-    return render_template("developer_details.html", developer=developer)
+    return render_template("developer_details.html", developer=developer, **page)
 
 
-@app.route("/franchises/<franchise_id>")
+@app.route("/franchises/<int:franchise_id>")
 def display_franchise(franchise_id):
-    """Displays the list of games for a given franchise"""
+    """Displays a sorted page of the games for a given franchise"""
 
     franchise = Franchise.query.filter_by(franchise_id=franchise_id).first()
+    if not franchise:
+        abort(404)
 
-    return render_template("franchise_details.html", franchise=franchise)
+    page = helpers.load_browse_page("franchises", franchise_id,
+                                    request.args.get("sort"),
+                                    request.args.get("after"))
 
+    return render_template("franchise_details.html", franchise=franchise, **page)
 
-@app.route("/platforms/<platform_id>")
+
+@app.route("/platforms/<int:platform_id>")
 def display_platform(platform_id):
-    """Displays the list of games for a given platform"""
+    """Displays a sorted page of the games for a given platform"""
 
     platform = Platform.query.filter_by(platform_id=platform_id).first()
+    if not platform:
+        abort(404)
+
+    page = helpers.load_browse_page("platforms", platform_id,
+                                    request.args.get("sort"),
+                                    request.args.get("after"))
 
-    return render_template("platform_details.html", platform=platform)
+    return render_template("platform_details.html", platform=platform, **page)
 
 
 @app.route("/get_game_reviews.json")
 def get_game_reviews():
-    """Returns json object of reviews for pagination"""
+    """Returns json object of a page of reviews and the next page's cursor"""
 
     game_id = int(request.args.get("gameId"))
-    max_reviews = int(request.args.get("maxReview"))
 
-    reviews = Review.query.filter_by(game_id=game_id).offset(max_reviews - 9).limit(9).all()
+    version = helpers.get_game_version(game_id)
+    cached = helpers.not_modified(version)
+    if cached:
+        return cached
+
+    reviews, next_cursor = helpers.get_review_page(
+        Review.query.filter_by(game_id=game_id)
+                    .options(sqlalchemy.orm.joinedload(Review.user)),
+        request.args.get("after"))
 
     cleaned_reviews = []
     for review in reviews:
@@ -323,17 +441,20 @@ def get_game_reviews():
                                 "score": review.score,
                                 "comment": review.comment})
 
-    return jsonify(cleaned_reviews)
+    return helpers.tag_response(jsonify({"reviews": cleaned_reviews,
+                                         "next": next_cursor}), version)
 
 
 @app.route("/get_user_reviews.json")
 def get_user_reviews():
-    """Returns json object of reviews for pagination"""
+    """Returns json object of a page of reviews and the next page's cursor"""
 
     user_id = int(request.args.get("userId"))
-    max_reviews = int(request.args.get("maxReview"))
 
-    reviews = Review.query.filter_by(user_id=user_id).offset(max_reviews - 9).limit(9).all()
+    reviews, next_cursor = helpers.get_review_page(
+        Review.query.filter_by(user_id=user_id)
+                    .options(sqlalchemy.orm.joinedload(Review.game)),
+        request.args.get("after"))
 
     cleaned_reviews = []
     for review in reviews:
@@ -342,7 +463,7 @@ def get_user_reviews():
                                 "score": review.score,
                                 "comment": review.comment})
 
-    return jsonify(cleaned_reviews)
+    return jsonify({"reviews": cleaned_reviews, "next": next_cursor})
 
 
 @app.route("/update_notes", methods=["POST"])
@@ -387,18 +508,24 @@ def publish_review():
     game_id = request.form.get("game_id")
     notes = request.form.get("notes")
     time_played = request.form.get("time_played")
-    score = request.form.get("score")
+    score = int(request.form.get("score"))
 
     comment = notes + "\n\nTime Played: " + str(time_played)
 
     prev_review = Review.query.filter_by(user_id=user_id, game_id=game_id).first()
     if prev_review:
+        old_score = prev_review.score
+        old_time = prev_review.review_time
         prev_review.score = score
         prev_review.comment = comment
     else:
+        old_score = old_time = None
         review = Review(user_id=user_id, game_id=game_id, score=score, comment=comment)
         db.session.add(review)
 
+    helpers.record_review_score(user_id, game_id, old_score, score, old_time,
+                                old_time)
+
     CurrentGame.query.filter_by(user_id=user_id, game_id=game_id).delete()
 
     db.session.commit()
@@ -412,25 +539,16 @@ def get_review_breakdown():
 
     game_id = request.args.get("gameId")
 
-    user_review_join = db.session.query(User.age, User.gender, Review.score).join(Review).filter_by(game_id=game_id)
-
-    datasets = helpers.sort_by_age_gender(user_review_join)
-
-    averages = {"m": [], "f": [], "tm": [], "tw":[], "nb": []}
+    version = helpers.get_game_version(game_id)
+    cached = helpers.not_modified(version)
+    if cached:
+        return cached
 
-    for gender in datasets:
-        for age_bracket in datasets[gender]:
-            total = 0
-            for user in age_bracket:
-                total += user[2]
-            if len(age_bracket) >= 1:
-                averages[gender].append(float(total) / len(age_bracket))
-            else:
-                averages[gender].append(0)
+    averages = helpers.get_demographic_averages(game_id)
 
     results = helpers.get_chart_dict(averages)
 
-    return jsonify(results)
+    return helpers.tag_response(jsonify(results), version)
 
 
 @app.route("/update_sort_pref", methods=["POST"])
@@ -442,12 +560,34 @@ def save_pref():
 
     user = User.query.filter_by(user_id=user_id).first()
     user.full_sort = bool(full_sort)
+    helpers.invalidate_recommendations([user.user_id], stored=True)
 
     db.session.commit()
 
     return jsonify("Done")
 
 
+@app.route("/trending.json")
+def get_trending_games():
+    """Returns the trending games with their decayed activity"""
+
+    games = [{"game_id": game.game_id, "name": game.name,
+              "cover_url": game.cover_url, "trend": game.trend,
+              "activity": game.activity, "avg_score": game.avg_score}
+             for game in helpers.get_homepage_list("trending_list")]
+
+    return jsonify({"games": games})
+
+
+@app.route("/cache_stats.json")
+def get_cache_stats():
+    """Returns hit/miss counters of the in-process caches for tuning"""
+
+    return jsonify({"recommendations": helpers.recommendation_cache.stats(),
+                    "homepage": helpers.homepage_cache.stats(),
+                    "search": helpers.search_cache.stats()})
+
+
 ################################################################################
 # Helper Functions
 
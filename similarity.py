@@ -0,0 +1,363 @@
+"""Sparse user x game score matrix used to find similar users"""
+
+import os
+
+import numpy as np
+
+from correlation import pearson_sums
+
+
+class RatingMatrix(object):
+    """Sparse user x game score matrix
+
+    Scores are kept as flat arrays twice: grouped by user, to read one user's
+    ratings, and grouped by game, to find everyone who reviewed a game. Users
+    and games are addressed by row/column index; user_ids and game_ids map
+    the indexes back to database ids.
+    """
+
+    # Everything needed to rebuild the matrix, see save() and load()
+    arrays = ("user_ids", "game_ids", "user_ptr", "user_games", "user_scores",
+              "game_ptr", "game_users", "game_scores")
+
+    def __init__(self, user_ids, game_ids, scores):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        game_ids = np.asarray(game_ids, dtype=np.int64)
+        scores = np.asarray(scores, dtype=float)
+
+        self.user_ids = np.unique(user_ids)
+        self.game_ids = np.unique(game_ids)
+
+        rows = np.searchsorted(self.user_ids, user_ids)
+        cols = np.searchsorted(self.game_ids, game_ids)
+
+        by_user = np.lexsort((cols, rows))
+        self.user_ptr = _pointers(rows[by_user], len(self.user_ids))
+        self.user_games = cols[by_user]
+        self.user_scores = scores[by_user]
+
+        by_game = np.lexsort((rows, cols))
+        self.game_ptr = _pointers(cols[by_game], len(self.game_ids))
+        self.game_users = rows[by_game]
+        self.game_scores = scores[by_game]
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        m = "<RatingMatrix users=%s games=%s reviews=%s>"
+        return m % (len(self.user_ids), len(self.game_ids), len(self.user_scores))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the matrix from (user_id, game_id, score) rows"""
+
+        if not rows:
+            return cls([], [], [])
+
+        user_ids, game_ids, scores = zip(*rows)
+
+        return cls(user_ids, game_ids, scores)
+
+    def save(self, directory):
+        """Writes the arrays to .npy files in directory, see load()"""
+
+        for name in RatingMatrix.arrays:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Opens a matrix written by save()
+
+        By default the arrays are memory-mapped read-only, so any number of
+        processes can share one copy through the OS page cache.
+        """
+
+        matrix = cls.__new__(cls)
+        for name in RatingMatrix.arrays:
+            setattr(matrix, name, np.load(os.path.join(directory, name + ".npy"),
+                                          mmap_mode=mmap_mode))
+
+        return matrix
+
+    def user_row(self, user_id):
+        """Returns the row index for user_id, or None if they have no reviews"""
+
+        row = np.searchsorted(self.user_ids, user_id)
+        if row < len(self.user_ids) and self.user_ids[row] == user_id:
+            return row
+
+        return None
+
+    def user_rows(self, user_ids):
+        """Row indexes of the given user_ids, skipping any without reviews"""
+
+        user_ids = np.asarray(sorted(user_ids), dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.user_ids, user_ids),
+                          max(len(self.user_ids) - 1, 0))
+
+        return rows[self.user_ids[rows] == user_ids]
+
+    def ratings(self, row):
+        """Returns (game columns, scores) for the user at row"""
+
+        start, end = self.user_ptr[row], self.user_ptr[row + 1]
+
+        return self.user_games[start:end], self.user_scores[start:end]
+
+    def pair_sums(self, user_id, candidates=None, rows=None):
+        """Running Pearson sums between user_id and every user sharing a game
+
+        Only the columns of games user_id reviewed are read, so the cost is
+        the number of co-reviews rather than the size of the matrix.
+        candidates is an optional boolean mask over rows restricting which
+        users may be matched. rows instead lists the only row indexes to
+        compare against, e.g. from a UserLSH, and bounds the cost by those
+        users' ratings when that is less than the co-reviews. Returns
+        (user_ids, sums) where sums holds the arrays (size, sum_user,
+        sum_other, squares_user, squares_other, product_sum) in the order
+        pearson_sums() takes them.
+        """
+
+        row = self.user_row(user_id)
+        if row is None:
+            empty = np.array([])
+            return np.array([], dtype=np.int64), (empty,) * 6
+
+        if rows is not None:
+            return self._candidate_sums(row, np.asarray(rows, dtype=np.int64))
+
+        games, own_scores = self.ratings(row)
+        starts = self.game_ptr[games]
+        lengths = self.game_ptr[games + 1] - starts
+
+        index = _ranges(starts, lengths)
+        others = self.game_users[index]
+        x = np.repeat(own_scores, lengths)
+        y = self.game_scores[index]
+
+        keep = others != row
+        if candidates is not None:
+            keep &= candidates[others]
+        others, x, y = others[keep], x[keep], y[keep]
+
+        size = len(self.user_ids)
+        count = np.bincount(others, minlength=size)
+        matched = np.flatnonzero(count)
+
+        def total(weights):
+            return np.bincount(others, weights=weights, minlength=size)[matched]
+
+        sums = (count[matched], total(x), total(y), total(x * x), total(y * y),
+                total(x * y))
+
+        return self.user_ids[matched], sums
+
+    def _candidate_sums(self, row, rows):
+        """pair_sums() against only the users at rows
+
+        Shared games are found from whichever side reads fewer entries: the
+        columns of user_id's games, keeping candidates, or the candidates'
+        own ratings, keeping user_id's games.
+        """
+
+        games, own_scores = self.ratings(row)
+        rows = np.unique(rows[rows != row])
+        if not len(rows):
+            empty = np.array([])
+            return np.array([], dtype=np.int64), (empty,) * 6
+
+        game_starts = self.game_ptr[games]
+        game_lengths = self.game_ptr[games + 1] - game_starts
+        starts = self.user_ptr[rows]
+        lengths = self.user_ptr[rows + 1] - starts
+
+        if game_lengths.sum() <= lengths.sum():
+            index = _ranges(game_starts, game_lengths)
+            reviewers = self.game_users[index]
+            # Which of rows each entry belongs to, if any
+            others = np.minimum(np.searchsorted(rows, reviewers), len(rows) - 1)
+            shared = rows[others] == reviewers
+            others = others[shared]
+            x = np.repeat(own_scores, game_lengths)[shared]
+            y = self.game_scores[index[shared]]
+        else:
+            index = _ranges(starts, lengths)
+            others = np.repeat(np.arange(len(rows)), lengths)
+            other_games = self.user_games[index]
+            # Where each game sits in user_id's ratings, -1 if unreviewed
+            where = np.full(len(self.game_ids), -1, dtype=np.int64)
+            where[games] = np.arange(len(games))
+            position = where[other_games]
+            shared = position >= 0
+            others = others[shared]
+            x = own_scores[position[shared]]
+            y = self.user_scores[index[shared]]
+
+        count = np.bincount(others, minlength=len(rows))
+        matched = np.flatnonzero(count)
+
+        def total(weights):
+            return np.bincount(others, weights=weights,
+                               minlength=len(rows))[matched]
+
+        sums = (count[matched], total(x), total(y), total(x * x), total(y * y),
+                total(x * y))
+
+        return self.user_ids[rows[matched]], sums
+
+    def similarities(self, user_id, candidates=None, rows=None):
+        """Pearson correlation between user_id and every user sharing a game
+
+        Returns (user_ids, correlations) arrays; see pair_sums().
+        """
+
+        user_ids, sums = self.pair_sums(user_id, candidates, rows)
+
+        return user_ids, pearson_sums(*sums)
+
+    def best_users(self, user_id, limit=5, candidates=None, rows=None):
+        """Returns the user_ids that correlate best with user_id, best first"""
+
+        user_ids, correlations = self.similarities(user_id, candidates, rows)
+
+        # Stable sort keeps ties in user_id order
+        order = np.argsort(-correlations, kind="mergesort")[:limit]
+
+        return [int(other) for other in user_ids[order]]
+
+    def recommend_games(self, user_id, limit=5, per_user=4, candidates=None,
+                        rows=None):
+        """Game ids recommended for user_id, best first
+
+        Mirrors helpers.recommend_games(): the top per_user games of each of
+        the limit best matching users, skipping games user_id reviewed, are
+        merged by game with weight sum((1 + correlation) * score).
+        """
+
+        user_ids, correlations = self.similarities(user_id, candidates, rows)
+        if not len(user_ids):
+            return []
+
+        order = np.argsort(-correlations, kind="mergesort")[:limit]
+        reviewed = self.ratings(self.user_row(user_id))[0]
+
+        weights = {}
+        for other_user, correlation in zip(user_ids[order], correlations[order]):
+            games, scores = self.ratings(self.user_row(other_user))
+            keep = ~np.in1d(games, reviewed)
+            games, scores = games[keep], scores[keep]
+
+            # Columns are in game_id order, so ties break as in the SQL
+            for top in np.argsort(-scores, kind="mergesort")[:per_user].tolist():
+                game_id = int(self.game_ids[games[top]])
+                weights[game_id] = (weights.get(game_id, 0) +
+                                    (1 + correlation) * scores[top])
+
+        return sorted(weights, key=lambda game_id: (-weights[game_id], game_id))
+
+
+def _pointers(sorted_index, size):
+    """Returns CSR-style offsets: entries for i live in [ptr[i], ptr[i + 1])"""
+
+    ptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sorted_index, minlength=size), out=ptr[1:])
+
+    return ptr
+
+
+def _ranges(starts, lengths):
+    """Concatenates arange(start, start + length) for each pair"""
+
+    offsets = np.cumsum(lengths) - lengths
+
+    return (np.arange(lengths.sum()) - np.repeat(offsets, lengths) +
+            np.repeat(starts, lengths))
+
+
+class UserLSH(object):
+    """Approximate nearest-neighbor index over user rating vectors
+
+    Random-projection LSH: each mean-centered rating vector is projected onto
+    tables x bits random hyperplanes, and the signs in each table form a
+    bucket key. Users whose scores point the same way tend to share a
+    bucket, so candidates() returns likely neighbors without comparing
+    against every user. More tables raise recall; more bits per table make
+    buckets smaller and lookups faster.
+
+    Each game's hyperplane components are derived from its id, so indexes
+    built in different processes agree.
+    """
+
+    def __init__(self, tables=8, bits=6, seed=0):
+        self.tables = tables
+        self.bits = bits
+        self.seed = seed
+
+        self.buckets = [{} for _ in range(tables)]
+        self.keys = {}
+
+        self._planes = {}
+        self._powers = 2 ** np.arange(bits)
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        l = "<UserLSH tables=%s bits=%s users=%s>"
+        return l % (self.tables, self.bits, len(self.keys))
+
+    @classmethod
+    def from_rows(cls, rows, **options):
+        """Builds the index from (user_id, game_id, score) rows"""
+
+        index = cls(**options)
+        size = index.tables * index.bits
+
+        # Per user: [sum of score * plane, sum of plane, sum of scores, count]
+        sums = {}
+        for user_id, game_id, score in rows:
+            user_sums = sums.get(user_id)
+            if user_sums is None:
+                user_sums = [np.zeros(size), np.zeros(size), 0.0, 0]
+                sums[user_id] = user_sums
+
+            plane = index.plane(game_id)
+            user_sums[0] += score * plane
+            user_sums[1] += plane
+            user_sums[2] += score
+            user_sums[3] += 1
+
+        for user_id, (scores, planes, total, count) in sums.items():
+            index._add(user_id, scores - (total / count) * planes)
+
+        return index
+
+    def plane(self, game_id):
+        """Hyperplane components for game_id, the same in every process"""
+
+        plane = self._planes.get(game_id)
+        if plane is None:
+            rand = np.random.RandomState((self.seed * 1000003 + game_id) % 2 ** 32)
+            plane = rand.normal(size=self.tables * self.bits)
+            self._planes[game_id] = plane
+
+        return plane
+
+    def _add(self, user_id, projection):
+        """Puts user_id in the bucket of each table their projection hashes to"""
+
+        signs = (projection > 0).reshape(self.tables, self.bits)
+        keys = signs.dot(self._powers).tolist()
+
+        for table, key in enumerate(keys):
+            self.buckets[table].setdefault(key, set()).add(user_id)
+        self.keys[user_id] = keys
+
+    def candidates(self, user_id):
+        """Users sharing at least one bucket with user_id"""
+
+        found = set()
+        for table, key in enumerate(self.keys.get(user_id, ())):
+            found.update(self.buckets[table][key])
+        found.discard(user_id)
+
+        return found
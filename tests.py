@@ -1,14 +1,58 @@
 import unittest
 
 from server import app
-from model import (db, connect_to_db, example_data, User, Review, CriticReview,
-                   Game, CurrentGame, Cover, Franchise, Genre, Developer,
-                   Platform, Screenshot)
+from model import (db, connect_to_db, example_data, example_sequel, User,
+                   Review, CriticReview, Game, CurrentGame, Cover, Franchise,
+                   Genre, Developer, Platform, Screenshot, Recommendation,
+                   UserSimilarity, CohortPopularGame, GameStats,
+                   build_similarity_index, build_game_stats, count_user_reviews,
+                   Video, GameGenre, GameDeveloper, GamePlatform)
 
+import numpy as np
 from correlation import pearson
+from similarity import RatingMatrix, UserLSH
+from cache import LRUCache, RefreshingCache
+from leaderboard import Leaderboard
+from trending import TrendingGames
+from search import SearchIndex, PrefixIndex
+import search
+from factorization import FactorModel
+import factorization
+import benchmark
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import pull_data
 import datetime
 import gen_fake_data
+import precompute
+import helpers
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+
+
+def count_queries(func):
+    """Runs func and returns how many SQL statements it executed"""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # Every engine, since each connect_to_db() call in a test run makes one
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        func()
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+    return len(statements)
+
 
 class RouteIntegrationTests(unittest.TestCase):
     """Tests for the app routes and URL paths"""
@@ -20,6 +64,17 @@ class RouteIntegrationTests(unittest.TestCase):
         connect_to_db(app, "postgresql:///testdb")
         db.create_all()
         example_data()
+        helpers.recommendation_cache.clear()
+        helpers.homepage_cache.clear()
+        helpers.homepage_cache.background = False
+        helpers._leaderboards.clear()
+        helpers._trending.clear()
+        helpers._search_index.clear()
+        helpers._suggest_index.clear()
+        helpers._search_snapshot.clear()
+        helpers.search_cache.clear()
+        helpers.browse_count_cache.clear()
+        app.config["SEARCH_INDEX_PATH"] = ""
 
     def tearDown(self):
         db.session.close()
@@ -29,6 +84,236 @@ class RouteIntegrationTests(unittest.TestCase):
         result = self.client.get("/")
         self.assertIn("Popular with Our Users", result.data)
 
+    def test_homepage_query_budget(self):
+        for game_id in range(2, 42):
+            db.session.add(Game(game_id=game_id, name="Game %d" % game_id,
+                                release_date=datetime.datetime(2030, 1, 1)))
+        db.session.commit()
+        for game_id in range(2, 42):
+            db.session.add(Cover(game_id=game_id, url="///%d.png" % game_id,
+                                 width=360, height=240))
+            db.session.add(Review(user_id=1 + game_id % 3, game_id=game_id,
+                                  score=50 + game_id))
+            db.session.add(CriticReview(game_id=game_id, critic_code='ign',
+                                        score=game_id * 2, name="IGN", link="fake"))
+        db.session.commit()
+        build_game_stats()
+        count_user_reviews()
+
+        result = []
+        queries = count_queries(lambda: result.append(self.client.get("/")))
+        self.assertIn("///41.png", result[0].data)
+        self.assertLessEqual(queries, 9)
+
+        # Shared lists are cached; only the recommendations are per user
+        self.assertEqual(count_queries(lambda: self.client.get("/")), 0)
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 1
+        queries = count_queries(lambda: self.client.get("/"))
+        self.assertLessEqual(queries, 5)
+
+    def test_game_details_query_budget(self):
+        for index in range(2, 12):
+            db.session.add(User(username='u%d' % index, password='x',
+                                email='u%d@test.com' % index, age=20, gender='f'))
+            db.session.add(Genre(genre="genre %d" % index))
+            db.session.add(Developer(name="dev %d" % index))
+            db.session.add(Platform(name="platform %d" % index))
+        db.session.commit()
+        for index in range(2, 12):
+            db.session.add(Review(user_id=index + 2, game_id=1, score=70))
+            db.session.add(Cover(game_id=1, url="///%d.png" % index,
+                                 width=360, height=240))
+            db.session.add(Screenshot(game_id=1, url="///s%d.png" % index,
+                                      width=260, height=240))
+            db.session.add(Video(game_id=1, name="Video %d" % index,
+                                 slug="v%d" % index))
+            db.session.add(GameGenre(game_id=1, genre_id=index))
+            db.session.add(GameDeveloper(game_id=1, developer_id=index))
+            db.session.add(GamePlatform(game_id=1, platform_id=index))
+        db.session.commit()
+        build_game_stats()
+        db.session.expunge_all()
+
+        result = []
+        queries = count_queries(lambda: result.append(self.client.get("/games/1")))
+        self.assertIn("platform 11", result[0].data)
+        self.assertIn("u11", result[0].data)
+        # Including the game_stats read for the ETag
+        self.assertLessEqual(queries, 10)
+
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 1
+        queries = count_queries(lambda: self.client.get("/games/1"))
+        self.assertLessEqual(queries, 11)
+
+    def test_homepage_recommendations(self):
+        example_sequel()
+        build_game_stats()
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 1
+        result = self.client.get("/")
+        self.assertIn("Recommended for You", result.data)
+        self.assertIn("Sequel", result.data)
+
+    def test_homepage_factor_recommendations(self):
+        example_sequel()
+        build_game_stats()
+        directory = tempfile.mkdtemp()
+        app.config["RECOMMENDER"] = "factors"
+        app.config["FACTORS_PATH"] = os.path.join(directory, "factors.npz")
+        try:
+            factorization.train_from_db(app.config["FACTORS_PATH"])
+            with self.client as c:
+                with c.session_transaction() as test_session:
+                    test_session['user_id'] = 1
+            result = self.client.get("/")
+            self.assertIn("Recommended for You", result.data)
+            self.assertIn("Sequel", result.data)
+        finally:
+            app.config["RECOMMENDER"] = "pearson"
+            shutil.rmtree(directory)
+
+    def test_recommendation_cache(self):
+        example_sequel(reviews=())
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 1
+        self.client.get("/")
+        self.client.get("/")
+        stats = helpers.recommendation_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+        # User 2's new review changes what user 1 is recommended
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 2
+        self.client.post("/review/2", data={"score": 90, "comment": "BLAH"})
+        self.assertEqual(helpers.recommendation_cache.stats()["invalidations"], 1)
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 1
+        self.assertIn("Sequel", self.client.get("/").data)
+
+        result = self.client.get("/cache_stats.json")
+        self.assertIn("hit_rate", result.data)
+
+    def test_homepage_list_cache(self):
+        example_sequel(reviews=())
+        self.assertNotIn("Sequel", self.client.get("/").data)
+
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 3
+        self.client.post("/review/2", data={"score": 90, "comment": "BLAH"})
+
+        # The stale lists are served while they are rebuilt
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                del test_session['user_id']
+        self.assertNotIn("Sequel", self.client.get("/").data)
+        self.assertIn("Sequel", self.client.get("/").data)
+
+        stats = json.loads(self.client.get("/cache_stats.json").data)["homepage"]
+        self.assertEqual((stats["misses"], stats["invalidations"]), (5, 3))
+
+    def test_leaderboards(self):
+        for game_id in range(2, 6):
+            db.session.add(Game(game_id=game_id, name="Game %d" % game_id,
+                                release_date=datetime.datetime.now()))
+        db.session.commit()
+        self.client.get("/")
+
+        for user_id, game_id, score in [(3, 2, 90), (3, 3, 70), (2, 3, 95),
+                                        (3, 2, 100), (1, 4, 95), (3, 1, 50)]:
+            with self.client as c:
+                with c.session_transaction() as test_session:
+                    test_session['user_id'] = user_id
+            self.client.post("/review/%d" % game_id,
+                             data={"score": score, "comment": "BLAH"})
+
+        with app.test_request_context():
+            self.assertEqual(helpers.check_leaderboards(), {})
+            self.assertEqual(helpers.get_leaderboard("players").top(2),
+                             [(2, 100.0), (4, 95.0)])
+
+    def test_trending(self):
+        for game_id in range(2, 5):
+            db.session.add(Game(game_id=game_id, name="Game %d" % game_id,
+                                release_date=datetime.datetime.now()))
+        db.session.add(Review(user_id=3, game_id=4, score=100,
+                              review_time=datetime.datetime(2000, 1, 1)))
+        db.session.commit()
+        self.assertIn("Trending This Week", self.client.get("/").data)
+
+        for user_id, game_id, score in [(1, 2, 60), (2, 2, 70), (3, 3, 100)]:
+            with self.client as c:
+                with c.session_transaction() as test_session:
+                    test_session['user_id'] = user_id
+            self.client.post("/review/%d" % game_id,
+                             data={"score": score, "comment": "BLAH"})
+
+        self.client.get("/trending.json")
+        games = json.loads(self.client.get("/trending.json").data)["games"]
+        self.assertEqual([game["game_id"] for game in games], [1, 2, 3])
+        self.assertAlmostEqual(games[1]["activity"], 2, places=3)
+        self.assertAlmostEqual(games[1]["avg_score"], 65, places=3)
+
+        # An edit replaces the review's event rather than adding one, so
+        # the ranking agrees with a rebuild from the reviews table
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 2
+        self.client.post("/review/2", data={"score": 90, "comment": "BLAH"})
+        self.client.post("/publish_review", data={"user_id": 1, "game_id": 2,
+                         "notes": "BLAH", "time_played": 2, "score": 80})
+        with app.test_request_context():
+            edited = helpers.get_trending().top(now=time.time())
+            helpers._trending.clear()
+            rebuilt = helpers.get_trending().top(now=time.time())
+        self.assertEqual([row[0] for row in edited], [row[0] for row in rebuilt])
+        self.assertEqual(edited[1][0], 2)
+        self.assertAlmostEqual(edited[1][2], 2, places=3)
+        self.assertAlmostEqual(edited[1][3], 85, places=3)
+        for row, expected in zip(edited, rebuilt):
+            for value, expected_value in zip(row[1:], expected[1:]):
+                self.assertAlmostEqual(value, expected_value, places=3)
+
+    def test_precomputed_empty_recommendations(self):
+        # User 1's only neighbor has no games user 1 hasn't reviewed
+        app.config["COLD_START_REVIEWS"] = 0
+        try:
+            precompute.precompute_recommendations()
+            precompute.precompute_popular()
+            self.assertEqual(Recommendation.query.count(), 0)
+
+            with app.test_request_context():
+                stored = count_queries(lambda: helpers.load_recommended_list(1))
+                helpers.invalidate_recommendations([1], stored=True)
+                db.session.commit()
+                self.assertIsNone(User.query.get(1).recommended_at)
+                live = count_queries(lambda: helpers.load_recommended_list(1))
+
+            # The stored result is trusted: user, stored list, popular games
+            self.assertEqual(stored, 3)
+            self.assertGreater(live, stored)
+        finally:
+            app.config["COLD_START_REVIEWS"] = 3
+
+    def test_homepage_cold_start(self):
+        example_sequel()
+        build_game_stats()
+        precompute.precompute_popular()
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 3
+        result = self.client.get("/")
+        self.assertIn("Recommended for You", result.data)
+        self.assertIn("Sequel", result.data)
+
     def test_login_page(self):
         result = self.client.get("/login")
         self.assertIn("Username:", result.data)
@@ -87,6 +372,17 @@ class RouteIntegrationTests(unittest.TestCase):
         self.assertIn("Popular with Our Users", result.data)
         self.assertNotIn("Age:", result.data)
 
+    def test_create_profile_cohort(self):
+        data = {'fname': 'Test', "lname": "O", "age": 45, "gender": "nb_gf"}
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 1
+        self.client.post("/create_profile", data=data)
+        self.assertEqual(User.query.get(1).cohort, "nb_gf:40")
+        self.assertEqual(UserSimilarity.query.filter_by(other_id=1).first().other_cohort,
+                         "nb_gf:40")
+        self.assertEqual(User.query.get(2).recommend(), None)
+
     def test_valid_username_fail(self):
         username = User.query.first().username
         result = self.client.get("/valid_username.json",
@@ -107,6 +403,150 @@ class RouteIntegrationTests(unittest.TestCase):
         self.assertIn("Testo Games", result.data)
         self.assertNotIn("boolean", result.data)
 
+    def test_search_ranked(self):
+        for index in range(3):
+            db.session.add(Game(game_id=10 + index, name="Testo Saga %d" % index,
+                                release_date=datetime.datetime.now()))
+        db.session.commit()
+
+        result = self.client.get("/search", query_string={"search": "testo"})
+        self.assertLess(result.data.index(">Testo</a>"),
+                        result.data.index(">Testo Saga 0</a>"))
+        self.assertIn("Testo Stories", result.data)
+        self.assertIn("testo</a>", result.data)
+
+        app.config["SEARCH_LIMIT"] = 2
+        try:
+            result = self.client.get("/search", query_string={"search": "testo"})
+        finally:
+            app.config["SEARCH_LIMIT"] = 20
+        self.assertIn("Testo Saga 0", result.data)
+        self.assertNotIn("Testo Saga 1", result.data)
+        self.assertIn("category=games&page=2", result.data)
+
+    def test_search_group_games(self):
+        for index in range(8):
+            db.session.add(Game(game_id=10 + index, name="Zed %d" % index,
+                                release_date=datetime.datetime.now()))
+        db.session.commit()
+        for index in range(8):
+            db.session.add(GamePlatform(game_id=10 + index, platform_id=1))
+        db.session.commit()
+
+        result = self.client.get("/search", query_string={"search": "testo360"})
+        self.assertIn("<span>Zed 3 </span>", result.data)
+        self.assertNotIn("Zed 4", result.data)
+        self.assertIn('<a href="/platforms/1">All 9 games</a>', result.data)
+
+    def test_search_category_pages(self):
+        for index in range(3):
+            db.session.add(Game(game_id=10 + index, name="Testo Saga %d" % index,
+                                release_date=datetime.datetime.now()))
+        db.session.commit()
+
+        app.config["SEARCH_LIMIT"] = 2
+        try:
+            result = self.client.get("/search", query_string={
+                "search": "saga", "category": "games", "page": 2})
+        finally:
+            app.config["SEARCH_LIMIT"] = 20
+        self.assertIn("Testo Saga 2", result.data)
+        self.assertNotIn("Testo Saga 1", result.data)
+        self.assertIn("Previous", result.data)
+        self.assertNotIn("Next", result.data)
+
+        # Only the chosen category is searched
+        result = self.client.get("/search", query_string={
+            "search": "testo", "category": "platforms"})
+        self.assertIn("Testo360", result.data)
+        self.assertNotIn("Testo Stories", result.data)
+
+    def test_search_cache(self):
+        self.client.get("/search", query_string={"search": "testo"})
+
+        results = []
+        queries = count_queries(lambda: results.append(self.client.get(
+            "/search", query_string={"search": "  TESTO "})))
+        self.assertIn("Testo Stories", results[0].data)
+        self.assertEqual(queries, 0)
+
+        stats = json.loads(self.client.get("/cache_stats.json").data)["search"]
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_search_query_budget(self):
+        for index in range(2, 12):
+            db.session.add(Game(game_id=index, name="Testo %d" % index,
+                                release_date=datetime.datetime.now(),
+                                franchise_id=1))
+            db.session.add(Genre(genre="testo genre %d" % index))
+        db.session.commit()
+        self.client.get("/search", query_string={"search": "zzz"})
+
+        result = []
+        queries = count_queries(lambda: result.append(self.client.get(
+            "/search", query_string={"search": "testo"})))
+        self.assertIn("Testo 11", result[0].data)
+        self.assertIn("testo genre 11", result[0].data)
+        # Game summaries and the games of each group category
+        self.assertLessEqual(queries, 5)
+
+    def test_search_reseed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "search.json")
+            app.config["SEARCH_INDEX_PATH"] = path
+            search.build_from_db(path)
+            self.assertNotIn("Testo Redux", self.client.get(
+                "/search", query_string={"search": "testo"}).data)
+
+            db.session.add(Game(game_id=2, name="Testo Redux",
+                                release_date=datetime.datetime.now()))
+            db.session.commit()
+            search.build_from_db(path)
+            os.utime(path, (time.time() + 10, time.time() + 10))
+
+            result = self.client.get("/search", query_string={"search": "testo"})
+            self.assertIn("Testo Redux", result.data)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_search_new_user(self):
+        self.client.get("/search", query_string={"search": "zed"})
+        self.client.post("/signup", data={"username": "zedd", "password": "z",
+                                          "email": "z@test.com"})
+        result = self.client.get("/search", query_string={"search": "zed"})
+        self.assertIn("zedd", result.data)
+
+    def test_search_suggest(self):
+        result = self.client.get("/search/suggest.json", query_string={"q": "tes"})
+        suggestions = json.loads(result.data)["suggestions"]
+        self.assertEqual(sorted(item["url"] for item in suggestions),
+                         ["/developers/1", "/franchises/1", "/games/1",
+                          "/platforms/1"])
+        # All share game 1's reviews, so shorter names come first
+        self.assertEqual([item["name"] for item in suggestions],
+                         ["Testo", "Testo360", "Testo Games", "Testo Stories"])
+
+        # A more reviewed game outranks them
+        db.session.add(Game(game_id=2, name="Testament",
+                            release_date=datetime.datetime.now()))
+        for user_id in range(1, 4):
+            db.session.add(Review(user_id=user_id, game_id=2, score=50))
+        db.session.commit()
+        build_game_stats()
+        helpers._suggest_index.clear()
+        result = self.client.get("/search/suggest.json", query_string={"q": "tes"})
+        suggestions = json.loads(result.data)["suggestions"]
+        self.assertEqual(suggestions[0]["url"], "/games/2")
+
+        result = self.client.get("/search/suggest.json",
+                                 query_string={"q": "stor", "limit": 1})
+        suggestions = json.loads(result.data)["suggestions"]
+        self.assertEqual([item["name"] for item in suggestions], ["Testo Stories"])
+
+        result = self.client.get("/search/suggest.json", query_string={"q": "zz"})
+        self.assertEqual(json.loads(result.data)["suggestions"], [])
+
     def test_game_details(self):
         game_id = 1
         result = self.client.get("/games/" + str(game_id))
@@ -141,6 +581,61 @@ class RouteIntegrationTests(unittest.TestCase):
         self.assertNotIn("Your rating has been added", result.data)
         self.assertIn("Your rating has been updated", result.data)
 
+    def test_review_updates_similarity(self):
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 3
+        self.client.post("/review/1", data={"score": 80, "comment": "BLAH"})
+        self.client.post("/review/1", data={"score": 60, "comment": "BLAH"})
+        self.client.post("/publish_review", data={"user_id": 1, "game_id": 1,
+                         "notes": "BLAH", "time_played": 2, "score": 70})
+
+        def index():
+            return {(pair.user_id, pair.other_id):
+                    [getattr(pair, column) for column in UserSimilarity.sum_columns]
+                    for pair in UserSimilarity.query.all()}
+
+        indexed = index()
+        build_similarity_index()
+        rebuilt = index()
+
+        self.assertEqual(sorted(indexed), sorted(rebuilt))
+        self.assertIn((3, 1), indexed)
+        for pair in rebuilt:
+            for value, expected in zip(indexed[pair], rebuilt[pair]):
+                self.assertAlmostEqual(value, expected)
+
+    def test_review_updates_game_stats(self):
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 3
+        self.client.post("/review/1", data={"score": 80, "comment": "BLAH"})
+        self.client.post("/review/1", data={"score": 65, "comment": "BLAH"})
+        self.client.post("/publish_review", data={"user_id": 1, "game_id": 1,
+                         "notes": "BLAH", "time_played": 2, "score": 70})
+
+        stats = GameStats.query.get(1)
+        self.assertEqual((stats.num_reviews, stats.score_sum), (3, 230))
+        self.assertAlmostEqual(stats.avg_score, 230 / 3.0)
+
+        build_game_stats()
+        rebuilt = GameStats.query.get(1)
+        self.assertEqual((rebuilt.num_reviews, rebuilt.score_sum,
+                          rebuilt.num_critics, rebuilt.critic_avg),
+                         (3, 230, 1, 100.0))
+
+    def test_first_review_creates_game_stats(self):
+        example_sequel(reviews=())
+        for user_id, score in [(3, 80), (3, 60), (1, 90)]:
+            with self.client as c:
+                with c.session_transaction() as test_session:
+                    test_session['user_id'] = user_id
+            self.client.post("/review/2", data={"score": score, "comment": "BLAH"})
+
+        stats = GameStats.query.get(2)
+        self.assertEqual((stats.num_reviews, stats.score_sum), (2, 150))
+        self.assertAlmostEqual(stats.avg_score, 75.0)
+
     def test_user_details(self):
         result = self.client.get("/users/1")
         self.assertIn("testo", result.data)
@@ -166,20 +661,151 @@ class RouteIntegrationTests(unittest.TestCase):
         self.assertIn(Platform.query.first().name, result.data)
         self.assertIn(Platform.query.first().games[0].name, result.data)
 
+    def test_browse_pages(self):
+        start = datetime.datetime(2000, 1, 1)
+        for index in range(2, 32):
+            db.session.add(Game(game_id=index, name="Game %d" % index,
+                                release_date=start + datetime.timedelta(days=index),
+                                franchise_id=1))
+        db.session.commit()
+        for index in range(2, 32):
+            db.session.add(GameGenre(game_id=index, genre_id=1))
+        # Only the even games get reviews
+        for index in range(2, 32, 2):
+            db.session.add(Review(user_id=1, game_id=index, score=50 + index))
+        db.session.commit()
+        build_game_stats()
+
+        def walk(sort):
+            seen = []
+            after = None
+            while True:
+                games, after = helpers.get_browse_page("genres", 1, sort, after,
+                                                       limit=7)
+                seen.extend(card.game_id for card in games)
+                if not after:
+                    return seen
+
+        self.assertEqual(walk("release"), [1] + range(31, 1, -1))
+        # Reviewed games by score, then the unreviewed ones newest game_id first
+        self.assertEqual(walk("score"), [1] + range(30, 1, -2) + range(31, 2, -2))
+
+        result = self.client.get("/genres/1", query_string={"sort": "score"})
+        self.assertIn("31 games", result.data)
+        self.assertIn("Game 30", result.data)
+        self.assertNotIn(">Game 3<", result.data)
+
+        # Deeper pages cost the same; the count is cached
+        after = result.data.split("after=")[1].split('"')[0]
+        results = []
+        queries = count_queries(lambda: results.append(self.client.get(
+            "/genres/1?sort=score&after=" + after)))
+        self.assertIn(">Game 3<", results[0].data)
+        # The genre, then the page's reviewed and unreviewed games
+        self.assertLessEqual(queries, 3)
+
+        result = self.client.get("/franchises/1", query_string={"sort": "bogus"})
+        self.assertIn("31 games", result.data)
+        self.assertLess(result.data.index(">Game 31<"), result.data.index(">Game 30<"))
+
+    def test_bad_browse_requests(self):
+        for url in ["/genres/x", "/developers/1.5", "/franchises/", "/platforms/99"]:
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+        for sort, after in [("release", "x"), ("release", "yesterday_1"),
+                            ("score", "high_1"), ("critic", "95.0_x")]:
+            result = self.client.get("/genres/1", query_string={"sort": sort,
+                                                                "after": after})
+            self.assertEqual(result.status_code, 400)
+
     def test_get_game_reviews(self):
-        data = {"gameId": 1, "maxReview": 10}
+        data = {"gameId": 1}
         result = self.client.get("/get_game_reviews.json",
                                  query_string=data)
         self.assertIn("testo", result.data)
         self.assertNotIn("[]", result.data)
 
     def test_get_user_reviews(self):
-        data = {"userId": 1, "maxReview": 10}
+        data = {"userId": 1}
         result = self.client.get("/get_user_reviews.json",
                                  query_string=data)
         self.assertIn("Testo", result.data)
         self.assertNotIn("[]", result.data)
 
+    def test_bad_review_cursor(self):
+        for after in ["garbage", "2017-01-01T00:00:00.000000_x", "x_1", "_"]:
+            result = self.client.get("/get_game_reviews.json",
+                                     query_string={"gameId": 1, "after": after})
+            self.assertEqual(result.status_code, 400)
+            result = self.client.get("/get_user_reviews.json",
+                                     query_string={"userId": 1, "after": after})
+            self.assertEqual(result.status_code, 400)
+
+    def test_conditional_get(self):
+        url = "/get_game_reviews.json?gameId=1"
+        result = self.client.get(url)
+        etag = result.headers["ETag"]
+        self.assertTrue(result.headers["Last-Modified"])
+        self.assertIn("no-cache", result.headers["Cache-Control"])
+
+        results = []
+        queries = count_queries(lambda: results.append(
+            self.client.get(url, headers={"If-None-Match": etag})))
+        self.assertEqual(results[0].status_code, 304)
+        self.assertEqual(results[0].data, "")
+        self.assertEqual(queries, 1)
+
+        result = self.client.get("/get_review_breakdown?gameId=1", headers={
+            "If-Modified-Since": result.headers["Last-Modified"]})
+        self.assertEqual(result.status_code, 304)
+        result = self.client.get("/games/1", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertIn("no-cache", result.headers["Cache-Control"])
+        self.assertIn("Cookie", result.headers["Vary"])
+
+        # A review write changes the version
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 3
+        result = self.client.get("/games/1", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("Cookie", result.headers["Vary"])
+        self.client.post("/review/1", data={"score": 80, "comment": "BLAH"})
+        result = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers["ETag"], etag)
+
+    def test_review_keyset_pages(self):
+        when = datetime.datetime(2017, 1, 1)
+        for game_id in range(2, 22):
+            db.session.add(Game(game_id=game_id, name="Game %d" % game_id,
+                                release_date=when))
+        db.session.commit()
+        for game_id in range(2, 22):
+            # Pairs of reviews share a timestamp; review_id breaks the tie
+            db.session.add(Review(user_id=3, game_id=game_id, score=70,
+                                  review_time=when + datetime.timedelta(
+                                      minutes=game_id / 2)))
+        db.session.commit()
+        count_user_reviews()
+        self.assertEqual(helpers.count_pages(User.query.get(3).num_reviews), 3)
+
+        pages = []
+        after = None
+        while True:
+            data = {"userId": 3}
+            if after:
+                data["after"] = after
+            result = json.loads(self.client.get("/get_user_reviews.json",
+                                                query_string=data).data)
+            pages.append([review["game_id"] for review in result["reviews"]])
+            after = result["next"]
+            if not after:
+                break
+
+        self.assertEqual([len(page) for page in pages], [9, 9, 2])
+        self.assertEqual(sum(pages, []), range(21, 1, -1))
+
     def test_update_notes(self):
         data = {"user_id": 1, "game_id": 1, "notes": "BLAH", "time_played": 2}
         result = self.client.post("/update_notes", data=data)
@@ -201,6 +827,30 @@ class RouteIntegrationTests(unittest.TestCase):
         self.assertIn("10-19", result.data)
         self.assertNotIn("[]", result.data)
 
+    def test_review_breakdown_histogram(self):
+        def breakdown():
+            result = self.client.get("/get_review_breakdown",
+                                     query_string={"gameId": 1})
+            return dict((dataset["label"], dataset["data"]) for dataset in
+                        json.loads(result.data)["datasets"])
+
+        self.assertEqual(breakdown()["Nonbinary"], [0, 0, 95, 0])
+
+        with self.client as c:
+            with c.session_transaction() as test_session:
+                test_session['user_id'] = 3
+        self.client.post("/review/1", data={"score": 80, "comment": "BLAH"})
+        self.assertEqual(breakdown()["Nonbinary"], [0, 0, 90, 0])
+
+        self.client.post("/create_profile", data={"fname": "I", "lname": "C",
+                                                  "age": 45, "gender": "f"})
+        moved = breakdown()
+        self.assertEqual(moved["Nonbinary"], [0, 0, 95, 0])
+        self.assertEqual(moved["Cis Women"], [0, 0, 0, 80])
+
+        build_game_stats()
+        self.assertEqual(breakdown(), moved)
+
 
 class DatabaseTests(unittest.TestCase):
     """Tests for db units (seed methods/user methods) and integration"""
@@ -240,8 +890,12 @@ class DatabaseTests(unittest.TestCase):
             "<Developer developer_id=1 name=Testo Games>")
         self.assertEqual(repr(Platform.query.first()),
             "<Platform platform_id=1 name=Testo360>")
+        self.assertEqual(repr(GameStats.query.first()),
+            "<GameStats game_id=1 num_reviews=2 avg_score=95.0 critic_avg=100.0>")
         self.assertEqual(repr(Screenshot.query.first()),
             "<Screenshot screenshot_id=1 game_id=1 url=///test.png>")
+        self.assertEqual(repr(UserSimilarity.query.filter_by(user_id=1).first()),
+            "<UserSimilarity user_id=1 other_id=2 size=1 correlation=0.0>")
 
     def test_relationships(self):
         """Tests the relationships between the tables"""
@@ -266,6 +920,122 @@ class DatabaseTests(unittest.TestCase):
         self.assertEqual(user2.recommend(), [1])
         self.assertEqual(user3.recommend(), None)
 
+    def test_recommend_games(self):
+        """Tests candidate expansion skips reviewed games before the top four"""
+        for game_id in range(2, 8):
+            db.session.add(Game(game_id=game_id, name="Game %d" % game_id,
+                                release_date=datetime.datetime.now()))
+        db.session.commit()
+        for game_id, score in zip(range(2, 8), [90, 85, 80, 75, 70, 65]):
+            db.session.add(Review(user_id=2, game_id=game_id, score=score))
+        db.session.add(Review(user_id=1, game_id=2, score=60))
+        db.session.commit()
+        build_similarity_index()
+
+        user1 = User.query.filter_by(user_id=1).first()
+        games = helpers.recommend_games(user1)
+        self.assertEqual([game.game_id for game in games], [3, 4, 5, 6])
+        self.assertEqual(games[0].name, "Game 3")
+
+        rows = db.session.query(Review.user_id, Review.game_id, Review.score).all()
+        self.assertEqual(RatingMatrix.from_rows(rows).recommend_games(1),
+                         [game.game_id for game in games])
+        self.assertEqual(helpers.recommend_games(User.query.get(3)), [])
+
+    def test_similarity_pairs_unique(self):
+        """Tests each direction of a pair is stored once and upserted"""
+        db.session.add(Review(user_id=3, game_id=1, score=80))
+        helpers.update_similarity_index(3, 1, None, 80)
+        db.session.commit()
+        helpers.update_similarity_index(3, 1, 80, 60)
+        db.session.commit()
+
+        pairs = UserSimilarity.query.filter_by(user_id=3).all()
+        self.assertEqual(sorted(pair.other_id for pair in pairs), [1, 2])
+        self.assertEqual([(pair.size, pair.sum_user) for pair in pairs],
+                         [(1, 60.0), (1, 60.0)])
+
+        db.session.add(UserSimilarity(user_id=3, other_id=1))
+        self.assertRaises(IntegrityError, db.session.commit)
+        db.session.rollback()
+
+    def test_cohorts(self):
+        """Tests that cohorts follow age and gender"""
+        user = User.query.filter_by(user_id=1).first()
+        self.assertEqual(user.cohort, "nb_gf:30")
+        user.age = "21"
+        self.assertEqual((user.age, user.cohort), (21, "nb_gf:20"))
+        user.gender = "f"
+        self.assertEqual(user.cohort, "f:20")
+        user.age = None
+        self.assertIsNone(user.cohort)
+
+    def test_no_cohort_neighbors(self):
+        """Tests full_sort users without a cohort don't match each other"""
+        for user_id in (1, 2):
+            User.query.get(user_id).age = None
+        db.session.commit()
+        build_similarity_index()
+
+        self.assertEqual(User.query.get(1).similar_users(), [])
+        User.query.get(1).full_sort = False
+        self.assertEqual([other_id for other_id, correlation
+                          in User.query.get(1).similar_users()], [2])
+
+    def test_precompute_recommendations(self):
+        """Tests the batch job stores each user's recommendations"""
+        example_sequel()
+
+        self.assertEqual(precompute.precompute_recommendations(chunk_size=2), 3)
+        self.assertEqual([(rec.user_id, rec.game_id, rec.rank)
+                          for rec in Recommendation.query.all()], [(1, 2, 0)])
+
+        # A rerun replaces the previous generation
+        precompute.precompute_recommendations()
+        self.assertEqual(Recommendation.query.count(), 1)
+
+    def test_precompute_popular(self):
+        """Tests the batch job ranks games per cohort and overall"""
+        db.session.add(User(username='other', password='x', email='o@test.com',
+                            age=22, gender='f'))
+        db.session.commit()
+        example_sequel(reviews=[(4, 90)])
+
+        self.assertEqual(precompute.precompute_popular(), 4)
+        popular = [(row.cohort, row.game_id, row.rank) for row in
+                   CohortPopularGame.query.order_by(CohortPopularGame.cohort,
+                                                    CohortPopularGame.rank)]
+        self.assertEqual(popular, [("all", 1, 0), ("all", 2, 1),
+                                   ("f:20", 2, 0), ("nb_gf:30", 1, 0)])
+
+    def test_precompute_parallel(self):
+        """Tests the process pool stores the same lists as the serial job"""
+        example_sequel()
+
+        precompute.precompute_recommendations()
+        serial = [(rec.user_id, rec.game_id, rec.rank)
+                  for rec in Recommendation.query.order_by(Recommendation.user_id,
+                                                           Recommendation.rank)]
+
+        self.assertEqual(precompute.precompute_parallel(workers=2), 2)
+        parallel = [(rec.user_id, rec.game_id, rec.rank)
+                    for rec in Recommendation.query.order_by(Recommendation.user_id,
+                                                             Recommendation.rank)]
+        self.assertEqual(parallel, serial)
+
+
+    def test_precompute_parallel_lsh(self):
+        """Tests workers only rank LSH candidates when asked to"""
+        example_sequel()
+
+        app.config["NEIGHBOR_SEARCH"] = "lsh"
+        try:
+            self.assertEqual(precompute.precompute_parallel(workers=2), 2)
+        finally:
+            app.config["NEIGHBOR_SEARCH"] = "exact"
+        self.assertEqual([(rec.user_id, rec.game_id, rec.rank)
+                          for rec in Recommendation.query.all()], [(1, 2, 0)])
+
 
 class PearsonTests(unittest.TestCase):
     """Tests for correlation/pearson"""
@@ -291,6 +1061,597 @@ class PearsonTests(unittest.TestCase):
         self.assertEqual(pearson(pairs), 0.0)
 
 
+class SimilarityTests(unittest.TestCase):
+    """Tests for the vectorized similarity engine in similarity"""
+
+    def setUp(self):
+        """Builds a random sparse set of reviews"""
+        rand = random.Random(7)
+        self.rows = []
+        for user_id in range(1, 41):
+            for game_id in rand.sample(range(1, 61), rand.randrange(1, 25)):
+                self.rows.append((user_id, game_id, rand.randrange(50, 100)))
+        self.matrix = RatingMatrix.from_rows(self.rows)
+
+    def test_matches_pearson(self):
+        """Tests that batch correlations agree with the scalar pearson"""
+        scores = {}
+        for user_id, game_id, score in self.rows:
+            scores.setdefault(user_id, {})[game_id] = score
+
+        for user_id in scores:
+            user_ids, correlations = self.matrix.similarities(user_id)
+            batch = dict(zip(user_ids, correlations))
+
+            for other_id in scores:
+                pairs = [(score, scores[other_id][game_id])
+                         for game_id, score in scores[user_id].items()
+                         if game_id in scores[other_id]]
+                if other_id == user_id or not pairs:
+                    self.assertNotIn(other_id, batch)
+                else:
+                    self.assertAlmostEqual(batch[other_id], pearson(pairs))
+
+    def test_candidates(self):
+        """Tests that a candidate mask limits the matched users"""
+        candidates = self.matrix.user_ids % 2 == 0
+        user_ids, correlations = self.matrix.similarities(1, candidates)
+        self.assertTrue(len(user_ids) > 0)
+        self.assertTrue(all(user_id % 2 == 0 for user_id in user_ids))
+
+    def test_candidate_rows(self):
+        """Tests that comparing against only some rows matches the mask"""
+        # Half the users reads the co-reviews, one user their own ratings
+        for candidates in (self.matrix.user_ids % 2 == 0,
+                           self.matrix.user_ids == 2):
+            rows = self.matrix.user_rows(self.matrix.user_ids[candidates])
+            for user_id in (1, 3):
+                masked = self.matrix.similarities(user_id, candidates)
+                limited = self.matrix.similarities(user_id, rows=rows)
+                self.assertEqual(list(limited[0]), list(masked[0]))
+                for found, expected in zip(limited[1], masked[1]):
+                    self.assertAlmostEqual(found, expected)
+                self.assertEqual(
+                    self.matrix.recommend_games(user_id, rows=rows),
+                    self.matrix.recommend_games(user_id, candidates=candidates))
+        self.assertEqual(list(self.matrix.user_rows([2, 999])),
+                         [self.matrix.user_row(2)])
+
+    def test_best_users(self):
+        """Tests that best users are the top correlations in order"""
+        user_ids, correlations = self.matrix.similarities(1)
+        best = self.matrix.best_users(1, 5)
+        self.assertEqual(len(best), min(5, len(user_ids)))
+        ranked = sorted(correlations, reverse=True)[:5]
+        found = dict(zip(user_ids, correlations))
+        self.assertEqual([found[user_id] for user_id in best], ranked)
+
+    def test_unknown_user(self):
+        """Tests that a user without reviews has no similar users"""
+        self.assertEqual(self.matrix.best_users(999), [])
+
+    def test_save_load(self):
+        """Tests that a memory-mapped copy gives the same results"""
+        directory = tempfile.mkdtemp()
+        try:
+            self.matrix.save(directory)
+            loaded = RatingMatrix.load(directory)
+            for user_id in (1, 2, 3):
+                self.assertEqual(loaded.best_users(user_id),
+                                 self.matrix.best_users(user_id))
+                self.assertEqual(loaded.recommend_games(user_id),
+                                 self.matrix.recommend_games(user_id))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_recommend_games(self):
+        """Tests that recommended games skip games the user reviewed"""
+        reviewed = set(game_id for user_id, game_id, score in self.rows
+                       if user_id == 1)
+        games = self.matrix.recommend_games(1)
+        self.assertTrue(games)
+        self.assertEqual(len(games), len(set(games)))
+        self.assertFalse(reviewed & set(games))
+
+
+class UserLSHTests(unittest.TestCase):
+    """Tests for the approximate neighbor index in similarity"""
+
+    def setUp(self):
+        """Builds exact neighbors for generated reviews"""
+        self.rows = benchmark.generate_reviews(num_users=200, num_games=100,
+                                               per_user=30)
+        matrix = RatingMatrix.from_rows(self.rows)
+        self.best = dict((user_id, matrix.best_users(user_id, 5))
+                         for user_id in range(1, 201))
+
+    def recall(self, index):
+        found = sum(len(set(best) & index.candidates(user_id))
+                    for user_id, best in self.best.items())
+        return found / float(sum(len(best) for best in self.best.values()))
+
+    def test_recall_knob(self):
+        """Tests that more tables find more of the exact neighbors"""
+        few = UserLSH.from_rows(self.rows, tables=1, bits=6)
+        many = UserLSH.from_rows(self.rows, tables=24, bits=6)
+        self.assertGreater(self.recall(many), self.recall(few))
+        self.assertGreater(self.recall(many), 0.5)
+
+    def test_candidates(self):
+        """Tests that candidates are symmetric and exclude the user"""
+        index = UserLSH.from_rows(self.rows, tables=4, bits=4)
+        for user_id in (1, 2, 3):
+            candidates = index.candidates(user_id)
+            self.assertNotIn(user_id, candidates)
+            for other_id in candidates:
+                self.assertIn(user_id, index.candidates(other_id))
+        self.assertEqual(index.candidates(999), set())
+
+
+class FactorizationTests(unittest.TestCase):
+    """Tests for the matrix-factorization engine in factorization"""
+
+    def setUp(self):
+        """Trains a model on generated reviews"""
+        self.rows = benchmark.generate_reviews(num_users=60, num_games=40,
+                                               per_user=15)
+        self.matrix = RatingMatrix.from_rows(self.rows)
+        self.model = FactorModel.train(self.matrix, factors=5)
+
+    def test_fits_scores(self):
+        """Tests that trained factors predict the training scores closely"""
+        errors = []
+        for user_id, game_id, score in self.rows:
+            game = list(self.model.game_ids).index(game_id)
+            errors.append(self.model.scores(user_id)[game] - score)
+        self.assertLess(np.sqrt(np.mean(np.square(errors))), 8)
+
+    def test_recommend_games(self):
+        """Tests that recommendations are ranked and skip reviewed games"""
+        reviewed = [game_id for user_id, game_id, score in self.rows
+                    if user_id == 1]
+        games = self.model.recommend_games(1, 10, reviewed)
+        self.assertEqual(len(games), 10)
+        self.assertFalse(set(reviewed) & set(games))
+        likes = self.model.expected_likes(1)
+        ranked = [likes[list(self.model.game_ids).index(game_id)]
+                  for game_id in games]
+        self.assertEqual(ranked, sorted(ranked, reverse=True))
+        self.assertEqual(self.model.recommend_games(999), [])
+
+    def test_biases(self):
+        """Tests that a user who scores everything high gets a high bias"""
+        rows = [(user_id, game_id, score + 15 if user_id == 1 else score)
+                for user_id, game_id, score in self.rows]
+        model = FactorModel.train(RatingMatrix.from_rows(rows), factors=5)
+        self.assertEqual(model.user_biases.argmax(), 0)
+        self.assertGreater(model.user_biases[0], 5)
+        self.assertAlmostEqual(model.mean, np.mean([row[2] for row in rows]))
+
+    def test_beats_popular(self):
+        """Tests the model recalls more liked games than the popular list"""
+        results = dict((result["engine"], result["recall_at_k"]) for result in
+                       benchmark.compare_recommenders(800, 300, 40, k=10,
+                                                      max_users=200))
+        self.assertGreater(results["factors"], results["popular"])
+
+    def test_save_load(self):
+        """Tests that a saved model scores the same after loading"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "factors.npz")
+            self.model.save(path)
+            loaded = factorization.load_cached(path)
+            self.assertTrue(np.allclose(loaded.scores(1), self.model.scores(1)))
+            self.assertTrue(np.allclose(loaded.expected_likes(1),
+                                        self.model.expected_likes(1)))
+            self.assertIs(factorization.load_cached(path), loaded)
+            self.assertIsNone(factorization.load_cached(path + ".missing"))
+        finally:
+            shutil.rmtree(directory)
+
+
+class BenchmarkTests(unittest.TestCase):
+    """Tests for the evaluation harness in benchmark"""
+
+    def test_metrics(self):
+        """Tests precision and recall count only liked held-out games"""
+        held_out = [(1, 90), (2, 85), (3, 60)]
+        self.assertEqual(benchmark.recall_at_k([1, 3, 4], held_out, k=2), 0.5)
+        self.assertEqual(benchmark.precision_at_k([1, 2, 4], held_out, k=4), 0.5)
+        self.assertIsNone(benchmark.precision_at_k([3], [(3, 60)]))
+
+    def test_compare_recommenders(self):
+        """Tests every engine is timed and scored, and results serialize"""
+        results = benchmark.compare_recommenders(60, 40, 15, k=5, max_users=20)
+        self.assertEqual([result["engine"] for result in results],
+                         ["popular", "pearson", "lsh", "factors"])
+        for result in results:
+            self.assertEqual(result["users"], 20)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+            self.assertGreater(result["peak_memory_mb"], 0)
+            self.assertGreaterEqual(result["memory_mb"], 0)
+            self.assertTrue(0 <= result["precision_at_k"] <= 1)
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "results.json")
+            benchmark.write_json(results, path)
+            with open(path) as file:
+                written = json.load(file)["results"]
+            self.assertEqual(written[1]["recall_at_k"], results[1]["recall_at_k"])
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_run_isolated(self):
+        """Tests that a child process reports only its own peak memory"""
+        baseline = benchmark.run_isolated(benchmark.peak_memory_mb)
+
+        def allocate():
+            scores = np.ones(10 ** 7)
+            return benchmark.peak_memory_mb(), scores.sum()
+
+        peak, total = benchmark.run_isolated(allocate)
+        self.assertEqual(total, 10 ** 7)
+        self.assertGreater(peak - baseline, 50)
+        self.assertRaises(RuntimeError, benchmark.run_isolated, lambda: 1 / 0)
+
+    def test_compare_search(self):
+        """Tests the search benchmark times the index on a generated catalog"""
+        rows = benchmark.generate_catalog(60)
+        self.assertEqual(len([row for row in rows if row[0] == "games"]), 60)
+        queries = benchmark.search_queries(rows, 30)
+        self.assertEqual(len(queries), 30)
+
+        results = benchmark.compare_search(60, 30, limit=5)
+        self.assertEqual([result["engine"] for result in results], ["index"])
+        self.assertEqual(results[0]["queries"], 30)
+        self.assertGreaterEqual(results[0]["mean_results"], 1)
+
+
+class TrigramSearchTests(unittest.TestCase):
+    """Tests for the PostgreSQL search backend in search"""
+
+    def setUp(self):
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        connect_to_db(app, "postgresql:///testdb")
+
+        available = db.session.execute("SELECT 1 FROM pg_available_extensions "
+                                       "WHERE name = 'pg_trgm'").scalar()
+        if not available:
+            db.session.close()
+            self.skipTest("pg_trgm is not installed")
+
+        db.create_all()
+        example_data()
+        search.create_trigram_indexes()
+        app.config["SEARCH_BACKEND"] = "trigram"
+
+    def tearDown(self):
+        app.config["SEARCH_BACKEND"] = "index"
+        search.drop_trigram_indexes()
+        db.session.close()
+        db.drop_all()
+
+    def test_search(self):
+        """Tests matches rank by similarity and page by offset"""
+        found = search.TrigramSearch().search("testo")
+        self.assertEqual(found["games"], [(1, "Testo")])
+        self.assertEqual([name for _, name in found["developers"]], ["Testo Games"])
+        self.assertEqual(search.TrigramSearch().search("testo", offset=1)["games"], [])
+        self.assertEqual(search.TrigramSearch().search("te_to")["games"], [])
+
+    def test_route(self):
+        """Tests /search can be served by the trigram backend"""
+        result = self.client.get("/search", query_string={"search": "test"})
+        self.assertIn("Testo Games", result.data)
+
+
+class CacheTests(unittest.TestCase):
+    """Tests for the LRU/TTL cache in cache"""
+
+    def setUp(self):
+        self.now = [0]
+        self.cache = LRUCache(max_size=2, ttl=10, timer=lambda: self.now[0])
+
+    def test_hit_miss(self):
+        """Tests that set values are returned and counted"""
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, [])
+        self.assertEqual(self.cache.get(1), [])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_ttl(self):
+        """Tests that entries expire after ttl seconds"""
+        self.cache.set(1, "a")
+        self.now[0] = 9
+        self.assertEqual(self.cache.get(1), "a")
+        self.now[0] = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        """Tests that the least recently used entry is evicted"""
+        self.cache.set(1, "a")
+        self.cache.set(2, "b")
+        self.cache.get(1)
+        self.cache.set(3, "c")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "a")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_invalidate(self):
+        """Tests that invalidated entries are dropped and counted"""
+        self.cache.set(1, "a")
+        self.cache.invalidate(1)
+        self.cache.invalidate(2)
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+    def test_invalidate_all(self):
+        """Tests that every entry is dropped and the counters kept"""
+        self.cache.set(1, "a")
+        self.cache.set(2, "b")
+        self.cache.get(1)
+        self.cache.invalidate_all()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.stats()["invalidations"], 2)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+
+class LeaderboardTests(unittest.TestCase):
+    """Tests for the in-memory rankings in leaderboard"""
+
+    def test_matches_sort(self):
+        """Tests that random updates keep the same order as a full sort"""
+        rand = random.Random(0)
+        leaderboard = Leaderboard.from_rows([(1, 80), (2, None), (3, 80)])
+        scores = {1: 80.0, 3: 80.0}
+        for _ in range(500):
+            game_id = rand.randint(1, 50)
+            score = rand.choice([None, rand.randint(50, 100)])
+            leaderboard.update(game_id, score)
+            scores.pop(game_id, None)
+            if score is not None:
+                scores[game_id] = float(score)
+
+        expected = sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))
+        self.assertEqual(leaderboard.top(len(scores) + 5), expected)
+        self.assertEqual(len(leaderboard), len(scores))
+        self.assertEqual(leaderboard.top(3), expected[:3])
+
+
+class TrendingTests(unittest.TestCase):
+    """Tests for the decayed activity ranking in trending"""
+
+    def setUp(self):
+        self.now = [0]
+        self.trending = TrendingGames(half_life=10, timer=lambda: self.now[0])
+
+    def test_decay(self):
+        """Tests that activity halves every half-life"""
+        self.trending.add_review(1, 80)
+        self.trending.add_review(1, 60)
+        self.now[0] = 20
+        game_id, trend, activity, avg_score = self.trending.top()[0]
+        self.assertAlmostEqual(activity, 0.5)
+        self.assertAlmostEqual(trend, 35)
+        self.assertAlmostEqual(avg_score, 70)
+
+    def test_ranking(self):
+        """Tests that recent activity outranks older activity"""
+        for _ in range(3):
+            self.trending.add_review(1, 90)
+        self.now[0] = 30
+        self.trending.add_review(2, 90)
+        self.trending.add_review(3, 50)
+        self.assertEqual([row[0] for row in self.trending.top()], [2, 3, 1])
+        self.assertEqual(len(self.trending.top(1)), 1)
+
+    def test_rebase(self):
+        """Tests that moving the landmark keeps totals and order"""
+        self.trending.add_review(1, 90)
+        self.trending.add_review(2, 50, when=5)
+        before = self.trending.top(now=10)
+        self.trending._rebase(8)
+        for row, expected in zip(self.trending.top(now=10), before):
+            self.assertEqual(row[0], expected[0])
+            for value, expected_value in zip(row[1:], expected[1:]):
+                self.assertAlmostEqual(value, expected_value)
+
+        self.trending.add_review(3, 70, when=10 * 1000)
+        self.assertEqual(self.trending.top(1, now=10 * 1000)[0][0], 3)
+
+    def test_edit(self):
+        """Tests that an edited review matches a rebuild with its new score"""
+        self.trending.add_review(1, 90, when=0)
+        self.trending.add_review(1, 50, when=5)
+        self.trending.remove_review(1, 50, 5)
+        self.trending.add_review(1, 70, when=8)
+        self.trending.add_review(2, 60, when=3)
+        self.trending.remove_review(2, 60, 3)
+
+        rebuilt = TrendingGames.from_rows([(1, 90, 0), (1, 70, 8)], half_life=10,
+                                          landmark=0)
+        self.assertEqual(len(self.trending.top(now=10)), 1)
+        for value, expected in zip(self.trending.top(now=10)[0],
+                                   rebuilt.top(now=10)[0]):
+            self.assertAlmostEqual(value, expected)
+
+
+class SearchIndexTests(unittest.TestCase):
+    """Tests for the in-memory search index in search"""
+
+    def setUp(self):
+        self.index = SearchIndex.from_rows([
+            ("games", 1, "Halo"), ("games", 2, "Halo: Reach"),
+            ("games", 3, "Mythic Halo Wars"), ("games", 4, "Shalom"),
+            ("games", 5, "Reach for Halo"), ("platforms", 1, "Xbox One"),
+            ("users", 1, "haloFan")])
+
+    def test_ranking(self):
+        """Tests exact, prefix, word and substring matches rank in order"""
+        found = self.index.search("halo")
+        self.assertEqual([game_id for game_id, name in found["games"]],
+                         [1, 2, 5, 3, 4])
+        self.assertEqual(found["users"], [(1, "haloFan")])
+        self.assertEqual(found["platforms"], [])
+
+    def test_words(self):
+        """Tests that every word must appear, in any order"""
+        found = self.index.search("REACH halo")
+        self.assertEqual([game_id for game_id, name in found["games"]], [2, 5])
+        self.assertEqual(self.index.search("x")["platforms"], [(1, "Xbox One")])
+        self.assertEqual(self.index.search("halo zzz")["games"], [])
+        self.assertEqual(self.index.search("  ")["games"], [])
+
+    def test_limit(self):
+        """Tests that limit applies per category"""
+        found = self.index.search("halo", limit=2)
+        self.assertEqual(len(found["games"]), 2)
+        self.assertEqual(len(found["users"]), 1)
+
+    def test_update(self):
+        """Tests that renaming and removing update the postings"""
+        self.index.add("games", 4, "Forza")
+        self.assertEqual(len(self.index.search("halo")["games"]), 4)
+        self.assertEqual(self.index.search("forza")["games"], [(4, "Forza")])
+        self.index.remove("games", 4)
+        self.assertEqual(self.index.search("forza")["games"], [])
+        self.assertNotIn(u"forz", self.index.postings)
+
+    def test_offset(self):
+        """Tests that offset pages through each category's ranking"""
+        first = self.index.search("halo", limit=2)["games"]
+        second = self.index.search("halo", limit=2, offset=2)["games"]
+        self.assertEqual(first + second, self.index.search("halo", 4)["games"])
+
+    def test_snapshot(self):
+        """Tests that a saved index loads with the same results"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "search.json")
+            self.index.save(path)
+            loaded = SearchIndex.load(path)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(len(loaded), len(self.index))
+        self.assertEqual(loaded.search("halo"), self.index.search("halo"))
+
+
+class PrefixIndexTests(unittest.TestCase):
+    """Tests for the typeahead prefix index in search"""
+
+    def setUp(self):
+        self.index = PrefixIndex([
+            ("games", 1, "Halo", 10), ("games", 2, "Halo: Reach", 30),
+            ("games", 3, "Mythic Halo Wars", 30), ("games", 4, "Shalom", 50),
+            ("franchises", 1, "Halo", None), ("platforms", 1, "Xbox One", 5)],
+            max_limit=4)
+
+    def test_ranking(self):
+        """Tests that word prefixes rank by weight, then name prefix"""
+        self.assertEqual(self.index.suggest("halo"),
+                         [("games", 2, "Halo: Reach"),
+                          ("games", 3, "Mythic Halo Wars"),
+                          ("games", 1, "Halo"), ("franchises", 1, "Halo")])
+        self.assertEqual(self.index.suggest("one"), [("platforms", 1, "Xbox One")])
+        self.assertEqual(self.index.suggest("alo"), [])
+
+    def test_precomputed(self):
+        """Tests that short prefixes rank the same as long ones"""
+        self.assertEqual(self.index.suggest("h", 3), self.index.suggest("hal", 3))
+        self.assertEqual(self.index.suggest("ha"), self.index.suggest("hal"))
+        self.assertEqual(self.index.suggest("s"), [("games", 4, "Shalom")])
+
+    def test_limit(self):
+        """Tests that limit is capped by max_limit"""
+        self.assertEqual(len(self.index.suggest("halo", 2)), 2)
+        self.assertEqual(len(self.index.suggest("halo", 100)), 4)
+        self.assertEqual(self.index.suggest("halo", 0), [])
+        self.assertEqual(self.index.suggest(" "), [])
+
+
+class RefreshingCacheTests(unittest.TestCase):
+    """Tests for the stale-while-revalidate cache in cache"""
+
+    def setUp(self):
+        self.now = [0]
+        self.cache = RefreshingCache(ttl=10, max_stale=100, background=False,
+                                     timer=lambda: self.now[0])
+        self.calls = []
+
+    def compute(self):
+        self.calls.append(self.now[0])
+        return len(self.calls)
+
+    def test_fresh(self):
+        """Tests that fresh entries are computed once"""
+        self.assertEqual(self.cache.get("a", self.compute), 1)
+        self.now[0] = 9
+        self.assertEqual(self.cache.get("a", self.compute), 1)
+        self.assertEqual(self.calls, [0])
+
+    def test_stale_while_revalidate(self):
+        """Tests that expired entries are served stale while refreshing"""
+        self.cache.get("a", self.compute)
+        self.now[0] = 10
+        self.assertEqual(self.cache.get("a", self.compute), 1)
+        self.assertEqual(self.cache.get("a", self.compute), 2)
+        self.now[0] = 200
+        self.assertEqual(self.cache.get("a", self.compute), 3)
+        self.assertEqual(self.cache.stats()["stale_hits"], 1)
+
+    def test_invalidate(self):
+        """Tests that invalidation marks entries stale"""
+        self.cache.get("a", self.compute)
+        self.cache.invalidate("a")
+        self.cache.invalidate("b")
+        self.assertEqual(self.cache.get("a", self.compute), 1)
+        self.assertEqual(self.cache.get("a", self.compute), 2)
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+    def test_invalidate_during_refresh(self):
+        """Tests that a refresh racing an invalidation stays stale"""
+        self.cache.get("a", self.compute)
+        self.now[0] = 10
+
+        def compute():
+            self.cache.invalidate("a")
+            return self.compute()
+
+        self.cache.get("a", compute)
+        self.assertEqual(self.cache.get("a", self.compute), 2)
+        self.assertEqual(self.cache.get("a", self.compute), 3)
+
+    def test_background(self):
+        """Tests that background refreshes run once per key"""
+        self.cache.background = True
+        self.cache.get("a", self.compute)
+        self.now[0] = 10
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return "new"
+
+        self.assertEqual(self.cache.get("a", slow), 1)
+        started.wait(5)
+        self.assertEqual(self.cache.get("a", self.compute), 1)
+        release.set()
+        for _ in range(500):
+            if self.cache.get("a", self.compute) == "new":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.calls, [0])
+        self.assertEqual(self.cache.get("a", self.compute), "new")
+
+
 class PullDataTests(unittest.TestCase):
     """Tests for pull_data"""
 
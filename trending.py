@@ -0,0 +1,121 @@
+"""Trending games ranked from time-decayed review activity"""
+
+import time
+
+from leaderboard import Leaderboard
+
+
+class TrendingGames(object):
+    """Games ranked by exponentially decayed review activity
+
+    Every review counts for 1 when written and half as much each half_life
+    seconds after. A game's trend is its decayed sum of review scores, so
+    a burst of well-scored reviews outranks the same number of poor ones;
+    activity (the decayed review count) and the decayed average score are
+    reported alongside.
+
+    Totals use forward decay: a review at time t adds 2 ** ((t - landmark) /
+    half_life) instead of decaying every game on each write. Dividing by the
+    same factor at the current time gives the decayed totals, and since that
+    factor is shared the order only changes on writes, so a Leaderboard of
+    the stored totals serves the top games.
+    """
+
+    # Rebase the landmark before the weights overflow a float
+    max_halvings = 512
+
+    def __init__(self, half_life=7 * 24 * 3600, landmark=None, timer=time.time):
+        self.half_life = float(half_life)
+        self.timer = timer
+        self.landmark = timer() if landmark is None else landmark
+
+        # game_id -> [weighted review count, weighted score sum]
+        self.totals = {}
+        self.ranking = Leaderboard()
+
+    def __repr__(self):
+        """Provide helpful output when printed"""
+
+        t = "<TrendingGames games=%s half_life=%s>"
+        return t % (len(self.totals), self.half_life)
+
+    @classmethod
+    def from_rows(cls, rows, **options):
+        """Builds the ranking from (game_id, score, timestamp) rows"""
+
+        trending = cls(**options)
+        for game_id, score, timestamp in rows:
+            trending.add_review(game_id, score, timestamp)
+
+        return trending
+
+    def weight(self, when):
+        """Forward-decay weight of an event at when"""
+
+        return 2 ** ((when - self.landmark) / self.half_life)
+
+    def add_review(self, game_id, score, when=None):
+        """Records a review of game_id written at when (default now)"""
+
+        if when is None:
+            when = self.timer()
+
+        if (when - self.landmark) / self.half_life > self.max_halvings:
+            self._rebase(when)
+
+        weight = self.weight(when)
+        totals = self.totals.setdefault(game_id, [0.0, 0.0])
+        totals[0] += weight
+        totals[1] += weight * score
+
+        self.ranking.update(game_id, totals[1])
+
+    def remove_review(self, game_id, score, when):
+        """Takes back a review recorded by add_review(), e.g. before its
+        score changes
+        """
+
+        totals = self.totals.get(game_id)
+        if totals is None:
+            return
+
+        weight = self.weight(when)
+        totals[0] -= weight
+        totals[1] -= weight * score
+
+        # Only rounding error left; drop the game rather than divide by it
+        if totals[0] <= weight * 1e-9:
+            del self.totals[game_id]
+            self.ranking.update(game_id, None)
+        else:
+            self.ranking.update(game_id, totals[1])
+
+    def _rebase(self, landmark):
+        """Moves the landmark to keep weights in range"""
+
+        scale = 1 / self.weight(landmark)
+        self.landmark = landmark
+
+        rows = []
+        for game_id, totals in self.totals.items():
+            totals[0] *= scale
+            totals[1] *= scale
+            rows.append((game_id, totals[1]))
+
+        self.ranking = Leaderboard.from_rows(rows)
+
+    def top(self, limit=20, now=None):
+        """Returns the trending (game_id, trend, activity, avg_score), best first
+
+        trend and activity are decayed to now (default the current time).
+        """
+
+        scale = 1 / self.weight(self.timer() if now is None else now)
+
+        results = []
+        for game_id, weighted_sum in self.ranking.top(limit):
+            weighted_count = self.totals[game_id][0]
+            results.append((game_id, weighted_sum * scale, weighted_count * scale,
+                            weighted_sum / weighted_count))
+
+        return results